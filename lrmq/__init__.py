@@ -31,7 +31,8 @@ assert sys.version_info >= (3, 5, 2), \
     "Python 3.5.2. required for loop.create_future()"
 
 from .hub import Hub
-from .agent import (Agent, AgentStdIO, AgentSystem, agent_factory)
+from .agent import (Agent, AgentStdIO, AgentSystem, AgentListener, 
+    AgentSocket, agent_factory)
 
 def main(cfg = None):
     import asyncio
@@ -39,6 +40,11 @@ def main(cfg = None):
     if not cfg:
         import argparse
         
+        if sys.argv[1:2] == ["bench"]:
+            from . import bench
+
+            return bench.main(sys.argv[2:])
+
         parser = argparse.ArgumentParser()
         parser.add_argument("-c", "--config", 
             help = "Configuration file (json)")
@@ -94,6 +100,12 @@ def main(cfg = None):
                 acfg["log"] = args.agent_log 
             cfg["agents"] = [acfg]
 
+    if cfg.get("shards", 1) > 1:
+        # hub of several processes
+        from .shard import run_sharded
+
+        return run_sharded(cfg)
+
     hub = Hub()
     hub.load_config(cfg)
 
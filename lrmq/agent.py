@@ -22,7 +22,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import sys
+import stat
 import json
 import pickle
 import struct
@@ -30,38 +32,89 @@ import logging
 import asyncio
 import re
 import types
+import zlib
 import traceback
-import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# frame compressors: name -> (compress, decompress), preferred first
+compressors = {}
+if lz4 is not None:
+    compressors[b"lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+compressors[b"zlib"] = (lambda data: zlib.compress(data, 1), 
+    zlib.decompress)
+
+# length header flag: frame is compressed
+FRAME_COMPRESSED = 0x80000000
 
 from .logs import LogTypes
+from .route import compile_mask
+from .topiclog import LogCursor
+from .msgqueue import (MsgQueue, QueueItem, Envelope, plain_item, 
+    plain_answer)
 
 class Agent:
     "Base class for all agents"
 
     protocols = {}
+    # commands which are never processed concurrently
+    ordered_cmds = ("exit", "pipeline")
+    # max messages in one stream frame
+    stream_chunk = 100
 
     @classmethod
     def reg_protocol(cls, label, proto):
         cls.protocols[label] = proto
 
-    def __init__(self, hub, name):
+    def __init__(self, hub, name, logger = None):
         self.hub = hub
         if name is None:
             name = hub.genid("agent")
         self.name = name
         self.isloop = True
         # messages
-        self.q = []
+        self.q = MsgQueue()
+        self.pulse = None # pending pulse, kept out of bounded queue
         self.q_s = None
         self.subs = []
-        # logger
-        self.logger = logging.getLogger("log_" + name)
-        self.logger.addFilter(self.hub.log_filter)
+        # logger, shared one is passed by short-lived agents, loggers
+        # are never released
+        if logger is None:
+            logger = logging.getLogger("log_" + name)
+            logger.addFilter(self.hub.log_filter)
+        self.logger = logger
         # events
         self.ev_msg = {} # messages for events: 
         #                  prepare, new, lost, exit, error, msg_lost
         # rpc
         self.isrpc = False
+        # link to other hub shard
+        self.isshard = False
+        # pipelined requests
+        self.pipeline_sem = None
+        self.pipeline_limit = None
+        self.inflight = set()
+        self.recv_task = None
+        # offered protocols, None - all registered
+        self.proto_labels = None
+        # frame compression (compress, decompress) or None
+        self.compressor = None
+        self.compress_threshold = 0
+        # streaming delivery
+        self.stream_credit = 0
+        self.stream_task = None
+        # durable queue name in hub store, None - not durable
+        self.store_key = None
+        # retention log replays, delivered before queue
+        self.replays = []
 
     async def prepare(self):
         "Prepare loop"
@@ -72,28 +125,38 @@ class Agent:
     async def negotiate(self):
         "Negotiate protocol"
         
-        pr = b"|".join(Agent.protocols.keys()) + b"\n"
-        self.send(pr)
+        # "proto1|proto2 compressor1,compressor2"
+        labels = [x for x in Agent.protocols 
+            if self.proto_labels is None or x in self.proto_labels]
+        pr = b"|".join(labels)
+        if self.hub.compress_threshold and compressors:
+            pr += b" " + b",".join(compressors.keys())
+        self.send(pr + b"\n")
         await self.flush()
-        # read confirmation
+        # read confirmation, "proto [compressor]"
         sp = (await self.readline()).strip()
         if sp:
             self.logger.debug(LogTypes.AGENT_SELECT_PROTO, self.name, 
                 sp.decode("utf-8"))
-            self.select_protocol(Agent.protocols[sp])
+            sp = sp.split(b" ")
+            if len(sp) > 1:
+                self.compressor = compressors[sp[1]]
+                self.compress_threshold = self.hub.compress_threshold
+            if sp[0] not in labels:
+                raise Exception("Protocol %s was not offered" % repr(sp[0]))
+            self.select_protocol(Agent.protocols[sp[0]])
             return True
         else:
             self.isloop = False
             self.logger.debug(LogTypes.AGENT_LOST_CHAN, self.name)
             self.hub.logger.debug(LogTypes.AGENT_LOST_CHAN, self.name)
             self.send_agent_event("lost")
-            # collect agent messages
-            while True:
-                data = await self.readline()
-                if not data: break
-                sys.stdout.buffer.write(data)
+            await self.collect_output()
             return False
 
+    async def collect_output(self):
+        "Channel without protocol is closed, pass rest of output"
+
     def select_protocol(self, mixin):
         "Use mixin methods for exchange"
 
@@ -129,15 +192,25 @@ class Agent:
             while self.isloop:
                 try:
                     req = await self.recv_request()
-                    self.logger.debug(LogTypes.AGENT_READ, req, 
-                        extra = {"req": req})
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug(LogTypes.AGENT_READ, req, 
+                            extra = {"req": req})
                 except asyncio.CancelledError as e:
                     self.logger.debug(LogTypes.AGENT_STREAM_END, self.name)
+                    if cmd_recv.empty():
+                        # wake main loop if pipelined send failed
+                        cmd_recv.put_nowait(None)
                     break
+                except asyncio.IncompleteReadError as e:
+                    self.logger.debug(LogTypes.AGENT_STREAM_END, self.name)
+                    req = None
                 except Exception as e:
                     self.logger.error(LogTypes.AGENT_READ_ERROR, self.name,
                         traceback.format_exc(), exc_info = True)
                     req = {"cmd": "!", "msg": repr(e)}
+                if req is None:
+                    await cmd_recv.put(req)
+                    break
                 if req == "-": 
                     self.logger.debug(LogTypes.AGENT_GOT_SIGNAL, self.name)
                     self.signal()
@@ -149,44 +222,90 @@ class Agent:
                     self.logger.error(LogTypes.AGENT_REQ_CMD_ERR)
                     req = {"cmd": "!", "msg": "Bad command request"}
                 await cmd_recv.put(req)
-        recv_task = asyncio.ensure_future(receiver())
+        self.recv_task = asyncio.ensure_future(receiver())
         while self.isloop:
             req = await cmd_recv.get()
             if not req:
+                if not self.isloop:
+                    # pipelined send failed, already reported
+                    break
                 # stream lost
                 self.logger.debug(LogTypes.AGENT_LOST, self.name)
                 self.hub.logger.debug(LogTypes.AGENT_LOST, self.name)
                 self.send_agent_event("lost")
                 self.isloop = False
                 break
-            try:
-                ans = await self.make_answer(req)
-            except Exception as e:
-                self.logger.exception(LogTypes.AGENT_EXC_LOOP)
-                ans = {"answer": "error", "msg": repr(e)}
-            cid = req.get("id")
-            if cid is not None:
-                ans["id"] = cid
-            self.logger.debug(LogTypes.AGENT_WRITE, ans, 
-                extra = {"ans": ans})
-            try:
-                await self.send_answer(ans)
-            except Exception as e:
-                self.logger.exception(LogTypes.AGENT_EXC_SEND)
-                self.hub.logger.debug(LogTypes.AGENT_LOST_SEND, self.name)
-                self.logger.debug(LogTypes.AGENT_LOST_SEND, self.name)
-                self.send_agent_event("lost")
-                self.isloop = False
+            if self.pipeline_sem is not None and \
+                    req.get("id") is not None and \
+                    req.get("cmd") not in self.ordered_cmds:
+                # pipelined mode: answer when ready
+                await self.pipeline_sem.acquire()
+                task = asyncio.ensure_future(self.process_request(req))
+                self.inflight.add(task)
+                task.add_done_callback(self.request_done)
+            elif not (await self.process_request(req)):
                 break
-        recv_task.cancel()
+        for task in list(self.inflight):
+            task.cancel()
+        if self.stream_task:
+            self.stream_task.cancel()
+        self.recv_task.cancel()
         self.hub.logger.debug(LogTypes.AGENT_FINISH, self.name)
         self.logger.debug(LogTypes.AGENT_FINISH, self.name)
+        grouped = {subid: self.hub.sub_groups[subid] for subid in self.subs
+            if subid in self.hub.sub_groups}
         for subid in self.subs:
             self.logger.debug(LogTypes.AGENT_UNSUBSCRIBE, self.name, subid)
             self.hub.unsubscribe(subid)
+        for cur in self.replays:
+            # unpin retention log segments
+            cur.close()
+        self.replays = []
+        if grouped:
+            # backlog goes to other group members
+            self.hub.redistribute(self, grouped)
         self.send_agent_event("exit")
         await self.finish()
 
+    async def process_request(self, req):
+        "Make answer and send it back, return False if channel lost"
+
+        try:
+            ans = await self.make_answer(req)
+        except Exception as e:
+            self.logger.exception(LogTypes.AGENT_EXC_LOOP)
+            ans = {"answer": "error", "msg": repr(e)}
+        if ans is None:
+            # one-way command
+            return True
+        cid = req.get("id")
+        if cid is not None:
+            ans["id"] = cid
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(LogTypes.AGENT_WRITE, ans, 
+                extra = {"ans": ans})
+        try:
+            await self.send_answer(ans)
+        except Exception as e:
+            self.logger.exception(LogTypes.AGENT_EXC_SEND)
+            self.hub.logger.debug(LogTypes.AGENT_LOST_SEND, self.name)
+            self.logger.debug(LogTypes.AGENT_LOST_SEND, self.name)
+            if self.isloop:
+                self.send_agent_event("lost")
+                self.isloop = False
+            return False
+        return True
+
+    def request_done(self, task):
+        "Pipelined request finished"
+
+        self.inflight.discard(task)
+        self.pipeline_sem.release()
+        if not task.cancelled() and task.exception() is None and \
+                task.result() is False:
+            # channel lost, stop like sequential mode does
+            self.recv_task.cancel()
+
     def send_agent_event(self, ev, extra = None):
         aid = self.getid()
         msg = extra or {}
@@ -198,22 +317,70 @@ class Agent:
             self.hub.push_msg(None, self.ev_msg[ev], msg)
 
     def signal(self, result = True):
-        if self.q_s is not None:
+        if self.q_s is not None and not self.q_s.done():
             self.q_s.set_result(True)
 
+    async def wait_signal(self):
+        "Wait for new messages, may be shared by several requests"
+
+        q_s = self.q_s
+        if q_s is None or q_s.done():
+            q_s = self.q_s = self.hub.loop.create_future()
+        await q_s
+        if self.q_s is q_s:
+            self.q_s = None
+
     def push_msg(self, name, msg = None, opts = None):
         "Push message to queue"
 
-        self.logger.debug(LogTypes.HUB_MESSAGE, name, str(msg), str(opts))
-        until = None
-        if opts:
+        self.push_envelope(Envelope(name, msg, opts))
+
+    def push_pulse(self, env):
+        "Keep latest pulse, it never takes place of queued messages"
+
+        self.pulse = QueueItem(env, until = self.hub.loop.time() + 
+            env.opts["ttl"])
+        self.signal()
+
+    def has_msgs(self):
+        "Replays, queued messages or pulse are waiting"
+
+        return bool(self.replays or len(self.q) or self.pulse)
+
+    def push_envelope(self, env, subid = None, until = None):
+        "Push shared message to queue, until keeps deadline of requeued"
+
+        opts = env.opts
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(LogTypes.HUB_MESSAGE, env.name, str(env.msg), 
+                str(opts))
+        if until is None and opts:
             ttl = opts.get("ttl")
             if ttl:
-                until = datetime.datetime.now() + \
-                    datetime.timedelta(seconds = ttl)
-        self.q.append((name, msg, opts, until))
+                until = self.hub.loop.time() + ttl
+        # may raise QueueOverflow
+        dropped = self.q.push(QueueItem(env, subid, until))
+        for item in dropped:
+            self.item_done(item)
+            self.hub.removed_msg(self, "overflow", item.name, item.msg, 
+                item.opts)
         self.signal()
 
+    def item_done(self, item):
+        "Message left queue, acknowledge it in durable log"
+
+        if item.env.store_seq is not None and self.store_key is not None:
+            self.hub.store.ack(item.env.store_seq, self.store_key)
+
+    def setup_queue(self, cfg):
+        "Configure queue limits, hub settings are defaults"
+
+        qcfg = dict(self.hub.cfg.get("queue", {}))
+        qcfg.update(cfg or {})
+        self.q.configure(max_msgs = qcfg.get("max_msgs"), 
+            max_bytes = qcfg.get("max_bytes"), 
+            overflow = qcfg.get("overflow", "drop_oldest"))
+
     def getid(self):
         "Return agentid"
         
@@ -242,6 +409,23 @@ class Agent:
 
         return {"answer": "ok", "agentid": self.getid()}
 
+    async def cmd_pipeline(self, req):
+        "Switch to pipelined mode, requests with id are processed concurrently"
+
+        limit = req.get("limit", self.hub.pipeline_limit)
+        if not isinstance(limit, int) or limit < 1:
+            return {"answer": "error", "msg": "Bad pipeline limit"}
+        limit = min(limit, self.hub.pipeline_limit)
+        if self.pipeline_sem is not None and self.pipeline_limit != limit \
+                and self.inflight:
+            # in-flight requests release old semaphore
+            return {"answer": "error", 
+                "msg": "Requests in flight, limit not changed"}
+        if self.pipeline_sem is None or self.pipeline_limit != limit:
+            self.pipeline_sem = asyncio.Semaphore(limit)
+            self.pipeline_limit = limit
+        return {"answer": "ok", "limit": limit}
+
     async def cmd_exit(self, req):
         "End communications"
 
@@ -252,39 +436,143 @@ class Agent:
         "Subscribe to message(s)"
 
         try:
-            mask = re.compile(req.get("mask"))
-            subid = self.hub.subscribe(mask = mask, subscriber = self)
+            mask = compile_mask(req.get("mask"), req.get("syntax", "re"))
+            group = req.get("group")
+            if group is not None and not isinstance(group, str):
+                raise Exception("Group must be string")
+            log = None
+            if "from_offset" in req or "from_time" in req or \
+                    req.get("latest"):
+                log = self.hub.topic_log_for(mask)
+                end = log.next_offset
+                if "from_offset" in req:
+                    start = int(req["from_offset"])
+                elif "from_time" in req:
+                    start = log.offset_at(float(req["from_time"]))
+                else:
+                    start = end
+                start = max(start, log.first_offset)
+            subid = self.hub.subscribe(mask = mask, subscriber = self, 
+                group = group)
             self.subs.append(subid)
             self.logger.debug(LogTypes.AGENT_SUBSCRIBE, self.name, subid)
-            return {"answer": "ok", "subid": subid}
+            if log is None:
+                return {"answer": "ok", "subid": subid}
+            # history up to end, then live messages from queue
+            if start < end:
+                self.replays.append(LogCursor(log, start, end, mask, subid))
+                self.signal()
+            return {"answer": "ok", "subid": subid, "offset": start, 
+                "end": end}
         except Exception as e:
             return {"answer": "error", "msg": str(e)}
 
     async def cmd_wait_msg(self, req):
         "Get new messages. Wait if necessary"
 
-        def getpart():
-            part = []
-            while len(self.q):
-                name, msg, opts, until = self.q.pop(0)
-                part.append((name, msg, opts))
-                if len(part) >= 10: break
-            return part
         def answer(part):
-            return {"answer": "ok", "msgs": part, "empty": len(self.q) == 0}
-        q = getpart()
+            return {"answer": "ok", "msgs": part, 
+                "empty": not self.has_msgs()}
+        q = self.take_part(10)
         if q:
             return answer(q) 
         try:
             if not q and req.get("block"):
                 # wait for new messages
-                self.q_s = self.hub.loop.create_future()
-                await self.q_s
-                self.q_s = None
-            return answer(getpart())
+                started = self.hub.loop.time()
+                await self.wait_signal()
+                self.hub.metrics.wait_time.record(self.hub.loop.time() - 
+                    started)
+            return answer(self.take_part(10))
         except Exception as e:
             return {"answer": "error", "msg": str(e)}
 
+    async def cmd_stream(self, req):
+        "Start (or stop) pushing messages to agent without wait_msg"
+
+        if req.get("stop"):
+            self.stream_credit = 0
+            if self.stream_task:
+                self.stream_task.cancel()
+                self.stream_task = None
+            return {"answer": "ok", "credit": 0}
+        credit = req.get("credit", 100)
+        if not isinstance(credit, int) or credit < 0:
+            return {"answer": "error", "msg": "Bad credit value"}
+        self.stream_credit += credit
+        if self.stream_task is None:
+            self.stream_task = asyncio.ensure_future(self.streamer())
+        self.signal()
+        return {"answer": "ok", "credit": self.stream_credit}
+
+    async def cmd_credit(self, req):
+        "Add stream credit, one-way command without answer"
+
+        credit = req.get("credit", 0)
+        if isinstance(credit, int) and credit > 0:
+            self.stream_credit += credit
+            self.signal()
+        return None
+
+    async def streamer(self):
+        "Write queued messages while stream credit allows"
+
+        while self.isloop:
+            if self.stream_credit > 0 and self.has_msgs():
+                part = self.take_part(min(self.stream_credit, 
+                    self.stream_chunk))
+                if part:
+                    self.stream_credit -= len(part)
+                    ans = {"answer": "stream", "msgs": part, 
+                        "credit": self.stream_credit}
+                    if self.logger.isEnabledFor(logging.DEBUG):
+                        self.logger.debug(LogTypes.AGENT_WRITE, ans, 
+                            extra = {"ans": ans})
+                    try:
+                        await self.send_answer(ans)
+                    except Exception as e:
+                        self.logger.exception(LogTypes.AGENT_EXC_SEND)
+                        break
+                    continue
+            await self.wait_signal()
+
+    async def cmd_batch(self, req):
+        "Execute list of requests in order, return all answers at once"
+
+        reqs = req.get("reqs")
+        if not isinstance(reqs, list):
+            return {"answer": "error", "msg": "Batch requests must be list"}
+        answers = []
+        commits = [] # wait for all persisted pushes at once
+        for sreq in reqs:
+            if not isinstance(sreq, dict) or \
+                    not isinstance(sreq.get("cmd"), str):
+                ans = {"answer": "error", "msg": "Bad command request"}
+            elif sreq["cmd"] in ("batch", "pipeline"):
+                ans = {"answer": "error", 
+                    "msg": "Command '%s' not allowed in batch" % sreq["cmd"]}
+            else:
+                try:
+                    if sreq["cmd"] == "push":
+                        fut = self.push_request(sreq)
+                        if fut is not None and fut not in commits:
+                            commits.append(fut)
+                        ans = {"answer": "ok"}
+                    else:
+                        ans = await self.make_answer(sreq)
+                    if ans is None:
+                        ans = {"answer": "ok"}
+                except Exception as e:
+                    self.logger.exception(LogTypes.AGENT_EXC_LOOP)
+                    ans = {"answer": "error", "msg": repr(e)}
+                cid = sreq.get("id")
+                if cid is not None:
+                    ans["id"] = cid
+            answers.append(ans)
+        if commits:
+            await asyncio.gather(*commits)
+        return {"answer": "ok", "answers": answers}
+
     async def cmd_start_agent(self, req):
         cfg = req.get("cfg")
         a = agent_factory(self.hub, cfg)
@@ -293,30 +581,70 @@ class Agent:
         return {"answer": "ok"}
 
     async def cmd_push(self, req):
-        self.hub.push_msg(self, name = req.get("name"), msg = req.get("msg"), 
-            opts = req.get("opts"))
+        fut = self.push_request(req)
+        if fut is not None:
+            # persisted message, answer when it is on disk
+            await fut
         return {"answer": "ok"}
 
+    def push_request(self, req):
+        "Push message, return commit future of persisted message or None"
+
+        return self.hub.push_msg(self, name = req.get("name"), 
+            msg = req.get("msg"), opts = req.get("opts"))
+
+    def take_msg(self):
+        "Get next not expired message from queue"
+
+        if self.pulse is not None:
+            item, self.pulse = self.pulse, None
+            if not item.isexpired(self.hub.loop.time()):
+                return item
+        while self.replays:
+            item = self.replays[0].next()
+            if item is not None:
+                return item
+            self.replays.pop(0)
+        now = self.hub.loop.time()
+        while True:
+            item = self.q.pop()
+            if item is None:
+                return None
+            self.item_done(item)
+            if not item.isexpired(now):
+                return item
+            self.q.expired += 1
+            self.hub.removed_msg(self, "timeout", item.name, item.msg, 
+                item.opts)
+
+    def take_part(self, limit):
+        "Get up to limit messages from queue"
+
+        part = []
+        while self.has_msgs():
+            item = self.take_msg()
+            if item is None: break
+            part.append(item)
+            if len(part) >= limit: break
+        return part
+
     def check_msg_expiration(self):
         "Check if messages expired"
         
-        now = datetime.datetime.now()
-        # self.q: name, msg, opts, until
-        for x in self.q[:]:
-            if x[3] and x[3] <= now:
-                self.q.remove(x)
-                self.hub.removed_msg(self, "timeout", x[0], x[1], x[2])
+        for x in self.q.expire(self.hub.loop.time()):
+            self.item_done(x)
+            self.hub.removed_msg(self, "timeout", x.name, x.msg, x.opts)
 
 class AgentSystem(Agent):
     "System namespace agent"
 
     def __init__(self, hub):
-        super().__init__(hub = hub, name = "<system>")
-        self.logger = self.hub.logger
+        super().__init__(hub = hub, name = "<system>", logger = hub.logger)
         # subscribe to system/call
         subid = self.hub.subscribe(mask = re.compile("system/call"), 
             subscriber = self)
         self.subs.append(subid)
+        self.isrpc = True
 
     def getid(self):
         return "<system>"
@@ -326,43 +654,76 @@ class AgentSystem(Agent):
             await asyncio.sleep(5)
             self.hub.push_pulse()
 
+    async def stats_pulse(self):
+        "Periodic system/stats message"
+
+        while True:
+            await asyncio.sleep(self.hub.stats_interval)
+            self.hub.push_msg(None, "system/stats", 
+                await self.sysrpc_stats("stats", None, None))
+
     async def run(self):
         pulse = asyncio.Task(self.heartbeat())
+        stats = None
+        shard = self.hub.shard
+        if self.hub.stats_interval and (shard is None or shard.index == 0):
+            # stats of all shards are sent by shard 0
+            stats = asyncio.Task(self.stats_pulse())
         while self.isloop:
             self.q_s = self.hub.loop.create_future()
             await self.q_s
             self.q_s = None
         if pulse:
             pulse.cancel()
+        if stats:
+            stats.cancel()
+
+    def push_envelope(self, env, subid = None, until = None):
+        self.push_msg(env.name, env.msg, env.opts)
+
+    def push_pulse(self, env):
+        "System agent needs no pulses"
 
     def push_msg(self, name, msg = None, opts = None):
         "Push message to system agent"
 
         if name == "system/call":
             # system-based calls
-            msg = msg or {}
-            func = msg.get("fn")
-            args = msg.get("args")
-            reqid = msg.get("reqid")
-            sender = msg.get("from")
-            try:
-                if hasattr(self, "sysrpc_" + func):
-                    ret = await (getattr(self, "sysrpc_" + func)(func, 
-                        args, sender))
-                    ans = {"answer": "ok", "ret": ret}
-                else:
-                    ans = {"answer": "error", "msg": "No function %s" % \
-                        repr(func)}
-            except Exception as e:
-                traceback.print_exc()
-                ans = {"answer": "error", "msg": repr(e)}
-            if reqid is not None:
-                ans["reqid"] = reqid
-            self.hub.push_msg(self, sender + "/ret", ans)
+            asyncio.ensure_future(self.system_call(msg, opts))
             return
 
-        self.logger.debug(LogTypes.AGENT_MSG_LOST, name, str(msg), 
-            str(opts))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(LogTypes.AGENT_MSG_LOST, name, str(msg), 
+                str(opts))
+
+    async def system_call(self, msg, opts):
+        "Execute system call and send answer"
+
+        msg = msg or {}
+        opts = opts or {}
+        func = msg.get("fn")
+        args = msg.get("args")
+        reqid = opts.get("reqid", msg.get("reqid"))
+        sender = opts.get("from", msg.get("from"))
+        try:
+            if hasattr(self, "sysrpc_" + func):
+                ret = await (getattr(self, "sysrpc_" + func)(func, 
+                    args, sender))
+                ans = {"answer": "ok", "ret": ret}
+            else:
+                ans = {"answer": "error", "msg": "No function %s" % \
+                    repr(func)}
+        except Exception as e:
+            traceback.print_exc()
+            ans = {"answer": "error", "msg": repr(e)}
+        if reqid is not None:
+            ans["reqid"] = reqid
+        try:
+            self.hub.push_msg(self, sender + "/ret", ans,
+                {"reqid": reqid, "from": sender, "check": "call"})
+        except Exception:
+            # call timed out or caller gone, answer dropped by hub
+            pass
 
     async def sysrpc_exit_code(self, func, args, sender):
         "Set hub exit code"
@@ -370,56 +731,212 @@ class AgentSystem(Agent):
         self.hub.logger.debug(LogTypes.HUB_SET_EXIT_CODE, sender, repr(args))
         self.hub.exit_code = args
 
+    async def sysrpc_call_stats(self, func, args, sender):
+        "RPC call counters"
+
+        if self.hub.shard is not None:
+            return await self.hub.shard.total_call_stats()
+        return self.hub.call_stats()
+
+    async def sysrpc_stats(self, func, args, sender):
+        "Hub metrics"
+
+        if self.hub.shard is not None:
+            return await self.hub.shard.total_stats()
+        return self.hub.stats()
+
+async def recv_frame(agent):
+    "Read 4 byte length prefixed frame"
+
+    plen = await agent.recv(4)
+    if not plen:
+        return None
+    plen = struct.unpack("!I", plen)[0]
+    if plen & FRAME_COMPRESSED:
+        data = await agent.recv(plen & ~FRAME_COMPRESSED)
+        if agent.compressor is None:
+            raise Exception("Compressed frame without negotiation")
+        return agent.compressor[1](data)
+    return await agent.recv(plen)
+
+def send_frame(agent, data):
+    "Write 4 byte length prefixed frame, compress big ones"
+
+    if agent.compressor is not None and \
+            len(data) >= agent.compress_threshold:
+        cdata = agent.compressor[0](data)
+        if len(cdata) < len(data):
+            agent.send(struct.pack("!I", len(cdata) | FRAME_COMPRESSED) + 
+                cdata)
+            return
+    agent.send(struct.pack("!I", len(data)) + data)
+
+def encode_json(ans, agent = None):
+    "Format JSON answer, report encoding errors to agent"
+
+    try:
+        return encode_json_answer(ans, agent)
+    except (TypeError, ValueError) as e:
+        err = {"answer": "error", "msg": "Can't encode answer: %s" % e}
+        if "id" in ans:
+            err["id"] = ans["id"]
+        return json.dumps(err, ensure_ascii = False).encode("utf-8")
+
+def encode_json_answer(ans, agent):
+    "JSON of answer, messages which can't be encoded are reported lost"
+
+    spliced = {}
+    msgs = ans.get("msgs")
+    if msgs and isinstance(msgs[0], QueueItem):
+        # splice messages encoded once for all subscribers
+        parts = []
+        for item in msgs:
+            try:
+                parts.append(item.encode_json())
+            except (TypeError, ValueError):
+                if agent is not None:
+                    # report is encodable, message may be binary
+                    agent.hub.removed_msg(agent, "encode_error", item.name,
+                        repr(item.msg), item.opts)
+        spliced["msgs"] = b"[" + b", ".join(parts) + b"]"
+    answers = ans.get("answers")
+    if answers:
+        spliced["answers"] = b"[" + b", ".join([encode_json_answer(x, 
+            agent) for x in answers]) + b"]"
+    if not spliced:
+        return json.dumps(ans, ensure_ascii = False, 
+            default = plain_item).encode("utf-8")
+    head = {k: v for k, v in ans.items() if k not in spliced}
+    data = json.dumps(head, ensure_ascii = False, 
+        default = plain_item).encode("utf-8")[:-1]
+    for k, v in spliced.items():
+        if len(data) > 1:
+            data += b", "
+        data += b'"' + k.encode("ascii") + b'": ' + v
+    return data + b"}"
+
 class Proto4ByteJson():
     "4 byte + json protocol"
 
     async def recv_request(self):
         "Receive and parse JSON data from stream"
 
-        plen = await self.recv(4)
-        if not plen:
+        data = await recv_frame(self)
+        if data is None:
             return None
-
-        plen = struct.unpack("!I", plen)[0]
-        data = (await self.recv(plen)).decode("utf-8")
-        return json.loads(data)
+        return json.loads(data.decode("utf-8"))
 
     async def send_answer(self, ans):
         "Format JSON data and send to stream"
 
-        data = json.dumps(ans, ensure_ascii = False)
-        data = data.encode("utf-8")
-        self.send(struct.pack("!I", len(data)))
-        self.send(data)
+        send_frame(self, encode_json(ans, self))
         await self.flush()
 
 Agent.reg_protocol(b"4bj", Proto4ByteJson)
 
+# pickle protocol readable by all supported python versions
+PICKLE_PROTOCOL = 4
+
 class Proto4BytePickle():
     "4 byte + pickle protocol"
 
     async def recv_request(self):
         "Receive and parse pickle data from stream"
 
-        plen = await self.recv(4)
-        if not plen:
+        data = await recv_frame(self)
+        if data is None:
             return None
-
-        plen = struct.unpack("!I", plen)[0]
-        data = (await self.recv(plen)).decode("utf-8")
         return pickle.loads(data)
 
     async def send_answer(self, ans):
         "Format pickle data and send to stream"
 
-        data = pickle.dumps(ans)
-        data = data.encode("utf-8")
-        self.send(struct.pack("!I", len(data)))
-        self.send(data)
+        send_frame(self, pickle.dumps(plain_answer(ans), 
+            protocol = PICKLE_PROTOCOL))
         await self.flush()
 
 Agent.reg_protocol(b"4bp", Proto4BytePickle)
 
+def pack_header(count, fix, code16):
+    "MessagePack array (0x90, 0xdc) or map (0x80, 0xde) header"
+
+    if count < 16:
+        return bytes([fix | count])
+    if count < 0x10000:
+        return bytes([code16]) + struct.pack("!H", count)
+    return bytes([code16 + 1]) + struct.pack("!I", count)
+
+def pack_body(name, msg):
+    "MessagePack of name and msg, items of [name, msg, opts] array"
+
+    return msgpack.packb(name, use_bin_type = True) + \
+        msgpack.packb(msg, use_bin_type = True)
+
+def encode_msgpack(ans, agent = None):
+    "Format MessagePack answer, report encoding errors to agent"
+
+    try:
+        return encode_msgpack_answer(ans, agent)
+    except (TypeError, ValueError, OverflowError) as e:
+        err = {"answer": "error", "msg": "Can't encode answer: %s" % e}
+        if "id" in ans:
+            err["id"] = ans["id"]
+        return msgpack.packb(err, use_bin_type = True)
+
+def encode_msgpack_answer(ans, agent):
+    "MessagePack of answer, like encode_json_answer"
+
+    spliced = {}
+    msgs = ans.get("msgs")
+    if msgs and isinstance(msgs[0], QueueItem):
+        # splice messages encoded once for all subscribers
+        parts = []
+        for item in msgs:
+            try:
+                parts.append(b"\x93" + item.env.encoded(b"4bm", pack_body) +
+                    msgpack.packb(item.opts, use_bin_type = True))
+            except (TypeError, ValueError, OverflowError):
+                if agent is not None:
+                    agent.hub.removed_msg(agent, "encode_error", item.name,
+                        repr(item.msg), item.opts)
+        spliced["msgs"] = pack_header(len(parts), 0x90, 0xdc) + \
+            b"".join(parts)
+    answers = ans.get("answers")
+    if answers:
+        spliced["answers"] = pack_header(len(answers), 0x90, 0xdc) + \
+            b"".join([encode_msgpack_answer(x, agent) for x in answers])
+    if not spliced:
+        return msgpack.packb(ans, use_bin_type = True, default = plain_item)
+    data = pack_header(len(ans), 0x80, 0xde)
+    for k, v in ans.items():
+        data += msgpack.packb(k, use_bin_type = True)
+        if k in spliced:
+            data += spliced[k]
+        else:
+            data += msgpack.packb(v, use_bin_type = True, 
+                default = plain_item)
+    return data
+
+class Proto4ByteMsgPack():
+    "4 byte + MessagePack protocol, bytes are passed as is"
+
+    async def recv_request(self):
+        "Receive and parse MessagePack data from stream"
+
+        data = await recv_frame(self)
+        if data is None:
+            return None
+        return msgpack.unpackb(data, raw = False)
+
+    async def send_answer(self, ans):
+        "Format MessagePack data and send to stream"
+
+        send_frame(self, encode_msgpack(ans, self))
+        await self.flush()
+
+if msgpack is not None:
+    Agent.reg_protocol(b"4bm", Proto4ByteMsgPack)
+
 class ProtoJsonNL():
     "Json + newline protocol"
 
@@ -427,13 +944,14 @@ class ProtoJsonNL():
         "Receive and parse JSON data from stream"
 
         data = (await self.readline()).decode("utf-8")
+        if not data:
+            return None
         return json.loads(data)
 
     async def send_answer(self, ans):
         "Format JSON data and send to stream"
 
-        data = json.dumps(ans, ensure_ascii = False).replace("\n", " ")
-        data = data.encode("utf-8")
+        data = encode_json(ans, self).replace(b"\n", b" ")
         self.send(data + b"\n")
         await self.flush()
 
@@ -449,6 +967,9 @@ class AgentStdIO(Agent):
         self.aid = cfg.get("id", self.cfg.get("cmd", ""))
         self.ev_msg = {k: v for k, v in cfg.get("events", {}).items()}
         self.isrpc = bool(cfg.get("rpc"))
+        self.setup_queue(cfg.get("queue"))
+        # configured agent keeps its queue in durable log
+        self.store_key = cfg.get("name")
         self.proc = None
 
     async def prepare(self):
@@ -471,10 +992,18 @@ class AgentStdIO(Agent):
             hdlr = logging.StreamHandler(sys.stdout)
         if hdlr:
             hdlr.setFormatter(self.hub.log_formatter)
-            self.logger.addHandler(hdlr)
+            self.hub.add_log_handler(self.logger, hdlr)
         self.logger.debug(LogTypes.MARK)
         self.logger.debug(LogTypes.AGENT_PROC_CREATED)
 
+    async def collect_output(self):
+        "Process output is not protocol, copy it to hub output"
+
+        while True:
+            data = await self.readline()
+            if not data: break
+            sys.stdout.buffer.write(data)
+
     async def recv(self, blen):
         return await self.proc.stdout.readexactly(blen)
 
@@ -505,6 +1034,130 @@ class AgentStdIO(Agent):
             ans["cfg"] = self.cfg
         return ans
 
+class AgentSocket(Agent):
+    "Agent connected to hub via accepted socket"
+
+    def __init__(self, hub, listener, reader, writer, cid):
+        self.cfg = listener.cfg
+        self.listener = listener
+        self.cid = cid
+        # all connections share listener log
+        super().__init__(hub, "%s-%d" % (listener.name, cid), 
+            listener.logger)
+        self.aid = self.cfg.get("id", listener.name)
+        self.ev_msg = {k: v for k, v in self.cfg.get("events", {}).items()}
+        self.isrpc = bool(self.cfg.get("rpc"))
+        self.proto_labels = listener.proto_labels
+        self.setup_queue(self.cfg.get("queue"))
+        self.reader = reader
+        self.writer = writer
+
+    async def prepare(self):
+        await super().prepare()
+        self.hub.logger.debug(LogTypes.AGENT_CONNECTED, self.listener.name, 
+            str(self.writer.get_extra_info('peername')))
+
+    async def recv(self, blen):
+        return await self.reader.readexactly(blen)
+
+    async def readline(self):
+        return await self.reader.readline()
+
+    def send(self, data):
+        return self.writer.write(data)
+
+    async def flush(self):
+        return await self.writer.drain()
+
+    async def finish(self):
+        self.writer.close()
+
+    def getid(self):
+        return "%s-%d-%s" % (self.cfg.get("type"), self.cid, self.aid)
+
+class AgentListener(Agent):
+    "Accept agents on unix domain or TCP socket"
+
+    def __init__(self, hub, cfg):
+        self.cfg = cfg
+        self.name = cfg.get("name")
+        super().__init__(hub, self.name)
+        self.conn_cnt = 0
+        self.server = None
+        self.address = None
+        # pickle is not safe for foreign connections, so it is off
+        # by default
+        labels = cfg.get("protocols")
+        if labels is None:
+            labels = [x for x in Agent.protocols if x != b"4bp"]
+        self.proto_labels = [x.encode("utf-8") if isinstance(x, str) else x
+            for x in labels]
+        self.logger.setLevel(cfg.get("loglevel", "INFO"))
+        logfn = cfg.get("log")
+        if logfn:
+            hdlr = logging.FileHandler(logfn)
+        else:
+            hdlr = logging.StreamHandler(sys.stdout)
+        hdlr.setFormatter(self.hub.log_formatter)
+        self.hub.add_log_handler(self.logger, hdlr)
+
+    def getid(self):
+        return "%s-listen-%s" % (self.cfg.get("type"), self.name)
+
+    async def run(self):
+        "Accept connections until stopped"
+
+        try:
+            if self.cfg.get("type") == "unix":
+                path = self.cfg.get("path")
+                if os.path.exists(path) and \
+                        stat.S_ISSOCK(os.stat(path).st_mode):
+                    # stale socket
+                    os.unlink(path)
+                self.server = await asyncio.start_unix_server(self.accept,
+                    path = path)
+                self.address = path
+            else:
+                self.server = await asyncio.start_server(self.accept,
+                    host = self.cfg.get("host", "127.0.0.1"),
+                    port = self.cfg.get("port", 0),
+                    backlog = self.cfg.get("backlog", 100))
+                self.address = self.server.sockets[0].getsockname()[:2]
+        except Exception as e:
+            self.hub.logger.exception(LogTypes.AGENT_EXC_PREPARE)
+            self.isloop = False
+            self.send_agent_event("error")
+            return
+        self.hub.logger.info(LogTypes.AGENT_LISTEN, self.name, 
+            str(self.address))
+        self.send_agent_event("new")
+        while self.isloop:
+            await self.wait_signal()
+        self.server.close()
+        await self.server.wait_closed()
+        if self.cfg.get("type") == "unix":
+            os.unlink(self.address)
+        self.hub.logger.debug(LogTypes.AGENT_FINISH, self.name)
+        self.send_agent_event("exit")
+
+    def accept(self, reader, writer):
+        "New connection, start agent"
+
+        self.conn_cnt += 1
+        shard = self.hub.shard
+        if shard is not None and shard.handoff(self, writer, self.conn_cnt):
+            # served by other shard
+            return
+        a = AgentSocket(self.hub, self, reader, writer, self.conn_cnt)
+        self.hub.pending_agents.append(a)
+        self.hub.signal()
+
+    def stop(self):
+        "Stop accepting connections"
+
+        self.isloop = False
+        self.signal()
+
 def agent_factory(hub, cfg):
     if not isinstance(cfg, dict):
         with open(cfg, "r") as f:
@@ -512,6 +1165,8 @@ def agent_factory(hub, cfg):
     atype = cfg.get("type")
     if atype == "stdio":
         return AgentStdIO(hub, cfg)
+    elif atype in ("unix", "tcp"):
+        return AgentListener(hub, cfg)
     else:
         raise Exception("Unknown agent type '%s'" % (atype))
 
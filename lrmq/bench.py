@@ -0,0 +1,425 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Load generator benchmark
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Hub runs in bench process, agents are separate processes connected
+# to unix socket listener. Agent reports JSON line to stdout:
+#   "ready" - connected and subscribed
+#   {...} - result after work is done
+# Publishers and RPC clients start on "go" line in stdin, RPC servers
+# exit on "stop" line.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import lrmq
+from .hub import Hub
+from .shard import ShardNode, start_workers, stop_workers
+from .agent import Agent
+from .metrics import Histogram, exp_bounds
+from .client.aio import AsyncAgentIO
+from .client.sync import codecs
+
+SCENARIOS = ("fanout", "pubsub", "rpc", "large")
+
+# 10% wide latency buckets, 1us .. ~90s
+LATENCY_BOUNDS = exp_bounds(1e-6, 1.1, 193)
+
+def bench_protocols():
+    "Hub protocols supported by bench agents"
+
+    return [x.decode("ascii") for x in Agent.protocols if x in codecs]
+
+def make_payload(size):
+    "Hex text, compressible about twice like typical data"
+
+    return os.urandom((size + 1) // 2).hex()[:size]
+
+def hist_state(hist):
+    return {"counts": hist.counts, "count": hist.count, "sum": hist.total,
+        "max": hist.max}
+
+def hist_merge(hist, state):
+    "Add histogram state reported by agent"
+
+    for idx, cnt in enumerate(state["counts"]):
+        hist.counts[idx] += cnt
+    hist.count += state["count"]
+    hist.total += state["sum"]
+    hist.max = max(hist.max, state["max"])
+
+async def agent_main(params):
+    "Bench agent process"
+
+    loop = asyncio.get_event_loop()
+    def ready():
+        sys.stdout.write("ready\n")
+        sys.stdout.flush()
+    async def wait_line():
+        return await loop.run_in_executor(None, sys.stdin.readline)
+
+    client = AsyncAgentIO(protocols = [params["protocol"].encode("ascii")],
+        compress_threshold = params["compress_threshold"])
+    await client.connect_unix(params["path"])
+    await client.start()
+    role = params["role"]
+    hist = Histogram(LATENCY_BOUNDS)
+    count = params.get("count", 0)
+    window = params.get("window", 100)
+    payload = make_payload(params.get("size", 0))
+    report = {"role": role}
+    if role == "sub":
+        await client.subscribe(params["mask"])
+        ready()
+        received = 0
+        async for name, msg, opts in client:
+            if not name.startswith("bench/"):
+                # hub pulses
+                continue
+            hist.record(time.monotonic() - msg["t"])
+            received += 1
+            if received == count:
+                break
+        report.update({"received": received, "last": time.monotonic()})
+    elif role == "server":
+        client.reg_rpc("ping", lambda fn, args, reqid, sender: args)
+        await client.subscribe(params["rpc"] + "/call")
+        ready()
+        await wait_line()
+    elif role == "pub":
+        ready()
+        await wait_line()
+        for start in range(0, count, window):
+            await asyncio.gather(*[client.push(params["topic"],
+                {"t": time.monotonic(), "p": payload})
+                for i in range(min(window, count - start))])
+        report["sent"] = count
+    elif role == "client":
+        ready()
+        await wait_line()
+        async def ping():
+            started = time.monotonic()
+            await client.call_check(params["rpc"], "ping", payload)
+            hist.record(time.monotonic() - started)
+        for start in range(0, count, window):
+            await asyncio.gather(*[ping() 
+                for i in range(min(window, count - start))])
+        report.update({"received": count, "last": time.monotonic()})
+    await client.exit()
+    report["latency"] = hist_state(hist)
+    report["bytes"] = client.sent_bytes + client.recv_bytes
+    sys.stdout.write(json.dumps(report) + "\n")
+    sys.stdout.flush()
+
+class Bench:
+    "Run scenarios against in-process hub"
+
+    def __init__(self, args):
+        self.args = args
+        self.path = None
+        self.hub = None
+        self.env = dict(os.environ)
+        # agents import this package
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.env["PYTHONPATH"] = os.pathsep.join([root] + 
+            [x for x in [os.environ.get("PYTHONPATH")] if x])
+
+    async def spawn(self, params):
+        "Start agent process, wait until it is ready"
+
+        params = dict(params, path = self.path)
+        proc = await asyncio.create_subprocess_exec(sys.executable, "-m",
+            "lrmq.bench", "agent", json.dumps(params), env = self.env,
+            stdin = asyncio.subprocess.PIPE, stdout = asyncio.subprocess.PIPE)
+        line = await proc.stdout.readline()
+        if line.strip() != b"ready":
+            proc.kill()
+            await proc.wait()
+            raise Exception("Bench agent %s failed to start" % params["role"])
+        return proc
+
+    async def finish(self, proc):
+        "Wait for agent report"
+
+        line = await proc.stdout.readline()
+        await proc.wait()
+        if proc.returncode != 0 or not line:
+            raise Exception("Bench agent failed, code %s" % proc.returncode)
+        return json.loads(line.decode("utf-8"))
+
+    def plan(self, scenario, protocol, threshold):
+        "Return (passive, active) agent parameters of scenario"
+
+        args = self.args
+        base = {"protocol": protocol, "window": args.window,
+            "size": args.size, "compress_threshold": threshold}
+        passive = []
+        active = []
+        if scenario == "fanout":
+            for i in range(args.subscribers):
+                passive.append(dict(base, role = "sub", mask = "bench/fanout",
+                    count = args.count))
+            active.append(dict(base, role = "pub", topic = "bench/fanout",
+                count = args.count))
+        elif scenario in ("pubsub", "large"):
+            count = args.count
+            if scenario == "large":
+                base.update(size = args.large_size, window = 1)
+                count = args.large_count
+            for i in range(args.publishers):
+                topic = "bench/%s/%d" % (scenario, i)
+                passive.append(dict(base, role = "sub", mask = topic,
+                    count = count))
+                active.append(dict(base, role = "pub", topic = topic,
+                    count = count))
+        elif scenario == "rpc":
+            for i in range(args.servers):
+                passive.append(dict(base, role = "server", rpc = "bench"))
+            for i in range(args.clients):
+                active.append(dict(base, role = "client", rpc = "bench",
+                    count = args.count))
+        else:
+            raise Exception("Unknown scenario '%s'" % scenario)
+        return passive, active
+
+    async def run_scenario(self, scenario, protocol, threshold):
+        passive, active = self.plan(scenario, protocol, threshold)
+        # frames to agents negotiated after this are compressed by hub
+        self.hub.compress_threshold = threshold
+        procs = []
+        try:
+            passive = [await self.spawn(x) for x in passive]
+            procs += passive
+            active = [await self.spawn(x) for x in active]
+            procs += active
+            usage = rusage()
+            started = time.monotonic()
+            for proc in active:
+                proc.stdin.write(b"go\n")
+            if scenario == "rpc":
+                # clients measure round trip
+                reports = await asyncio.gather(*[self.finish(x) 
+                    for x in active])
+                usage = rusage(usage)
+                for proc in passive:
+                    proc.stdin.write(b"stop\n")
+                served = await asyncio.gather(*[self.finish(x) 
+                    for x in passive])
+                wire = sum(x["bytes"] for x in reports + served)
+            else:
+                reports = await asyncio.gather(*[self.finish(x) 
+                    for x in passive + active])
+                usage = rusage(usage)
+                wire = sum(x["bytes"] for x in reports)
+                reports = [x for x in reports if x["role"] == "sub"]
+        finally:
+            for proc in procs:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+        hist = Histogram(LATENCY_BOUNDS)
+        for report in reports:
+            hist_merge(hist, report["latency"])
+        seconds = max(x["last"] for x in reports) - started
+        messages = sum(x["received"] for x in reports)
+        return {"scenario": scenario, "protocol": protocol,
+            "compress_threshold": threshold,
+            "messages": messages, "seconds": round(seconds, 6),
+            "msgs_per_sec": round(messages / seconds, 1) if seconds else None,
+            "latency": {"p50": round(hist.percentile(0.5), 6), 
+                "p99": round(hist.percentile(0.99), 6), 
+                "p999": round(hist.percentile(0.999), 6), 
+                "max": round(hist.max, 6)},
+            "hub_cpu_sec": usage[0], 
+            "bytes_per_msg": round(wire / messages, 1) if messages else None,
+            "hub_peak_rss_kb": usage[1]}
+
+    async def run(self):
+        "Run all scenarios, return results"
+
+        args = self.args
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.path = os.path.join(tmpdir, "bench.sock")
+            cfg = {"loglevel": "WARNING", "log": os.devnull,
+                "debuglogger": None, 
+                "compress_threshold": args.compress_threshold[0],
+                "agents": [{"type": "unix", "name": "bench", 
+                "path": self.path, "rpc": True, "log": os.devnull,
+                "protocols": args.protocol}]}
+            hub = self.hub = Hub()
+            node = None
+            workers = []
+            if args.shards > 1:
+                # shard 0 is here, agents are spread over all shards
+                node = ShardNode(hub, 0, args.shards, tmpdir)
+                workers = start_workers(cfg, args.shards, tmpdir)
+            hub.load_config(cfg)
+            listener = hub.pending_agents[-1]
+            if node is not None:
+                await node.start()
+                while len(node.peers) < args.shards - 1:
+                    await asyncio.sleep(0.01)
+            task = asyncio.ensure_future(hub.main_loop())
+            try:
+                while listener.address is None:
+                    if task.done():
+                        task.result()
+                    await asyncio.sleep(0.01)
+                results = []
+                for scenario in args.scenario:
+                    for protocol in args.protocol:
+                        for threshold in args.compress_threshold:
+                            results.append(await asyncio.wait_for(
+                                self.run_scenario(scenario, protocol, 
+                                threshold), args.timeout))
+            finally:
+                listener.stop()
+                await task
+                if node is not None:
+                    await node.close()
+                    stop_workers(workers)
+                hub.cleanup()
+        return results
+
+def rusage(start = None):
+    """Process (cpu seconds, max rss KiB), cpu is delta from start
+
+    Max rss is peak of whole process lifetime, not of scenario.
+    """
+
+    if resource is None:
+        return (None, None)
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = ru.ru_utime + ru.ru_stime
+    rss = ru.ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on macOS
+        rss //= 1024
+    if start is not None:
+        cpu = round(cpu - start[0], 6)
+    return (cpu, rss)
+
+def compare(results, baseline):
+    "Add msgs/s change relative to baseline results"
+
+    def key(res):
+        return (res["scenario"], res["protocol"], 
+            res.get("compress_threshold"))
+    base = {key(x): x for x in baseline["results"]}
+    for res in results:
+        old = base.get(key(res))
+        if old and old.get("msgs_per_sec") and res["msgs_per_sec"]:
+            res["baseline_msgs_per_sec"] = old["msgs_per_sec"]
+            res["change"] = round(res["msgs_per_sec"] / 
+                old["msgs_per_sec"] - 1, 4)
+
+def parse_args(argv):
+    "Bench options"
+
+    protocols = bench_protocols()
+    parser = argparse.ArgumentParser(prog = "python -m lrmq bench",
+        description = "Measure hub throughput and latency")
+    parser.add_argument("-s", "--scenario", action = "append", 
+        choices = SCENARIOS, help = "Scenario to run (default all)")
+    parser.add_argument("-p", "--protocol", action = "append",
+        choices = protocols, help = "Protocol to use (default all)")
+    parser.add_argument("-n", "--count", type = int, default = 10000,
+        help = "Messages per publisher or calls per client")
+    parser.add_argument("--subscribers", type = int, default = 4,
+        help = "Subscribers in fanout scenario")
+    parser.add_argument("--publishers", type = int, default = 2,
+        help = "Publisher/subscriber pairs in pubsub scenario")
+    parser.add_argument("--servers", type = int, default = 2,
+        help = "RPC servers")
+    parser.add_argument("--clients", type = int, default = 2,
+        help = "RPC clients")
+    parser.add_argument("--size", type = int, default = 100,
+        help = "Payload size")
+    parser.add_argument("--large-size", type = int, default = 256 * 1024,
+        help = "Payload size in large scenario")
+    parser.add_argument("--large-count", type = int, default = 200,
+        help = "Messages per publisher in large scenario")
+    parser.add_argument("--window", type = int, default = 100,
+        help = "Requests in flight per agent")
+    parser.add_argument("--compress-threshold", type = int, 
+        action = "append", 
+        help = "Frame compression threshold, 0 - off (default 65536)")
+    parser.add_argument("--shards", type = int, default = 1,
+        help = "Hub processes, hub cpu is measured for first one")
+    parser.add_argument("--timeout", type = float, default = 300,
+        help = "Scenario timeout, seconds")
+    parser.add_argument("-o", "--output", help = "Write JSON to file")
+    parser.add_argument("-b", "--baseline", 
+        help = "Compare with JSON of previous run")
+    args = parser.parse_args(argv)
+    args.scenario = args.scenario or list(SCENARIOS)
+    args.protocol = args.protocol or protocols
+    args.compress_threshold = args.compress_threshold or [65536]
+    if args.shards > 1 and len(args.compress_threshold) > 1:
+        # worker shards keep threshold of their config
+        parser.error("several compression thresholds need --shards 1")
+    return args
+
+def main(argv = None):
+    "Command-line entry: python -m lrmq bench"
+
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["agent"]:
+        asyncio.get_event_loop().run_until_complete(
+            agent_main(json.loads(argv[1])))
+        return 0
+
+    args = parse_args(argv)
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(Bench(args).run())
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
+    # parameters are kept to compare runs
+    params = {k: v for k, v in vars(args).items() 
+        if k not in ("output", "baseline", "timeout")}
+    out = {"version": lrmq.__version__, 
+        "python": platform.python_version(),
+        "platform": platform.platform(), "params": params, 
+        "results": results}
+    data = json.dumps(out, indent = 2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,418 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Asynchronous message client
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sys
+import struct
+import asyncio
+import traceback
+from asyncio.streams import StreamWriter, FlowControlMixin
+
+from .sync import (codecs, compressors, default_protocols,
+    FRAME_COMPRESSED)
+
+class AsyncAgentIO:
+    """Asyncio agent client
+
+    One reader task dispatches answers to request futures by "id" and
+    RPC returns to call futures by "reqid", so many requests and calls
+    may be in flight at once.
+    """
+
+    def __init__(self, protocols = None, compress_threshold = 65536,
+            pipeline = 256, stream = 100):
+        self.protocols = protocols or default_protocols
+        self.protocol = None
+        self.dumps, self.loads = codecs[b"4bj"]
+        self.compress_threshold = compress_threshold # 0 - disabled
+        self.compressor = None
+        # frame bytes with length headers
+        self.sent_bytes = 0
+        self.recv_bytes = 0
+        self.pipeline = pipeline # in-flight requests, 0 - sequential
+        self.stream_window = stream # stream credit, 0 - use wait_msg
+        self.stream_used = 0
+        self.streaming = False
+        self.reader = None
+        self.writer = None
+        self.cmdid = 0
+        self.waiters = {} # id -> future
+        self.reqid = 0
+        self.calls = {} # reqid -> future
+        self.rpc_listeners = {} # function listeners
+        self.rpc_def_listener = None
+        self.ret_sub = None # future of subscription to own answers
+        self.msgs = asyncio.Queue()
+        self.myid = None
+        self.cfg = None
+        self.read_task = None
+        self.pump_task = None
+        self.isloop = False
+
+    async def connect_stdio(self):
+        "Use stdin and stdout, agent started by hub"
+
+        loop = asyncio.get_event_loop()
+        # NOTE: os.fdopen(0, "wb") will not works in pipe
+        writer_transport, writer_protocol = await loop.connect_write_pipe(
+            FlowControlMixin, os.fdopen(sys.stdout.fileno(), "wb"))
+        self.writer = StreamWriter(writer_transport, writer_protocol,
+            None, loop)
+        self.reader = asyncio.StreamReader()
+        reader_protocol = asyncio.StreamReaderProtocol(self.reader)
+        await loop.connect_read_pipe(lambda: reader_protocol,
+            sys.stdin.buffer)
+
+    async def connect_unix(self, path):
+        "Connect to hub unix socket listener"
+
+        self.reader, self.writer = await asyncio.open_unix_connection(path)
+
+    async def connect_tcp(self, host, port):
+        "Connect to hub TCP listener"
+
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+    async def start(self, cfg = False):
+        "Negotiate protocol and get agent ID"
+
+        # "proto1|proto2 compressor1,compressor2"
+        offer = (await self.reader.readline()).strip().split(b" ")
+        protocols = offer[0].split(b"|")
+        offered_comp = offer[1].split(b",") if len(offer) > 1 else []
+        for proto in self.protocols:
+            if proto in protocols:
+                break
+        else:
+            raise Exception("No acceptable protocol (%s)" % \
+                ", ".join([x.decode("utf-8") for x in protocols]))
+        self.protocol = proto
+        self.dumps, self.loads = codecs[proto]
+        reply = proto
+        if self.compress_threshold:
+            for comp in compressors:
+                if comp in offered_comp:
+                    self.compressor = compressors[comp]
+                    reply += b" " + comp
+                    break
+        self.writer.write(reply + b"\n")
+        self.isloop = True
+        self.read_task = asyncio.ensure_future(self.read_loop())
+        if self.pipeline:
+            await self.request_check({"cmd": "pipeline",
+                "limit": self.pipeline})
+        ans = await self.request_check({"cmd": "getid", "cfg": cfg})
+        self.myid = ans.get("agentid")
+        self.cfg = ans.get("cfg")
+        return ans
+
+    def send_frame(self, req):
+        "Write one frame"
+
+        data = self.dumps(req)
+        plen = len(data)
+        if self.compressor and plen >= self.compress_threshold:
+            cdata = self.compressor[0](data)
+            if len(cdata) < plen:
+                data = cdata
+                plen = len(data) | FRAME_COMPRESSED
+        self.sent_bytes += len(data) + 4
+        self.writer.write(struct.pack("!I", plen) + data)
+
+    async def recv_frame(self):
+        "Read one frame"
+
+        plen = struct.unpack("!I", await self.reader.readexactly(4))[0]
+        if plen & FRAME_COMPRESSED:
+            data = await self.reader.readexactly(plen & ~FRAME_COMPRESSED)
+            self.recv_bytes += len(data) + 4
+            return self.loads(self.compressor[1](data))
+        data = await self.reader.readexactly(plen)
+        self.recv_bytes += plen + 4
+        return self.loads(data)
+
+    async def read_loop(self):
+        "Dispatch incoming frames"
+
+        try:
+            while self.isloop:
+                ans = await self.recv_frame()
+                if ans.get("answer") == "stream":
+                    for m in ans.get("msgs", []):
+                        self.dispatch_msg(*m)
+                    continue
+                fut = self.waiters.pop(ans.get("id"), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(ans)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            err = e
+        except asyncio.CancelledError:
+            err = Exception("Client closed")
+        except Exception as e:
+            traceback.print_exc(file = sys.stderr)
+            err = e
+        self.isloop = False
+        # channel lost, fail everyone
+        for fut in list(self.waiters.values()) + list(self.calls.values()):
+            if not fut.done():
+                fut.set_exception(Exception("Connection lost: %r" % err))
+        self.waiters.clear()
+        self.calls.clear()
+        self.msgs.put_nowait(None)
+
+    def dispatch_msg(self, name, msg, opts):
+        "Route RPC answers and calls, queue other messages"
+
+        if self.myid and name == self.myid + "/ret" and \
+                isinstance(msg, dict):
+            reqid = (opts or {}).get("reqid", msg.get("reqid"))
+            fut = self.calls.pop(reqid, None)
+            if fut is not None:
+                if not fut.done():
+                    fut.set_result(msg)
+                self.use_credit()
+                return
+        # own address or shared address of server replicas
+        if name.endswith("/call") and \
+                (self.rpc_listeners or self.rpc_def_listener):
+            asyncio.ensure_future(self.serve_rpc(msg, opts))
+            self.use_credit()
+            return
+        self.msgs.put_nowait((name, msg, opts))
+
+    def use_credit(self):
+        "Message consumed, return credit to hub"
+
+        if self.stream_window and self.pump_task is None:
+            self.stream_used += 1
+            if self.stream_used * 2 >= self.stream_window:
+                self.send_frame({"cmd": "credit", "credit": self.stream_used})
+                self.stream_used = 0
+
+    async def request(self, req):
+        "Send request and wait for answer"
+
+        if not self.isloop:
+            raise Exception("Not connected")
+        cid = self.cmdid
+        self.cmdid += 1
+        req["id"] = cid
+        fut = asyncio.get_event_loop().create_future()
+        self.waiters[cid] = fut
+        self.send_frame(req)
+        await self.writer.drain()
+        return await fut
+
+    async def request_check(self, req):
+        "Send request, raise exception on error answer"
+
+        ans = await self.request(req)
+        if ans.get("answer") != "ok":
+            raise Exception("Error during %s: %s" % (req.get("cmd"),
+                ans.get("msg", "")))
+        return ans
+
+    async def push(self, name, msg = None, opts = None):
+        "Push message to hub"
+
+        return await self.request_check({"cmd": "push", "name": name,
+            "msg": msg, "opts": opts})
+
+    async def push_many(self, msgs):
+        "Push list of (name, msg, opts) with one request"
+
+        ans = await self.batch([{"cmd": "push", "name": name, "msg": msg,
+            "opts": opts} for name, msg, opts in msgs])
+        for sans in ans.get("answers", []):
+            if sans.get("answer") != "ok":
+                raise Exception("Error during push: %s" %
+                    sans.get("msg", ""))
+        return ans
+
+    async def batch(self, reqs):
+        "Send several requests in one frame"
+
+        return await self.request_check({"cmd": "batch", "reqs": reqs})
+
+    async def subscribe(self, mask, syntax = None, group = None, 
+            from_offset = None, from_time = None, latest = False):
+        "Subscribe to message(s), start receiving messages"
+
+        req = {"cmd": "sub", "mask": mask}
+        if syntax:
+            req["syntax"] = syntax
+        if group:
+            # one member of group gets message
+            req["group"] = group
+        # replay retained history first
+        if from_offset is not None:
+            req["from_offset"] = from_offset
+        if from_time is not None:
+            req["from_time"] = from_time
+        if latest:
+            req["latest"] = True
+        ans = await self.request_check(req)
+        self.start_receiving()
+        return ans
+
+    def start_receiving(self):
+        "Start message delivery: stream or wait_msg pump"
+
+        if self.stream_window:
+            if not self.streaming:
+                self.streaming = True
+                self.send_frame({"cmd": "stream",
+                    "credit": self.stream_window})
+        elif self.pump_task is None:
+            self.pump_task = asyncio.ensure_future(self.pump())
+
+    async def pump(self):
+        "Receive messages with blocking wait_msg"
+
+        try:
+            while self.isloop:
+                ans = await self.request_check({"cmd": "wait_msg",
+                    "block": True})
+                for m in ans.get("msgs", []):
+                    self.dispatch_msg(*m)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if self.isloop:
+                traceback.print_exc(file = sys.stderr)
+
+    async def call(self, rpc, fn, args = None, timeout = None, opts = None):
+        "Remote procedure call, many calls may be in flight"
+
+        assert rpc, "RPC address can't be empty"
+        if self.ret_sub is None:
+            self.ret_sub = asyncio.ensure_future(
+                self.subscribe(self.myid + "/ret"))
+        sub = self.ret_sub
+        try:
+            # concurrent first calls wait for the same subscription
+            await asyncio.shield(sub)
+        except Exception:
+            if self.ret_sub is sub and sub.done():
+                # next call tries again
+                self.ret_sub = None
+            raise
+        reqid = self.reqid
+        self.reqid += 1
+        fut = asyncio.get_event_loop().create_future()
+        self.calls[reqid] = fut
+        # extra options like balancing "key"
+        opts = dict(opts) if opts else {}
+        opts.update({"reqid": reqid, "from": self.myid, "check": "call"})
+        if timeout is not None:
+            opts["timeout"] = timeout
+        try:
+            await self.push(rpc + "/call", {"fn": fn, "args": args}, opts)
+        except Exception:
+            self.calls.pop(reqid, None)
+            raise
+        return await fut
+
+    async def call_check(self, rpc, fn, args = None, timeout = None,
+            opts = None):
+        "Remote procedure call, raise exception on error"
+
+        ans = await self.call(rpc, fn, args, timeout, opts)
+        if ans.get("answer") != "ok":
+            raise Exception("Error during call rpc: %s" % ans.get("msg", ""))
+        return ans.get("ret")
+
+    def reg_rpc(self, fn, cb):
+        "Register RPC callback, cb may be coroutine function"
+
+        if fn:
+            self.rpc_listeners[fn] = cb
+        else:
+            self.rpc_def_listener = cb
+
+    async def serve_rpc(self, msg, opts):
+        "Execute RPC and send answer"
+
+        msg = msg or {}
+        opts = opts or {}
+        fn = msg.get("fn")
+        reqid = opts.get("reqid")
+        sender = opts.get("from")
+        cb = self.rpc_listeners.get(fn, self.rpc_def_listener)
+        try:
+            if cb is None:
+                ans = {"answer": "error", "msg": "No function \"%s\"" % fn}
+            else:
+                ret = cb(fn, msg.get("args"), reqid, sender)
+                if asyncio.iscoroutine(ret):
+                    ret = await ret
+                ans = {"answer": "ok", "ret": ret}
+        except Exception as e:
+            traceback.print_exc(file = sys.stderr)
+            ans = {"answer": "error", "msg": repr(e)}
+        ans["reqid"] = reqid
+        # answer after call deadline is dropped by hub with error
+        try:
+            await self.request({"cmd": "push", "name": sender + "/ret",
+                "msg": ans, "opts": {"reqid": reqid, "from": sender,
+                "check": "call"}})
+        except Exception as e:
+            traceback.print_exc(file = sys.stderr)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        "Next (name, msg, opts) message"
+
+        item = await self.msgs.get()
+        if item is None:
+            # connection lost, wake other consumers too
+            self.msgs.put_nowait(None)
+            raise StopAsyncIteration
+        self.use_credit()
+        return item
+
+    async def exit(self):
+        "Send normal exit message and close connection"
+
+        try:
+            ans = await self.request({"cmd": "exit"})
+        finally:
+            await self.close()
+        return ans
+
+    async def close(self):
+        "Stop tasks and close connection"
+
+        self.isloop = False
+        for task in (self.pump_task, self.read_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.pump_task = None
+        self.writer.close()
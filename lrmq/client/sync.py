@@ -24,7 +24,51 @@
 
 import sys
 import json
+import pickle
+import zlib
 import struct
+import queue
+import threading
+import traceback
+import collections
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def json_dumps(obj):
+    return json.dumps(obj, ensure_ascii = False).encode("utf-8")
+
+def json_loads(data):
+    return json.loads(data.decode("utf-8"))
+
+# protocol label: (dumps, loads)
+codecs = {
+    b"4bj": (json_dumps, json_loads),
+    b"4bp": (lambda obj: pickle.dumps(obj, protocol = 4), pickle.loads),
+}
+if msgpack is not None:
+    codecs[b"4bm"] = (lambda obj: msgpack.packb(obj, use_bin_type = True),
+        lambda data: msgpack.unpackb(data, raw = False))
+
+# preferred protocols, best first, pickle is used only if requested
+default_protocols = [x for x in (b"4bm", b"4bj") if x in codecs]
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# frame compressors: name -> (compress, decompress), preferred first
+compressors = {}
+if lz4 is not None:
+    compressors[b"lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+compressors[b"zlib"] = (lambda data: zlib.compress(data, 1), 
+    zlib.decompress)
+
+# length header flag: frame is compressed
+FRAME_COMPRESSED = 0x80000000
 
 def check_answer(fn, name = None):
     def wrapped(*args, **kwargs):
@@ -35,14 +79,29 @@ def check_answer(fn, name = None):
         return ans
     return wrapped
 
+def check_batch(fn, name = None):
+    def wrapped(*args, **kwargs):
+        ans = check_answer(fn, name)(*args, **kwargs)
+        for sans in ans.get("answers", []):
+            assert sans.get("answer") == "ok", \
+                "Error during " + (name if name else fn.__name__) + \
+                " " + sans.get("msg", "")
+        return ans
+    return wrapped
+
 class AgentIO:
 
-    def __init__(self):
+    def __init__(self, protocols = None, compress_threshold = 65536):
+        self.protocols = protocols or default_protocols
+        self.protocol = None
+        self.dumps, self.loads = codecs[b"4bj"]
+        self.compress_threshold = compress_threshold # 0 - disabled
+        self.compressor = None # (compress, decompress)
         self.cmdid = 0
         self.waitid = None
         self.myid = None
         self.isloop = False
-        self.msgs = [] # all received messages
+        self.msgs = collections.deque() # all received messages
         self.msg_listeners = {} # named listeners
         self.msg_def_listener = None # default listener
         self.reqid = 0
@@ -50,6 +109,11 @@ class AgentIO:
         self.wait_ans = {} # awaited answers
         self.rpc_listeners = {} # function listeners
         self.rpc_def_listener = None # default function listeners
+        self.streaming = False # messages are pushed by hub
+        self.stream_window = 0 # credit given to hub
+        self.stream_used = 0 # messages processed since last credit
+        self.rfile = sys.stdin.buffer
+        self.wfile = sys.stdout.buffer
     
     def send_req(self, req):
         "Send request"
@@ -57,19 +121,53 @@ class AgentIO:
         self.waitid = self.cmdid
         self.cmdid += 1
         req["id"] = self.waitid
-        data = json.dumps(req, ensure_ascii = False)
-        data = data.encode("utf-8")
-        sys.stdout.buffer.write(struct.pack("!I", len(data)))
-        sys.stdout.buffer.write(data)
-        sys.stdout.buffer.flush()
+        self.send_frame(req)
+
+    def send_frame(self, req):
+        "Write one frame"
+
+        data = self.dumps(req)
+        plen = len(data)
+        if self.compressor and plen >= self.compress_threshold:
+            cdata = self.compressor[0](data)
+            if len(cdata) < plen:
+                data = cdata
+                plen = len(data) | FRAME_COMPRESSED
+        self.write_frame(struct.pack("!I", plen) + data)
+
+    def write_frame(self, frame):
+        "Write encoded frame with header"
+
+        self.wfile.write(frame)
+        self.wfile.flush()
+
+    def read_frame(self):
+        "Read and decode one frame"
+
+        plen = self.rfile.read(4)
+        if len(plen) < 4:
+            raise EOFError("Connection closed")
+        plen = struct.unpack("!I", plen)[0]
+        if plen & FRAME_COMPRESSED:
+            data = self.rfile.read(plen & ~FRAME_COMPRESSED)
+            return self.loads(self.compressor[1](data))
+        return self.loads(self.rfile.read(plen))
+
+    def recv_frame(self):
+        "Read one frame, stream messages are queued"
+
+        ans = self.read_frame()
+        if ans.get("answer") == "stream":
+            self.msgs += ans.get("msgs", [])
+            return None
+        return ans
     
     def recv_ans(self):
         "Receive answer"
     
-        plen = sys.stdin.buffer.read(4)
-        plen = struct.unpack("!I", plen)[0]
-        data = sys.stdin.buffer.read(plen).decode("utf-8")
-        ans =  json.loads(data)
+        ans = self.recv_frame()
+        while ans is None:
+            ans = self.recv_frame()
         #print("ANS", ans, file = sys.stderr)
         cid = ans.get("id")
         if cid is None:
@@ -80,6 +178,14 @@ class AgentIO:
                 (self.waitid, cid))
         return ans
 
+    def pipeline(self, limit = None):
+        "Allow hub to process requests with id concurrently"
+
+        self.send_req({"cmd": "pipeline", "limit": limit})
+        return self.recv_ans()
+
+    pipeline_check = check_answer(pipeline, "switch to pipeline")
+
     def getid(self, cfg = False):
         "Get agent ID and configuration"
     
@@ -96,10 +202,42 @@ class AgentIO:
 
     push_msg_check = check_answer(push_msg, "push message")
 
-    def subscribe(self, mask):
-        "Subscribe to message(s)"
+    def batch(self, reqs):
+        "Send several requests in one frame, answers are in 'answers'"
+
+        self.send_req({"cmd": "batch", "reqs": reqs})
+        return self.recv_ans()
+
+    batch_check = check_batch(batch, "batch")
+
+    def push_many(self, msgs):
+        "Push list of (name, msg, opts) with one request"
+
+        return self.batch([{"cmd": "push", "name": name, "msg": msg, 
+            "opts": opts} for name, msg, opts in msgs])
+
+    push_many_check = check_batch(push_many, "push messages")
+
+    def subscribe(self, mask, syntax = None, group = None, 
+            from_offset = None, from_time = None, latest = False):
+        """Subscribe to message(s), syntax is 're' (default) or 'glob'
+
+        Each message is delivered to only one member of group.
+        Retained namespace history is replayed from offset or time.
+        """
     
-        self.send_req({"cmd": "sub", "mask": mask})
+        req = {"cmd": "sub", "mask": mask}
+        if syntax:
+            req["syntax"] = syntax
+        if group:
+            req["group"] = group
+        if from_offset is not None:
+            req["from_offset"] = from_offset
+        if from_time is not None:
+            req["from_time"] = from_time
+        if latest:
+            req["latest"] = True
+        self.send_req(req)
         return self.recv_ans()
 
     subscribe_check = check_answer(subscribe, "subscribe to messages")
@@ -112,6 +250,24 @@ class AgentIO:
 
     wait_msg_check = check_answer(wait_msg, "getting/waiting messages")
 
+    def stream(self, credit = 100):
+        "Switch to stream mode, hub pushes up to credit messages"
+
+        self.send_req({"cmd": "stream", "credit": credit})
+        ans = self.recv_ans()
+        if ans.get("answer") == "ok":
+            self.streaming = True
+            self.stream_window = credit
+            self.stream_used = 0
+        return ans
+
+    stream_check = check_answer(stream, "start streaming")
+
+    def add_credit(self, credit):
+        "Allow hub to push more messages, no answer expected"
+
+        self.send_frame({"cmd": "credit", "credit": credit})
+
     def start_agent(self, cfg):
         "Start remote agent"
     
@@ -147,28 +303,57 @@ class AgentIO:
     def init_loop(self, cfg = False):
         "Loop initialization"
     
-        # negotiate protocol
-        protocols = sys.stdin.buffer.readline().strip().split(b"|")
-        if not b"4bj" in protocols:
-            raise Exception("No acceptable protocol (%s)" % \
-                ", ".join([x.decode("utf-8") for x in protocols]))
-        sys.stdout.buffer.write(b"4bj\n")
-        sys.stdout.buffer.flush()
-        
+        self.negotiate()
         # initial exchange
         self.reg_callback(None, self.default_message)
         ans = self.getid_check(cfg = cfg)
         self.myid = ans.get("agentid")
         self.cfg = ans.get("cfg")
 
+    def negotiate(self):
+        "Select best protocol and compressor offered by hub"
+
+        # "proto1|proto2 compressor1,compressor2"
+        offer = self.rfile.readline().strip().split(b" ")
+        protocols = offer[0].split(b"|")
+        offered_comp = offer[1].split(b",") if len(offer) > 1 else []
+        for proto in self.protocols:
+            if proto in protocols:
+                break
+        else:
+            raise Exception("No acceptable protocol (%s)" % \
+                ", ".join([x.decode("utf-8") for x in protocols]))
+        self.protocol = proto
+        self.dumps, self.loads = codecs[proto]
+        reply = proto
+        if self.compress_threshold:
+            for comp in compressors:
+                if comp in offered_comp:
+                    self.compressor = compressors[comp]
+                    reply += b" " + comp
+                    break
+        self.wfile.write(reply + b"\n")
+        self.wfile.flush()
+
     def process_msgs(self):
         "Process messages until exhaustion"
         
         if not self.msgs:
-            ans = self.wait_msg_check(block = True)
-            self.msgs += ans.get("msgs", [])
+            if self.streaming:
+                while not self.msgs:
+                    ans = self.recv_frame()
+                    if ans is not None:
+                        raise Exception("Protocol error: unexpected answer")
+            else:
+                ans = self.wait_msg_check(block = True)
+                self.msgs += ans.get("msgs", [])
         while self.msgs:
-            nsname, msg, opts = self.msgs.pop(0)
+            nsname, msg, opts = self.msgs.popleft()
+            if self.streaming:
+                self.stream_used += 1
+                if self.stream_used * 2 >= self.stream_window:
+                    self.add_credit(self.stream_used)
+                    self.stream_used = 0
             self.process_msg(nsname, msg, opts)
 
     def process_msg(self, name, msg, opts):
@@ -177,8 +362,8 @@ class AgentIO:
         # get namespace
         ns, name = name.split("/", 1)
         if ns == self.myid and name == "ret":
-            # rpc for answers
-            reqid = msg.get("reqid")
+            # rpc for answers, reqid is in opts or in answer
+            reqid = (opts or {}).get("reqid", msg.get("reqid"))
             if reqid in self.wait_req:
                 self.wait_ans[reqid] = msg
                 return
@@ -198,15 +383,19 @@ class AgentIO:
     def end_loop(self):
         self.isloop = False
 
-    def call(self, rpc, fn, args = None):
-        "RPC from client"
+    def call(self, rpc, fn, args = None, timeout = None, opts = None):
+        "RPC from client, timeout in seconds overrides hub default"
         
         assert rpc, "RPC address can't be empty"
         reqid = self.reqid
         self.reqid += 1
+        # extra options like balancing "key"
+        opts = dict(opts) if opts else {}
+        opts.update({"reqid": reqid, "from": self.myid, "check": "call"})
+        if timeout is not None:
+            opts["timeout"] = timeout
         self.push_msg_check(name = rpc + "/call", 
-            msg = {"fn": fn, "args": args}, 
-            opts = {"reqid": reqid, "from": self.myid, "check": "call"})
+            msg = {"fn": fn, "args": args}, opts = opts)
         self.wait_req[reqid] = (reqid, rpc, fn, args)
         while reqid not in self.wait_ans:
             self.process_msgs()
@@ -219,7 +408,9 @@ class AgentIO:
         "Default message handler"
 
         if ns == "*" and name == "pulse": return
-        if ns == self.myid and name == "call": 
+        if name == "call" and (ns == self.myid or self.rpc_listeners or
+                self.rpc_def_listener):
+            # own address or shared address of server replicas
             return self.default_rpc(ns, name, msg, opts)
         print("Unprocessed", ns, name, msg, opts, file = sys.stderr)
 
@@ -249,13 +440,229 @@ class AgentIO:
         except Exception as e:
             traceback.print_exc(file = sys.stderr)
             msg = {"answer": "error", "msg": repr(e)}
-        opts = {"reqid": reqid, "from": sender}
-        self.push_msg_check(name = sender + "/ret", 
-            msg = msg, opts = opts)
+        # answer after call deadline is dropped by hub with error
+        opts = {"reqid": reqid, "from": sender, "check": "call"}
+        self.push_msg(name = sender + "/ret", msg = msg, opts = opts)
 
     def send_signal(self):
         "Send signal to hub"
         
-        sys.stdout.buffer.write(b"\"-\"")
-        sys.stdout.buffer.flush()
+        self.wfile.write(b"\"-\"")
+        self.wfile.flush()
+
+
+class ThreadedAgentIO(AgentIO):
+    """Thread-safe agent client
+
+    Background thread reads all frames, answers are passed to waiting
+    threads by id, messages are queued. Requests are pipelined, so
+    any thread may push or call while other threads wait.
+    """
+
+    def __init__(self, protocols = None, compress_threshold = 65536,
+            pipeline = 256, stream = 100):
+        super().__init__(protocols, compress_threshold)
+        self.pipeline_limit = pipeline
+        self.stream_credit = stream # 0 - use wait_msg
+        self.local = threading.local() # per thread waitid
+        self.lock = threading.Lock() # ids, waiters, credit
+        self.wlock = threading.Lock() # writer
+        self.wpending = 0 # threads going to write
+        self.waiters = {} # id -> [event, answer]
+        self.queue = queue.Queue() # incoming messages
+        self.reader = None
+        self.pump = None
+        self.error = None # reader termination reason
 
+    def init_loop(self, cfg = False):
+        "Negotiate, start reader thread, switch to pipeline and stream"
+
+        self.negotiate()
+        self.reg_callback(None, self.default_message)
+        self.reader = threading.Thread(target = self.read_loop,
+            name = "lrmq-reader", daemon = True)
+        self.reader.start()
+        if self.pipeline_limit:
+            self.pipeline_check(self.pipeline_limit)
+        ans = self.getid_check(cfg = cfg)
+        self.myid = ans.get("agentid")
+        self.cfg = ans.get("cfg")
+        if self.stream_credit:
+            self.stream_check(self.stream_credit)
+        else:
+            self.pump = threading.Thread(target = self.pump_loop,
+                name = "lrmq-pump", daemon = True)
+            self.pump.start()
+
+    def send_req(self, req):
+        "Send request, answer is awaited by recv_ans in the same thread"
+
+        waiter = [threading.Event(), None]
+        with self.lock:
+            if self.error is not None:
+                raise Exception("Connection lost: %r" % self.error)
+            cid = self.cmdid
+            self.cmdid += 1
+            self.waiters[cid] = waiter
+        self.local.waitid = cid
+        req["id"] = cid
+        self.send_frame(req)
+
+    def write_frame(self, frame):
+        "Buffered write, last writer of burst flushes"
+
+        with self.lock:
+            self.wpending += 1
+        with self.wlock:
+            self.wfile.write(frame)
+            with self.lock:
+                self.wpending -= 1
+                flush = not self.wpending
+            if flush:
+                self.wfile.flush()
+
+    def recv_ans(self):
+        "Wait for answer to last request of current thread"
+
+        cid = self.local.waitid
+        with self.lock:
+            waiter = self.waiters.get(cid)
+        if waiter is None:
+            raise Exception("Protocol error: no request %r" % cid)
+        waiter[0].wait()
+        with self.lock:
+            self.waiters.pop(cid, None)
+        if waiter[1] is None:
+            raise Exception("Connection lost: %r" % self.error)
+        return waiter[1]
+
+    def stream(self, credit = 100):
+        "Switch to stream mode, hub pushes up to credit messages"
+
+        # frames may come before answer
+        with self.lock:
+            self.streaming = True
+            self.stream_window = credit
+            self.stream_used = 0
+        self.send_req({"cmd": "stream", "credit": credit})
+        ans = self.recv_ans()
+        if ans.get("answer") != "ok":
+            self.streaming = False
+        return ans
+
+    stream_check = check_answer(stream, "start streaming")
+
+    def read_loop(self):
+        "Reader thread: dispatch answers and messages"
+
+        try:
+            while True:
+                ans = self.read_frame()
+                if ans.get("answer") == "stream":
+                    for m in ans.get("msgs", []):
+                        self.dispatch_msg(*m)
+                    continue
+                with self.lock:
+                    waiter = self.waiters.get(ans.get("id"))
+                if waiter is not None:
+                    waiter[1] = ans
+                    waiter[0].set()
+        except Exception as e:
+            error = e
+        with self.lock:
+            self.error = error
+            waiters = list(self.waiters.values())
+            calls = list(self.wait_req.values())
+        for waiter in waiters + calls:
+            waiter[0].set()
+        self.queue.put(None)
+
+    def dispatch_msg(self, name, msg, opts):
+        "Pass RPC answer to caller or queue message"
+
+        if self.myid and name == self.myid + "/ret" and \
+                isinstance(msg, dict):
+            reqid = (opts or {}).get("reqid", msg.get("reqid"))
+            with self.lock:
+                waiter = self.wait_req.get(reqid)
+            if waiter is not None:
+                waiter[1] = msg
+                waiter[0].set()
+                self.use_credit()
+                return
+        self.queue.put((name, msg, opts))
+
+    def pump_loop(self):
+        "Pump thread: receive messages with wait_msg if not streaming"
+
+        try:
+            while True:
+                ans = self.wait_msg_check(block = True)
+                for m in ans.get("msgs", []):
+                    self.dispatch_msg(*m)
+        except Exception as e:
+            if self.error is None:
+                traceback.print_exc(file = sys.stderr)
+
+    def use_credit(self):
+        "Message processed, return credit to hub"
+
+        with self.lock:
+            if not self.streaming:
+                return
+            self.stream_used += 1
+            if self.stream_used * 2 < self.stream_window:
+                return
+            credit = self.stream_used
+            self.stream_used = 0
+        self.add_credit(credit)
+
+    def process_msgs(self):
+        "Process messages until exhaustion, may be called from many threads"
+
+        item = self.queue.get()
+        while item is not None:
+            self.use_credit()
+            self.process_msg(*item)
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+        # connection lost, wake other consumers
+        self.queue.put(None)
+        self.isloop = False
+
+    def process_msg(self, name, msg, opts):
+        "Process one message"
+
+        ns, name = name.split("/", 1)
+        if ns in self.msg_listeners:
+            return self.msg_listeners[ns](ns, name, msg, opts)
+        if self.msg_def_listener:
+            return self.msg_def_listener(ns, name, msg, opts)
+
+    def call(self, rpc, fn, args = None, timeout = None, opts = None):
+        "RPC from client, answer is awaited by current thread only"
+
+        assert rpc, "RPC address can't be empty"
+        waiter = [threading.Event(), None]
+        with self.lock:
+            reqid = self.reqid
+            self.reqid += 1
+            self.wait_req[reqid] = waiter
+        opts = dict(opts) if opts else {}
+        opts.update({"reqid": reqid, "from": self.myid, "check": "call"})
+        if timeout is not None:
+            opts["timeout"] = timeout
+        try:
+            self.push_msg_check(name = rpc + "/call",
+                msg = {"fn": fn, "args": args}, opts = opts)
+            waiter[0].wait()
+        finally:
+            with self.lock:
+                self.wait_req.pop(reqid, None)
+        if waiter[1] is None:
+            raise Exception("Connection lost: %r" % self.error)
+        return waiter[1]
+
+    call_check = check_answer(call, "call rpc")
@@ -28,14 +28,21 @@ import re
 import asyncio
 import time
 import json
-import pickle
-import struct
+import zlib
 import traceback
+import heapq
 import logging
-import datetime
+import itertools
+import collections
 
 from .agent import AgentSystem, agent_factory
-from .logs import LogTypes, LogTypesFilter
+from .logs import (LogTypes, LogTypesFilter, LogWriter, QueuedHandler,
+    BinaryLogHandler)
+from .route import RouteTable, GlobMask, regex_namespace
+from .msgqueue import QueueOverflow, Envelope
+from .store import Store
+from .topiclog import TopicLog
+from .metrics import Metrics
 
 # Agent work scheme:
 #  propose protocols line
@@ -50,8 +57,27 @@ class Hub:
     def __init__(self):
         # subscribers
         self.subs = {}
-        self.subsmasks = []
+        self.routes = RouteTable()
+        self.route_gen = 0 # bumped on every subscription change
+        self.route_cache = collections.OrderedDict() # name -> entries
+        self.route_cache_gen = 0
+        self.route_cache_size = 1024
+        self.route_cache_hits = 0
+        self.route_cache_misses = 0
+        self.cfg = {}
+        self.pipeline_limit = 256 # max concurrent requests per agent
+        self.compress_threshold = 65536 # compress bigger frames, 0 - off
+        self.rpc_timeout = 60 # default call deadline, seconds, 0 - none
+        self.rpc_balance = "round_robin" # RPC server selection strategy
+        self.rpc_rr = {} # call name -> round robin counter
+        self.rpc_outstanding = collections.Counter() # server -> calls
         self.subscnt = 0
+        # competing consumers, each message goes to one group member
+        self.groups = {} # name -> [subid]
+        self.sub_groups = {} # subid -> name
+        self.group_rr = {} # name -> counter
+        self.group_partitions = 64 # keyed messages, partitions per group
+        self.group_owners = {} # name -> [subid of partition owner]
         self.loop = asyncio.get_event_loop()
         self.log_formatter = \
             logging.Formatter('%(asctime)s %(levelname)s %(message)s')
@@ -59,6 +85,17 @@ class Hub:
         self.logger = logging.getLogger("<hub>")
         self.logger.addFilter(self.log_filter)
         self.log_handlers = set()
+        self.log_writer = None # thread for log output, None - inline
+
+        # durable log
+        self.store = None
+        self.store_namespaces = set() # always persisted
+        self.store_queues = {} # recovered messages by agent store_key
+        # replayable namespace history
+        self.topic_logs = {} # namespace -> TopicLog
+
+        # sharded mode, ShardNode of this worker or None
+        self.shard = None
 
         # current agent list
         self.sysagent = AgentSystem(self)
@@ -67,26 +104,57 @@ class Hub:
         self.stopped_agents = []
         self.id_cnt = 0 # numerate objects
         self.exit_code = 0
-        self.clean_cnt = 0
+        self.reporting_lost = False
         
         # checks
+        # (caller, reqid) -> (caller, reqid, rpc, until, server, started)
         self.call_wait = {}
+        self.call_deadlines = [] # heap (until, seq, key)
+        self.call_seq = itertools.count()
+        self.call_timer = None # reaper for earliest deadline
+        self.calls_completed = 0
+        self.calls_timed_out = 0
+        self.calls_late = 0 # answers after deadline
+
+        # load metrics
+        self.metrics = Metrics()
+        self.stats_interval = 0 # system/stats period, seconds, 0 - off
 
         self.main_s = None
         self.is_active = True
 
     def load_config(self, cfg):
         self.cfg = cfg
+        self.route_cache_size = cfg.get("route_cache_size", 
+            self.route_cache_size)
+        self.pipeline_limit = cfg.get("pipeline_limit", self.pipeline_limit)
+        self.compress_threshold = cfg.get("compress_threshold", 
+            self.compress_threshold)
+        self.rpc_timeout = cfg.get("rpc_timeout", self.rpc_timeout)
+        self.rpc_balance = cfg.get("rpc_balance", self.rpc_balance)
+        self.group_partitions = cfg.get("group_partitions", 
+            self.group_partitions)
+        self.stats_interval = cfg.get("stats_interval", self.stats_interval)
+        self.metrics.max_namespaces = cfg.get("metrics_namespaces", 
+            self.metrics.max_namespaces)
+        if self.rpc_balance not in self.balancers:
+            raise Exception("Unknown RPC balance strategy '%s'" % 
+                self.rpc_balance)
+        if cfg.get("log_thread"):
+            # format and write records out of event loop
+            self.log_writer = LogWriter()
+            self.log_writer.start()
         # debug logger
         if __debug__:
-            debuglogger = self.cfg.get("debuglogger", "INFO")
+            debuglogger = self.cfg.get("debuglogger")
             if debuglogger:
                 rootlogger = logging.getLogger("")
-                self.debughandler = DebugLoggerHandler(filename = debuglogger, 
-                    mode = "wb")
+                self.debughandler = BinaryLogHandler(debuglogger,
+                    max_bytes = self.cfg.get("debuglog_max_bytes", 
+                    64 * 1024 * 1024),
+                    backup_count = self.cfg.get("debuglog_backups", 3))
                 self.debughandler.setLevel(logging.DEBUG)
-                rootlogger.addHandler(self.debughandler)
-                self.log_handlers.add((rootlogger, self.debughandler))
+                self.add_log_handler(rootlogger, self.debughandler)
         
         loglevel = self.cfg.get("loglevel", "INFO")
         self.logger.setLevel(loglevel)
@@ -97,10 +165,15 @@ class Hub:
             hdlr = logging.StreamHandler(sys.stdout)
         if hdlr:
             hdlr.setFormatter(self.log_formatter)
-            self.logger.addHandler(hdlr)
-            self.log_handlers.add((self.logger, hdlr))
+            self.add_log_handler(self.logger, hdlr)
 
         self.logger.debug(LogTypes.MARK)
+        scfg = cfg.get("store")
+        if scfg:
+            self.open_store(scfg)
+        rcfg = cfg.get("retention")
+        if rcfg:
+            self.open_retention(rcfg)
         loadmode = cfg.get("load_mode", "config")
         self.logger.debug(LogTypes.HUB_LOAD_MODE, loadmode)
         if loadmode == "config_folder":
@@ -119,34 +192,343 @@ class Hub:
                 a = agent_factory(self, acfg)
                 self.pending_agents.append(a)
 
+    def add_log_handler(self, logger, hdlr):
+        "Attach handler, it is closed on cleanup"
+
+        if self.log_writer is not None:
+            hdlr = QueuedHandler(hdlr, self.log_writer)
+        logger.addHandler(hdlr)
+        self.log_handlers.add((logger, hdlr))
+
+    def open_store(self, scfg):
+        "Open durable log, recover undelivered messages"
+
+        self.store = Store(self.loop, scfg["path"], 
+            segment_bytes = scfg.get("segment_bytes", 16 * 1024 * 1024),
+            commit_interval = scfg.get("commit_interval", 0.005),
+            commit_bytes = scfg.get("commit_bytes", 1024 * 1024))
+        segments = self.store.open()
+        self.store_namespaces = set(scfg.get("namespaces", ()))
+        self.store_queues = self.store.recovered()
+        self.logger.info(LogTypes.HUB_STORE_OPEN, scfg["path"], segments,
+            len(self.store.live))
+
+    def open_retention(self, rcfg):
+        "Open retention logs of configured namespaces"
+
+        for ns in rcfg.get("namespaces", ()):
+            log = TopicLog(os.path.join(rcfg["path"], ns),
+                segment_bytes = rcfg.get("segment_bytes", 64 * 1024 * 1024),
+                retention_bytes = rcfg.get("retention_bytes"),
+                index_bytes = rcfg.get("index_bytes", 4096))
+            log.open()
+            self.topic_logs[ns] = log
+            self.logger.info(LogTypes.HUB_RETENTION_OPEN, ns, 
+                log.first_offset, log.next_offset)
+
+    def topic_log_for(self, mask):
+        "Retention log of mask namespace, raise if there is none"
+
+        if isinstance(mask, GlobMask):
+            ns = mask.parts[0] if "*" not in mask.parts[0] else None
+        elif mask.flags & re.IGNORECASE:
+            ns = None
+        else:
+            ns = regex_namespace(mask.pattern)
+        if ns is None:
+            raise Exception("Replay needs mask with literal namespace")
+        log = self.topic_logs.get(ns)
+        if log is None:
+            raise Exception("Namespace '%s' has no retention log" % ns)
+        return log
+
+    def retain(self, log, name, msg, opts):
+        "Append message to retention log, return options with offset"
+
+        opts = dict(opts) if opts else {}
+        opts["offset"] = log.next_offset
+        env = Envelope(name, msg, opts)
+        try:
+            body, jopts = env.encode_json()
+        except (TypeError, ValueError):
+            # not JSON serializable, can't be replayed
+            return None
+        log.append(name, b"[" + body + b", " + jopts + b"]")
+        return env
+
+    def restore_queue(self, a):
+        "Put recovered messages to durable agent queue"
+
+        for seq, name, msg, opts in self.store_queues.pop(a.store_key, ()):
+            env = Envelope(name, msg, opts)
+            env.store_seq = seq
+            try:
+                a.push_envelope(env)
+            except QueueOverflow:
+                self.store.ack(seq, a.store_key)
+                self.removed_msg(a, "overflow_reject", name, msg, opts)
+
+    def store_move(self, env, old, new):
+        "Durable message moved to other agent queue"
+
+        if env.store_seq is None:
+            return
+        if new.store_key is not None:
+            self.store.add(env.store_seq, new.store_key)
+        if old is not None and old.store_key is not None:
+            self.store.ack(env.store_seq, old.store_key)
+
     def genid(self, prefix):
         oid = self.id_cnt
         self.id_cnt += 1
+        if self.shard is not None:
+            # unique over all shards
+            return "%s%d-%d" % (prefix, self.shard.index, oid)
         return "%s%d" % (prefix, oid)
 
-    def subscribe(self, mask, subscriber):
-        "Subscribe to message by mask"
+    def subscribe(self, mask, subscriber, group = None):
+        "Subscribe to message by mask, optionally as group member"
 
         subid = self.subscnt
         self.subscnt += 1
         self.subs[subid] = subscriber
-        self.subsmasks.append((mask, subid))
+        self.routes.add(mask, subid)
+        self.route_gen += 1
+        if group is not None:
+            self.groups.setdefault(group, []).append(subid)
+            self.sub_groups[subid] = group
+            self.rebalance(group)
+        if self.shard is not None and not subscriber.isshard:
+            self.shard.sub_added(subid, mask, group, subscriber.isrpc)
         return subid
 
     def unsubscribe(self, subid):
         "Unsubscribe by subid"
 
-        oldsubid = subid
-        self.subsmasks = [(mask, subid) for (mask, subid) in self.subsmasks
-            if subid != oldsubid]
-        del self.subs[oldsubid]
+        subscriber = self.subs[subid]
+        if self.shard is not None and not subscriber.isshard:
+            self.shard.sub_removed(subid)
+        self.routes.remove(subid)
+        del self.subs[subid]
+        self.route_gen += 1
+        if subscriber in self.rpc_outstanding and \
+                all(a is not subscriber for a in self.subs.values()):
+            # server is gone, calls without deadline would never release
+            del self.rpc_outstanding[subscriber]
+        group = self.sub_groups.pop(subid, None)
+        if group is not None:
+            members = self.groups[group]
+            members.remove(subid)
+            if not members:
+                del self.groups[group]
+                self.group_rr.pop(group, None)
+            self.rebalance(group)
+
+    def partition(self, key):
+        "Partition number of message key"
+
+        return zlib.crc32(str(key).encode("utf-8")) % self.group_partitions
+
+    def rebalance(self, group):
+        """Spread group partitions over members
+
+        Partitions keep their owners while quota allows. Queued keyed
+        messages of moved partitions follow them, so order of messages
+        with one key is kept.
+        """
+
+        members = self.groups.get(group)
+        old = self.group_owners.pop(group, None)
+        if not members:
+            return
+        pcnt = self.group_partitions
+        quota = {subid: pcnt // len(members) + 
+            (1 if idx < pcnt % len(members) else 0)
+            for idx, subid in enumerate(members)}
+        owners = [None] * pcnt
+        if old is not None:
+            for part, subid in enumerate(old):
+                if quota.get(subid):
+                    owners[part] = subid
+                    quota[subid] -= 1
+        free = iter([subid for subid in members 
+            for i in range(quota[subid])])
+        for part in range(pcnt):
+            if owners[part] is None:
+                owners[part] = next(free)
+        self.group_owners[group] = owners
+        if old is None:
+            moved = range(pcnt)
+        else:
+            moved = [part for part in range(pcnt) if old[part] != owners[part]]
+        if not moved:
+            return
+        # move queued messages of still subscribed owners
+        if old is not None:
+            sources = {}
+            for part in moved:
+                if old[part] in self.subs:
+                    sources.setdefault(old[part], set()).add(part)
+            for subid, parts in sources.items():
+                a = self.subs[subid]
+                items = a.q.remove(lambda item: item.subid == subid and 
+                    item.env.opts and item.env.opts.get("key") is not None and
+                    self.partition(item.env.opts["key"]) in parts)
+                for item in items:
+                    owner = owners[self.partition(item.env.opts["key"])]
+                    try:
+                        self.subs[owner].push_envelope(item.env, owner, 
+                            item.until)
+                        self.store_move(item.env, a, self.subs[owner])
+                    except QueueOverflow:
+                        a.item_done(item)
+                        self.removed_msg(self.subs[owner], "overflow_reject",
+                            item.name, item.msg, item.opts)
+        # notify members about new assignment
+        changed = set(owners[part] for part in moved)
+        if old is not None:
+            changed.update(old[part] for part in moved 
+                if old[part] in self.subs)
+        for subid in members:
+            if subid in changed:
+                self.subs[subid].send_agent_event("rebalance", {
+                    "group": group, "subid": subid, "partitions": 
+                    [part for part in range(pcnt) if owners[part] == subid]})
+
+    def group_entries(self, entries, opts, groups = None):
+        """Replace group members by one selected member per group
+
+        Only listed groups are served if groups is not None, other shard
+        has selected members of the rest.
+        """
+
+        key = opts.get("key") if opts else None
+        selected = []
+        candidates = {}
+        for subid, subscriber in entries:
+            group = self.sub_groups.get(subid)
+            if group is None:
+                selected.append((subid, subscriber))
+            elif groups is None or group in groups:
+                candidates.setdefault(group, []).append((subid, subscriber))
+        if key is not None and candidates and self.shard is not None:
+            # partition owners are chosen by each shard
+            raise Exception("Keyed group messages are not supported by "
+                "sharded hub")
+        for group, members in candidates.items():
+            if key is not None:
+                # keyed message goes to partition owner, even stopping
+                # one, its backlog is passed on exit in order
+                owner = self.group_owners[group][self.partition(key)]
+                member = self.subs[owner]
+                if (owner, member) in members:
+                    selected.append((owner, member))
+                    continue
+            members = [x for x in members if x[1].isloop]
+            if members:
+                selected.append(self.pick_member(group, members))
+        return selected
+
+    def pick_member(self, group, members):
+        "Member with most free stream credit, then shortest queue"
+
+        if len(members) == 1:
+            return members[0]
+        # rotate start, so equal members are used in turn
+        cnt = self.group_rr.get(group, 0)
+        self.group_rr[group] = cnt + 1
+        start = cnt % len(members)
+        members = members[start:] + members[:start]
+        def score(member):
+            a = member[1]
+            qlen = len(a.q)
+            return (max(a.stream_credit - qlen, 0), -qlen)
+        return max(members, key = score)
+
+    def redistribute(self, agent, grouped):
+        "Pass queued group messages of stopped agent to other members"
+
+        cnt = 0
+        while True:
+            item = agent.q.pop()
+            if item is None:
+                break
+            group = grouped.get(item.subid)
+            if group is None:
+                continue
+            if item.isexpired(self.loop.time()):
+                agent.q.expired += 1
+                agent.item_done(item)
+                self.removed_msg(agent, "timeout", item.name, item.msg, 
+                    item.opts)
+                continue
+            members = [(subid, self.subs[subid]) 
+                for subid in self.groups.get(group, ())
+                if self.subs[subid].isloop]
+            if not members:
+                agent.item_done(item)
+                self.removed_msg(agent, "no_group_member", item.name, 
+                    item.msg, item.opts)
+                continue
+            key = item.env.opts.get("key") if item.env.opts else None
+            if key is not None:
+                subid = self.group_owners[group][self.partition(key)]
+                member = self.subs[subid]
+            else:
+                subid, member = self.pick_member(group, members)
+            try:
+                member.push_envelope(item.env, subid, item.until)
+                self.store_move(item.env, agent, member)
+                cnt += 1
+            except QueueOverflow:
+                agent.item_done(item)
+                self.removed_msg(member, "overflow_reject", item.name, 
+                    item.msg, item.opts)
+        if cnt:
+            self.logger.debug(LogTypes.HUB_GROUP_REDISTRIBUTE, 
+                agent.getid() or agent.name, cnt)
+
+    def route(self, name):
+        "Return list of (subid, subscriber) for message name"
+
+        cache = self.route_cache
+        if self.route_cache_gen != self.route_gen:
+            # subscriptions changed
+            cache.clear()
+            self.route_cache_gen = self.route_gen
+        entries = cache.get(name)
+        if entries is not None:
+            self.route_cache_hits += 1
+            cache.move_to_end(name)
+            return entries
+        self.route_cache_misses += 1
+        entries = [(subid, self.subs[subid])
+            for subid in self.routes.match(name)]
+        if self.route_cache_size > 0:
+            cache[name] = entries
+            if len(cache) > self.route_cache_size:
+                cache.popitem(last = False)
+        return entries
+
+    def route_cache_stats(self):
+        "Route cache counters"
+
+        return {"size": len(self.route_cache), 
+            "limit": self.route_cache_size,
+            "hits": self.route_cache_hits, 
+            "misses": self.route_cache_misses}
 
     async def main_loop(self):
         self.logger.info(LogTypes.HUB_START)
         self.main_s = self.loop.create_future()
         pending = [self.main_s]
         def process_agents(pending):
-            pending += [a.run() for a in self.pending_agents]
+            if self.store_queues:
+                for a in self.pending_agents:
+                    if a.store_key is not None:
+                        self.restore_queue(a)
+            pending += [asyncio.ensure_future(a.run())
+                for a in self.pending_agents]
             self.working_agents += self.pending_agents
             self.pending_agents = []
             cnt = 0
@@ -179,42 +561,143 @@ class Hub:
             if cnt <= 1: break
         self.logger.info(LogTypes.HUB_FINISH)
         # cleanup
+        if self.call_timer:
+            self.call_timer.cancel()
+            self.call_timer = None
+        if self.store:
+            await self.store.close()
+        for log in self.topic_logs.values():
+            log.close()
         self.sysagent.isloop = False
         self.sysagent.signal()
         self.signal()
         await asyncio.wait(pending + [self.main_s])
 
     def signal(self):
-        if self.main_s:
+        if self.main_s and not self.main_s.done():
             self.main_s.set_result(True)
 
     def push_msg(self, sender, name, msg = None, opts = None):
-        "Push message to all queues"
+        """Push message to all queues
+
+        Return future of durable log commit if message is persisted.
+        """
 
         # check variants
         check = opts.get("check") if opts else None
         if check:
             assert isinstance(check, str), "Check must be string or None"
-
-        self.logger.debug(LogTypes.HUB_MESSAGE, name, str(msg), str(opts),
-            extra = {"msg_name": name, "msg_msg": msg, "msg_opts": opts})
-
+            timeout = opts.get("timeout")
+            if check == "call" and timeout is not None and \
+                    (isinstance(timeout, bool) or 
+                    not isinstance(timeout, (int, float)) or 
+                    not timeout >= 0):
+                # refused before call reaches server
+                raise Exception("Call timeout must be non-negative number")
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(LogTypes.HUB_MESSAGE, name, str(msg), 
+                str(opts), extra = {"msg_name": name, "msg_msg": msg, 
+                "msg_opts": opts})
+
+        # message from other shard goes to local subscribers only
+        forwarded = sender is not None and sender.isshard
+        started = time.perf_counter()
+        entries = self.route(name)
+        if forwarded:
+            entries = [x for x in entries if not x[1].isshard]
+
+        if check == "call" and name.endswith("/ret"):
+            # answer must be awaited, late answers are dropped, call
+            # is traced by shard of caller
+            if self.shard is None or forwarded or not entries or \
+                    not all(x[1].isshard for x in entries):
+                self.call_done(sender, name, opts)
+
+        server = None
+        if check == "call" and name.endswith("/call"):
+            if forwarded and not sender.forward_server:
+                # copy for observers, server is on other shard
+                entries = [x for x in entries if not x[1].isrpc]
+            else:
+                # exactly one RPC server executes call
+                entries, server = self.balance_call(name, entries, opts)
+        if self.sub_groups:
+            entries = self.group_entries(entries, opts, 
+                sender.forward_groups if forwarded else None)
+        metrics = self.metrics
+        metrics.match_time.record(time.perf_counter() - started)
+
+        ns = name.split("/", 1)[0]
         msg_processed = False
         msg_rpc = False
-        for mask, subid in self.subsmasks:
+        delivered = 0
+        rejected = []
+        env = Envelope(name, msg, opts)
+        if sender is not None:
+            # refuse before delivery to anyone, so publisher can retry
+            need = {}
+            for subid, subscriber in entries:
+                if subscriber.isloop and subscriber.q.overflow == "reject":
+                    need[subscriber] = need.get(subscriber, 0) + 1
+            for subscriber, count in need.items():
+                if subscriber.q.rejects(env, count):
+                    rejected.append(subscriber)
+            if rejected:
+                for subscriber in rejected:
+                    subscriber.q.rejected += 1
+                    self.removed_msg(subscriber, "overflow_reject", name, 
+                        msg, opts)
+                raise QueueOverflow("Queue is full for %s" % 
+                    ", ".join([str(a.getid() or a.name) for a in rejected]))
+        if self.topic_logs:
+            log = self.topic_logs.get(ns)
+            if log is not None:
+                retained = self.retain(log, name, msg, opts)
+                if retained is not None:
+                    # kept for replay, retry of publisher would duplicate
+                    env = retained
+                    msg_processed = True
+        commit = None
+        if self.store is not None and ((opts and opts.get("persist")) or
+                ns in self.store_namespaces):
+            targets = []
+            for subid, subscriber in entries:
+                key = subscriber.store_key
+                if key is not None and subscriber.isloop and \
+                        key not in targets:
+                    targets.append(key)
+            if targets:
+                env.store_seq, commit = self.store.put(name, msg, env.opts, 
+                    targets)
+        for subid, subscriber in entries:
             try:
-                if mask.match(name):
-                    nopts = {} if not opts else {k: v for k, v in opts.items()}
-                    nopts["subid"] = subid
-                    if self.subs[subid].isloop:
-                        self.subs[subid].push_msg(name, msg, nopts)
-                        msg_processed = True
-                        if self.subs[subid].isrpc:
-                            msg_rpc = True
+                if subscriber.isloop:
+                    subscriber.push_envelope(env, subid)
+                    msg_processed = True
+                    delivered += 1
+                    if subscriber.isrpc:
+                        msg_rpc = True
+            except QueueOverflow as e:
+                rejected.append(subscriber)
+                if env.store_seq is not None and \
+                        subscriber.store_key is not None:
+                    self.store.ack(env.store_seq, subscriber.store_key)
+                self.removed_msg(subscriber, "overflow_reject", name, msg, 
+                    opts)
             except Exception as e:
                 traceback.print_exc()
+        metrics.count(ns, delivered)
+        metrics.fanout.record(delivered)
 
-        if check == "call":
+        if rejected and sender is not None:
+            raise QueueOverflow("Queue is full for %s" % 
+                ", ".join([str(a.getid() or a.name) for a in rejected]))
+
+        if forwarded:
+            # checked by origin shard
+            pass
+        elif check == "call":
             opts = opts or {}
             from_agent = opts.get("from")
             if not sender:
@@ -225,47 +708,212 @@ class Hub:
                 if not msg_rpc:
                     raise Exception("RPC server not found")
                 # start tracing by (caller, reqid) pair
-                self.call_wait[(from_agent, reqid)] = \
-                    (from_agent, reqid, name[:-5], datetime.datetime.now())
+                timeout = opts.get("timeout", self.rpc_timeout)
+                until = self.loop.time() + timeout if timeout else None
+                self.call_wait[(from_agent, reqid)] = (from_agent, reqid,
+                    name[:-5], until, server, self.loop.time())
+                self.rpc_outstanding[server] += 1
+                if until is not None:
+                    self.add_call_deadline(until, (from_agent, reqid))
             elif name.endswith("/ret"):
-                waiter = self.call_wait.pop((from_agent, reqid), None)
-                if waiter is None or not msg_processed:
+                if not msg_processed:
                     self.logger.debug(LogTypes.HUB_MESSAGE_NORET, name)
                     raise Exception("Answer was not received")
             else:
                 self.logger.debug(LogTypes.HUB_MESSAGE_BADCALL, name)
                 raise Exception("Unknown RPC message type '%s'" % name)
         else:
-            if msg_processed:
+            if not msg_processed and sender is not None:
+                # hub events may stay unprocessed
                 self.logger.debug(LogTypes.HUB_MSG_UNPROCESSED, name, 
                     str(msg), str(opts))
                 raise Exception("Message was not processed")
+        return commit
                 
         
+    def call_done(self, sender, name, opts):
+        "Finish call tracing on answer, raise if call is not awaited"
+
+        opts = opts or {}
+        if not sender:
+            raise Exception("Sender must be specified")
+        waiter = self.call_wait.pop((opts.get("from"), opts.get("reqid")),
+            None)
+        if waiter is None:
+            self.calls_late += 1
+            self.logger.debug(LogTypes.HUB_MESSAGE_NORET, name)
+            raise Exception("Answer was not received")
+        self.calls_completed += 1
+        self.metrics.rpc_time.record(self.loop.time() - waiter[5])
+        self.release_server(waiter[4])
+
+    def release_server(self, server):
+        "Call finished, decrease server load"
+
+        if server not in self.rpc_outstanding:
+            # server already unsubscribed
+            return
+        cnt = self.rpc_outstanding[server] - 1
+        if cnt > 0:
+            self.rpc_outstanding[server] = cnt
+        else:
+            del self.rpc_outstanding[server]
+
+    def balance_call(self, name, entries, opts):
+        "Select one RPC server, return (entries, server)"
+
+        servers = []
+        others = []
+        for subid, subscriber in entries:
+            if not subscriber.isrpc:
+                # observers get copy of every call
+                others.append((subid, subscriber))
+            elif subscriber.isloop and \
+                    all(subscriber is not a for _, a in servers):
+                servers.append((subid, subscriber))
+        if len(servers) > 1:
+            strategy = opts.get("balance", self.rpc_balance)
+            balancer = self.balancers.get(strategy)
+            if balancer is None:
+                raise Exception("Unknown RPC balance strategy '%s'" % 
+                    strategy)
+            servers = [balancer(self, name, servers, opts)]
+        if not servers:
+            return others, None
+        return others + servers, servers[0][1]
+
+    def balance_round_robin(self, name, servers, opts):
+        "Next server by turn"
+
+        cnt = self.rpc_rr.get(name, 0)
+        self.rpc_rr[name] = cnt + 1
+        return servers[cnt % len(servers)]
+
+    def balance_least_outstanding(self, name, servers, opts):
+        "Server with least calls in progress, ties by turn"
+
+        least = min(self.rpc_outstanding[a] for _, a in servers)
+        servers = [x for x in servers if self.rpc_outstanding[x[1]] == least]
+        return self.balance_round_robin(name, servers, opts)
+
+    def balance_hash(self, name, servers, opts):
+        "Rendezvous hashing on 'key' option, same key - same server"
+
+        key = opts.get("key")
+        if key is None:
+            return self.balance_round_robin(name, servers, opts)
+        key = str(key).encode("utf-8") + b"|"
+        return max(servers, key = lambda x: 
+            zlib.crc32(key + str(x[1].getid() or x[1].name).encode("utf-8")))
+
+    balancers = {
+        "round_robin": balance_round_robin,
+        "least_outstanding": balance_least_outstanding,
+        "hash": balance_hash,
+    }
+
+    def add_call_deadline(self, until, key):
+        "Remember call deadline, reschedule reaper if it is earliest"
+
+        deadlines = self.call_deadlines
+        if len(deadlines) > 64 and len(deadlines) > 2 * len(self.call_wait):
+            # drop answered calls
+            deadlines[:] = [x for x in deadlines
+                if self.call_wait.get(x[2], (None,) * 6)[3] == x[0]]
+            heapq.heapify(deadlines)
+        heapq.heappush(deadlines, (until, next(self.call_seq), key))
+        if self.call_timer is None or until < self.call_timer.when():
+            if self.call_timer is not None:
+                self.call_timer.cancel()
+            self.call_timer = self.loop.call_at(until, self.reap_calls)
+
+    def reap_calls(self):
+        "Answer expired calls with error"
+
+        self.call_timer = None
+        now = self.loop.time()
+        deadlines = self.call_deadlines
+        while deadlines and deadlines[0][0] <= now:
+            until, seq, key = heapq.heappop(deadlines)
+            waiter = self.call_wait.get(key)
+            if waiter is None or waiter[3] != until:
+                # answered or reused reqid
+                continue
+            del self.call_wait[key]
+            self.calls_timed_out += 1
+            caller, reqid, rpc, until, server, started = waiter
+            self.release_server(server)
+            self.logger.debug(LogTypes.HUB_CALL_TIMEOUT, rpc, str(reqid),
+                str(caller))
+            if caller is None:
+                continue
+            try:
+                self.push_msg(None, caller + "/ret", {"answer": "error",
+                    "msg": "RPC timeout", "reqid": reqid},
+                    {"reqid": reqid, "from": caller})
+            except Exception:
+                traceback.print_exc()
+        if deadlines:
+            self.call_timer = self.loop.call_at(deadlines[0][0], 
+                self.reap_calls)
+
+    def call_stats(self):
+        "RPC call counters"
+
+        return {"inflight": len(self.call_wait),
+            "completed": self.calls_completed,
+            "timed_out": self.calls_timed_out,
+            "late": self.calls_late}
+
+    def stats(self):
+        "Metrics snapshot with queue state of agents"
+
+        agents = {}
+        for a in self.working_agents:
+            agents[str(a.getid() or a.name)] = {"msgs": len(a.q),
+                "bytes": a.q.queued_bytes(), "dropped": a.q.dropped,
+                "rejected": a.q.rejected, "expired": a.q.expired}
+        stats = self.metrics.snapshot()
+        stats["agents"] = agents
+        stats["route_cache"] = self.route_cache_stats()
+        stats["calls"] = self.call_stats()
+        if self.store is not None:
+            stats["store"] = self.store.stats()
+        if self.shard is not None:
+            stats["shard"] = self.shard.stats()
+        return stats
+
     def push_pulse(self):
         "Push broadcast pulse message. Update internal structures"
 
-        # send alive notifications
+        # send alive notifications, out of bounded queues
+        env = Envelope("*/pulse", None, {"ttl": 30})
         for a in self.working_agents:
-            a.push_msg(None, "*/pulse", opts = {"ttl": 30})
+            a.push_pulse(env)
 
-        # cleanup old messages from queues
-        self.clean_cnt += 1
-        if self.clean_cnt >= 12:
-            self.clean_cnt = 0
-            for a in self.working_agents:
-                a.check_msg_expiration()
+        # cleanup expired messages, costs only expired items
+        for a in self.working_agents:
+            a.check_msg_expiration()
 
     def removed_msg(self, a, reason, name, msg, opts):
-        self.logger.debug(LogTypes.HUB_MESSAGE_REMOVED, name, 
-            str(msg), str(opts))
-        if name != "*/pulse" and not name.starts_with("system/msg_lost/"):
-            if a:
-                a.send_agent_event("msg_lost", {"msg": {"name": name,
-                "msg": msg, "opts": opts, "reason": reason}})
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(LogTypes.HUB_MESSAGE_REMOVED, name, 
+                str(msg), str(opts))
+        if name != "*/pulse" and \
+                not name.startswith("system/msg_lost_agent/"):
+            # lost report may overflow queue again, do not recurse
+            if a and not self.reporting_lost:
+                self.reporting_lost = True
+                try:
+                    a.send_agent_event("msg_lost", {"msg": {"name": name,
+                    "msg": msg, "opts": opts, "reason": reason}})
+                finally:
+                    self.reporting_lost = False
 
     def cleanup(self):
         # free used resources
+        if self.log_writer is not None:
+            self.log_writer.stop()
         for logger, hdlr in self.log_handlers:
             try:
                 hdlr.flush()
@@ -273,26 +921,3 @@ class Hub:
                 logger.removeHandler(hdlr)
             except:
                 traceback.print_exc()
-
-class DebugLoggerHandler(logging.FileHandler):
-    "Special debug logger"
-
-    def emit(self, record):
-        if self.stream is None:
-            self.stream = self._open()
-        fields = ("name", "asctime", "created", "levelname", "msg", 
-            "log_id", "args")
-        try:
-            data = {k: getattr(record, k) 
-                for k in fields if hasattr(record, k)}
-            if record.exc_info:
-                data["exc_info"] = repr(record.exc_info)
-            s = pickle.dumps(data)
-            slen = struct.pack(">L", len(s))
-            self.stream.write(slen + s)
-        except Exception:
-            self.handleError(record)
-
-    
-    
-
@@ -0,0 +1,173 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Binary debug log reader
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Reader of debug log written by logs.BinaryLogHandler
+
+import os
+import sys
+import mmap
+import pickle
+import logging
+import argparse
+
+from .logs import LogTypes, MAGIC, HEADER, RECORD, NAME
+
+class LogReader:
+    "Index of binary debug log, payload is decoded only for selected records"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.names = [] # agent index -> name
+        self.index = [] # (time, log_id, level, agent, pos, length)
+        self.data = b""
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                self.data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise Exception("'%s' is not lrmq debug log" % filename)
+        self.scan()
+
+    def scan(self):
+        "Read headers, skip payloads"
+
+        data = self.data
+        pos = len(MAGIC)
+        names = {}
+        while pos + HEADER.size <= len(data):
+            kind, rtime, log_id, level, agent, plen = \
+                HEADER.unpack_from(data, pos)
+            pos += HEADER.size
+            if pos + plen > len(data):
+                # record is not written completely
+                break
+            if kind == NAME:
+                names[agent] = len(self.names)
+                self.names.append(bytes(data[pos:pos + plen]).decode("utf-8"))
+            elif kind == RECORD:
+                self.index.append((rtime, log_id, level, names.get(agent),
+                    pos, plen))
+            pos += plen
+
+    def __len__(self):
+        return len(self.index)
+
+    def select(self, log_ids = None, agents = None, since = None, 
+            until = None, level = None):
+        """Iterate selected index entries
+
+        log_ids is (first, last) range, agents is list of names, time
+        window is [since, until).
+        """
+
+        if agents is not None:
+            agents = set(idx for idx, name in enumerate(self.names) 
+                if name in agents)
+        for entry in self.index:
+            rtime, log_id, lvl, agent = entry[:4]
+            if log_ids is not None and not \
+                    log_ids[0] <= log_id <= log_ids[1]:
+                continue
+            if agents is not None and agent not in agents:
+                continue
+            if since is not None and rtime < since:
+                continue
+            if until is not None and rtime >= until:
+                continue
+            if level is not None and lvl < level:
+                continue
+            yield entry
+
+    def decode(self, entry):
+        "Full record as dict"
+
+        rtime, log_id, level, agent, pos, plen = entry
+        msg, args, exc = pickle.loads(self.data[pos:pos + plen])
+        if log_id:
+            msg = LogTypes.text.get(log_id, msg)
+        rec = {"created": rtime, "log_id": log_id or None, "levelno": level,
+            "levelname": logging.getLevelName(level), 
+            "name": self.names[agent] if agent is not None else None,
+            "msg": msg, "args": args}
+        if exc is not None:
+            rec["exc_info"] = exc
+        return rec
+
+    def records(self, **filters):
+        "Decoded records matched by select() filters"
+
+        for entry in self.select(**filters):
+            yield self.decode(entry)
+
+def log_files(filename):
+    "Rotated files of debug log, oldest first"
+
+    files = []
+    idx = 1
+    while os.path.exists("%s.%d" % (filename, idx)):
+        files.insert(0, "%s.%d" % (filename, idx))
+        idx += 1
+    if os.path.exists(filename):
+        files.append(filename)
+    return files
+
+def read_log(filename, rotated = False, **filters):
+    "List of decoded records of log (with rotated files)"
+
+    files = log_files(filename) if rotated else [filename]
+    return [rec for fn in files for rec in LogReader(fn).records(**filters)]
+
+def main(argv = None):
+    "Print debug log: python -m lrmq.logreader"
+
+    parser = argparse.ArgumentParser(prog = "python -m lrmq.logreader",
+        description = "Print binary debug log")
+    parser.add_argument("filename")
+    parser.add_argument("-r", "--rotated", action = "store_true",
+        help = "Include rotated files")
+    parser.add_argument("-i", "--ids", 
+        help = "log_id range 'first-last' or single id")
+    parser.add_argument("-a", "--agent", action = "append",
+        help = "Logger name")
+    parser.add_argument("--since", type = float, help = "Unix time")
+    parser.add_argument("--until", type = float, help = "Unix time")
+    args = parser.parse_args(argv)
+    log_ids = None
+    if args.ids:
+        first, _, last = args.ids.partition("-")
+        log_ids = (int(first), int(last or first))
+    for rec in read_log(args.filename, rotated = args.rotated, 
+            log_ids = log_ids, agents = args.agent, since = args.since, 
+            until = args.until):
+        try:
+            text = rec["msg"] % rec["args"] if rec["args"] else rec["msg"]
+        except Exception:
+            text = "%s %r" % (rec["msg"], rec["args"])
+        print("%.6f %s %s %s %s" % (rec["created"], rec["levelname"],
+            rec["name"], rec["log_id"] or "-", text))
+        if "exc_info" in rec:
+            print(rec["exc_info"], end = "")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,20 +22,214 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
+import copy
+import queue
+import pickle
+import struct
 import logging
+import threading
+import traceback
 
 class LogTypesFilter(logging.Filter):
     "Filter translate id to text representation"
 
     def filter(self, record):
+        value = record.msg
+        if value.__class__ is int:
+            text = LogTypes.text.get(value)
+            if text is not None:
+                record.msg = text
+                record.log_id = value
+        return True
+
+class LogWriter:
+    "Thread which formats and writes records of queued handlers"
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, 
+            name = "lrmq-log", daemon = True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            target, record = item
+            try:
+                target.handle(record)
+            except Exception:
+                target.handleError(record)
+
+    def stop(self):
+        "Write pending records and stop thread"
+
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+class QueuedHandler(logging.Handler):
+    "Pass records to target handler in writer thread"
+
+    def __init__(self, target, writer):
+        super().__init__(target.level)
+        self.target = target
+        self.writer = writer
+
+    def handle(self, record):
+        # level is checked by target, no lock on event loop
         try:
-            value = record.msg
-            record.msg = LogTypes.text[value]
-            record.log_id = value
-        except Exception as e:
-            pass
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return True
+        self.writer.queue.put((self.target, record))
         return True
+
+    def prepare(self, record):
+        """Copy of record without args, like QueueHandler.prepare
+
+        Args may be changed by caller before writer thread formats them.
+        Record is shared by handlers, so it is copied.
+        """
+
+        prepare = getattr(self.target, "prepare", None)
+        if prepare is not None:
+            return prepare(record)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def flush(self):
+        self.target.flush()
+
+    def close(self):
+        self.target.close()
+        super().close()
         
+# Binary debug log
+# File starts with MAGIC, then records:
+#   header (kind, time, log_id, level, agent, payload length), payload
+# Kind NAME defines agent (logger) name for agent index, payload is
+# utf-8 name. Kind RECORD payload is pickled (msg, args, exc_text), msg
+# is None for records with log_id, text is in LogTypes. Names are
+# defined again in each rotated file, so every file is readable alone.
+
+MAGIC = b"LRMQLOG1"
+HEADER = struct.Struct("!BdHBHI")
+RECORD = 0
+NAME = 1
+
+class BinaryLogHandler(logging.Handler):
+    "Buffered, size rotated binary debug log"
+
+    def __init__(self, filename, max_bytes = 64 * 1024 * 1024, 
+            backup_count = 3, buffer_size = 256 * 1024):
+        super().__init__()
+        self.filename = filename
+        self.max_bytes = max_bytes # 0 - no rotation
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.agents = {} # logger name -> index in current file
+        self.stream = None
+        self.size = 0
+        self.open()
+
+    def open(self):
+        self.stream = open(self.filename, "wb", buffering = self.buffer_size)
+        self.stream.write(MAGIC)
+        self.size = len(MAGIC)
+        self.agents = {}
+
+    def rotate(self):
+        "Move file to .1, older to .2 and so on"
+
+        self.stream.close()
+        if self.backup_count:
+            for idx in range(self.backup_count - 1, 0, -1):
+                src = "%s.%d" % (self.filename, idx)
+                if os.path.exists(src):
+                    os.replace(src, "%s.%d" % (self.filename, idx + 1))
+            os.replace(self.filename, self.filename + ".1")
+        self.open()
+
+    def agent_index(self, name):
+        idx = self.agents.get(name)
+        if idx is None:
+            idx = len(self.agents)
+            self.agents[name] = idx
+            data = name.encode("utf-8")
+            self.write(HEADER.pack(NAME, 0, 0, 0, idx, len(data)) + data)
+        return idx
+
+    def write(self, data):
+        self.stream.write(data)
+        self.size += len(data)
+
+    def payload(self, record):
+        "Pickled (msg, args, exc_text) of record"
+
+        log_id = getattr(record, "log_id", 0)
+        exc = None
+        if record.exc_info:
+            exc = "".join(traceback.format_exception(*record.exc_info))
+        msg = None if log_id else str(record.msg)
+        try:
+            return pickle.dumps((msg, record.args, exc), protocol = 4)
+        except Exception:
+            return pickle.dumps((msg, repr(record.args), exc), protocol = 4)
+
+    def prepare(self, record):
+        "Copy of record with payload, pickled args can't change later"
+
+        record = copy.copy(record)
+        record.payload = self.payload(record)
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            log_id = getattr(record, "log_id", 0)
+            payload = getattr(record, "payload", None)
+            if payload is None:
+                payload = self.payload(record)
+            if self.max_bytes and self.size + HEADER.size + len(payload) > \
+                    self.max_bytes and self.size > len(MAGIC):
+                self.rotate()
+            agent = self.agent_index(record.name)
+            self.write(HEADER.pack(RECORD, record.created, log_id, 
+                min(record.levelno, 255), agent, len(payload)) + payload)
+            if record.levelno >= logging.ERROR:
+                self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
+
 class LogTypes():
     MARK = 10
 
@@ -55,6 +249,13 @@ class LogTypes():
     HUB_MESSAGE_BADCALL = 152
     HUB_MESSAGE_REMOVED = 153
     HUB_MSG_UNPROCESSED = 154
+    HUB_CALL_TIMEOUT = 155
+    HUB_GROUP_REDISTRIBUTE = 156
+    HUB_STORE_OPEN = 157
+    HUB_RETENTION_OPEN = 158
+    HUB_SHARD_LINK = 159
+    HUB_SHARD_LOST = 160
+    HUB_SHARD_ERROR = 161
     
     # agent 1000 -
     AGENT_PREPARE = 1003
@@ -76,6 +277,8 @@ class LogTypes():
     AGENT_START = 1020
     AGENT_PROC_CREATED = 1021
     AGENT_MSG_LOST = 1022
+    AGENT_LISTEN = 1023
+    AGENT_CONNECTED = 1024
     
     AGENT_EXC_PREPARE = 1100
     AGENT_EXC_NEGOTIATE = 1101
@@ -101,6 +304,13 @@ class LogTypes():
         HUB_MESSAGE_BADCALL: "Message '%s' unknown call check type",
         HUB_MESSAGE_REMOVED: "Message '%s' was removed, msg=%s, opts=%s",
         HUB_MSG_UNPROCESSED: "Message not processed: '%s', msg=%s, opts=%s",
+        HUB_CALL_TIMEOUT: "Call to '%s' timed out, reqid=%s, from '%s'",
+        HUB_GROUP_REDISTRIBUTE: "Agent '%s' left groups, %d messages passed",
+        HUB_STORE_OPEN: "Store '%s' opened, segments=%d, undelivered=%d",
+        HUB_RETENTION_OPEN: "Retention log of '%s' opened, offsets %d-%d",
+        HUB_SHARD_LINK: "Shard %d linked with shard %d",
+        HUB_SHARD_LOST: "Shard %d lost link with shard %d",
+        HUB_SHARD_ERROR: "Shard %d failed on forwarded '%s': %s",
         
         #AGENT_: "Bulk message",
         AGENT_PREPARE: "Prepare agent '%s'",
@@ -122,6 +332,8 @@ class LogTypes():
         AGENT_START: "Start process '%s'",
         AGENT_PROC_CREATED: "Process created",
         AGENT_MSG_LOST: "System message lost: '%s', msg=%s, opts=%s",
+        AGENT_LISTEN: "Agent '%s' listen on '%s'",
+        AGENT_CONNECTED: "Agent '%s' connection from '%s'",
         
         AGENT_EXC_PREPARE: "while preparing",
         AGENT_EXC_NEGOTIATE: "while negotiating",
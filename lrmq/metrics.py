@@ -0,0 +1,137 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Hub metrics
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import collections
+
+def exp_bounds(start, factor, count):
+    "Exponential bucket bounds"
+
+    return [start * factor ** i for i in range(count)]
+
+# 1us .. ~67s
+TIME_BOUNDS = exp_bounds(1e-6, 2, 27)
+# 0, 1, 2, 4 .. 65536 receivers
+COUNT_BOUNDS = [0] + exp_bounds(1, 2, 17)
+
+class Histogram:
+    "Fixed bucket histogram, bucket i counts values <= bounds[i]"
+
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # last is overflow
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        "Upper bound of bucket with q-th value, max for overflow"
+
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for idx, cnt in enumerate(self.counts):
+            seen += cnt
+            if seen >= rank and cnt:
+                if idx < len(self.bounds):
+                    return min(self.bounds[idx], self.max)
+                break
+        return self.max
+
+    def merge(self, other):
+        "Add values of histogram with same bounds"
+
+        for idx, cnt in enumerate(other.counts):
+            self.counts[idx] += cnt
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.total, "max": self.max,
+            "p50": self.percentile(0.5), "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            # overflow bucket has bound None
+            "buckets": [[b, c] for b, c in zip(self.bounds + [None],
+                self.counts) if c]}
+
+# counter key of namespaces over limit
+OTHER_NAMESPACES = "(other)"
+
+class Metrics:
+    "Hub counters and histograms, cheap enough to be always on"
+
+    def __init__(self, max_namespaces = 256):
+        # per agent namespaces like <agentid>/ret come and go
+        self.max_namespaces = max_namespaces
+        self.published = collections.Counter() # namespace -> messages
+        self.delivered = collections.Counter() # namespace -> queue pushes
+        self.fanout = Histogram(COUNT_BOUNDS) # receivers per message
+        self.match_time = Histogram(TIME_BOUNDS) # routing, seconds
+        self.wait_time = Histogram(TIME_BOUNDS) # blocked wait_msg
+        self.rpc_time = Histogram(TIME_BOUNDS) # call to answer
+
+    def count(self, ns, delivered):
+        "Count published message, namespaces over limit share one key"
+
+        published = self.published
+        if ns not in published and len(published) >= self.max_namespaces:
+            ns = OTHER_NAMESPACES
+        published[ns] += 1
+        self.delivered[ns] += delivered
+
+    def merge(self, other):
+        "Add counters and histograms of other hub"
+
+        for ns, cnt in other.published.items():
+            if ns not in self.published and \
+                    len(self.published) >= self.max_namespaces:
+                ns = OTHER_NAMESPACES
+            self.published[ns] += cnt
+        for ns, cnt in other.delivered.items():
+            if ns not in self.published:
+                ns = OTHER_NAMESPACES
+            self.delivered[ns] += cnt
+        self.fanout.merge(other.fanout)
+        self.match_time.merge(other.match_time)
+        self.wait_time.merge(other.wait_time)
+        self.rpc_time.merge(other.rpc_time)
+
+    def snapshot(self):
+        return {"published": dict(self.published),
+            "delivered": dict(self.delivered),
+            "fanout": self.fanout.snapshot(),
+            "match_time": self.match_time.snapshot(),
+            "wait_time": self.wait_time.snapshot(),
+            "rpc_time": self.rpc_time.snapshot()}
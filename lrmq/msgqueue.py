@@ -0,0 +1,307 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Agent message queue
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import heapq
+import itertools
+import collections
+
+class QueueOverflow(Exception):
+    "Queue is full and overflow policy is 'reject'"
+
+def msg_size(name, msg, opts):
+    "Approximate message size in bytes"
+
+    return len(json.dumps([name, msg, opts], ensure_ascii = False,
+        default = repr))
+
+class Envelope:
+    """Message shared by all subscribers
+
+    Must not be changed after creation, encoded forms are cached.
+    """
+
+    __slots__ = ("name", "msg", "opts", "size", "json_body", "json_opts",
+        "bodies", "store_seq")
+
+    def __init__(self, name, msg = None, opts = None):
+        self.name = name
+        self.msg = msg
+        self.opts = opts
+        self.size = None
+        self.json_body = None # '"name", msg'
+        self.json_opts = None # '{opts}' or 'null'
+        self.bodies = None # protocol label -> encoded name and msg
+        self.store_seq = None # sequence number in durable log
+
+    def get_size(self):
+        "Cached message size"
+
+        if self.size is None:
+            try:
+                self.encode_json()
+                self.size = len(self.json_body) + len(self.json_opts)
+            except (TypeError, ValueError):
+                self.size = msg_size(self.name, self.msg, self.opts)
+        return self.size
+
+    def encode_json(self):
+        "Encode once, return (body, opts) JSON bytes"
+
+        if self.json_body is None:
+            self.json_body = json.dumps(self.name, ensure_ascii = False
+                ).encode("utf-8") + b", " + json.dumps(self.msg, 
+                ensure_ascii = False).encode("utf-8")
+            self.json_opts = json.dumps(self.opts, ensure_ascii = False
+                ).encode("utf-8")
+        return self.json_body, self.json_opts
+
+    def encoded(self, label, encode):
+        "Body encoded by encode(name, msg), cached per protocol label"
+
+        if self.bodies is None:
+            self.bodies = {}
+        body = self.bodies.get(label)
+        if body is None:
+            body = self.bodies[label] = encode(self.name, self.msg)
+        return body
+
+    def __repr__(self):
+        return repr((self.name, self.msg, self.opts))
+
+# item states
+QUEUED = 0
+TAKEN = 1
+EXPIRED = 2
+
+class QueueItem:
+    "Queued message, per subscriber part of envelope"
+
+    __slots__ = ("env", "subid", "until", "size", "state")
+
+    def __init__(self, env, subid = None, until = None):
+        self.env = env
+        self.subid = subid
+        self.until = until # loop.time() based deadline
+        self.size = 0
+        self.state = QUEUED
+
+    @property
+    def name(self):
+        return self.env.name
+
+    @property
+    def msg(self):
+        return self.env.msg
+
+    @property
+    def opts(self):
+        "Message options with subscription id"
+
+        opts = self.env.opts
+        if self.subid is None:
+            return opts
+        opts = dict(opts) if opts else {}
+        opts["subid"] = self.subid
+        return opts
+
+    def astuple(self):
+        return (self.env.name, self.env.msg, self.opts)
+
+    def encode_json(self):
+        "JSON bytes of [name, msg, opts], message is encoded only once"
+
+        body, opts = self.env.encode_json()
+        if self.subid is not None:
+            if self.env.opts:
+                opts = opts[:-1] + b', "subid": %d}' % self.subid
+            else:
+                opts = b'{"subid": %d}' % self.subid
+        return b"[" + body + b", " + opts + b"]"
+
+    def isexpired(self, now):
+        return self.until is not None and self.until <= now
+
+    def __repr__(self):
+        return repr(self.astuple())
+
+def plain_item(obj):
+    "Convert queue item for generic encoders"
+
+    if isinstance(obj, QueueItem):
+        return obj.astuple()
+    raise TypeError("Object of type %s is not serializable" % 
+        type(obj).__name__)
+
+def plain_answer(ans):
+    "Replace queue items in answer with tuples"
+
+    if "msgs" in ans:
+        ans = dict(ans)
+        ans["msgs"] = [x.astuple() if isinstance(x, QueueItem) else x
+            for x in ans["msgs"]]
+    if "answers" in ans:
+        ans = dict(ans)
+        ans["answers"] = [plain_answer(x) for x in ans["answers"]]
+    return ans
+
+class MsgQueue:
+    """Bounded FIFO message queue
+
+    Items with deadline are also kept in heap, expired items are marked
+    and skipped on dequeue, so expiration costs O(expired).
+    """
+
+    policies = ("drop_oldest", "drop_newest", "reject")
+
+    def __init__(self, max_msgs = None, max_bytes = None,
+            overflow = "drop_oldest"):
+        self.items = collections.deque()
+        self.live = 0 # items in queue except expired
+        self.nbytes = 0
+        self.deadlines = [] # heap (until, seq, item)
+        self.seq = itertools.count()
+        # counters
+        self.dropped = 0
+        self.rejected = 0
+        self.expired = 0
+        self.configure(max_msgs, max_bytes, overflow)
+
+    def configure(self, max_msgs = None, max_bytes = None,
+            overflow = "drop_oldest"):
+        "Set queue limits"
+
+        if overflow not in self.policies:
+            raise Exception("Unknown overflow policy '%s'" % overflow)
+        self.max_msgs = max_msgs or None
+        self.max_bytes = max_bytes or None
+        self.overflow = overflow
+
+    def __len__(self):
+        return self.live
+
+    def queued_bytes(self):
+        "Size of queued messages, counted on demand without byte limit"
+
+        if self.max_bytes is not None:
+            return self.nbytes
+        return sum(x.env.get_size() for x in self.items if x.state == QUEUED)
+
+    def isfull(self, size):
+        "Check if item with size can't be added"
+
+        if self.max_msgs is not None and self.live >= self.max_msgs:
+            return True
+        if self.max_bytes is not None and self.live and \
+                self.nbytes + size > self.max_bytes:
+            return True
+        return False
+
+    def rejects(self, env, count = 1):
+        "Check if reject policy refuses count copies of envelope"
+
+        if self.overflow != "reject":
+            return False
+        if self.max_msgs is not None and self.live + count > self.max_msgs:
+            return True
+        if self.max_bytes is not None and (self.live or count > 1) and \
+                self.nbytes + count * env.get_size() > self.max_bytes:
+            return True
+        return False
+
+    def push(self, item):
+        "Add item, return list of dropped items"
+
+        if self.max_bytes is not None:
+            item.size = item.env.get_size()
+        dropped = []
+        if self.isfull(item.size):
+            if self.overflow == "reject":
+                self.rejected += 1
+                raise QueueOverflow("Queue is full")
+            elif self.overflow == "drop_newest":
+                self.dropped += 1
+                return [item]
+            while self.live and self.isfull(item.size):
+                dropped.append(self.pop())
+            self.dropped += len(dropped)
+        self.items.append(item)
+        self.live += 1
+        self.nbytes += item.size
+        if item.until is not None:
+            heapq.heappush(self.deadlines, (item.until, next(self.seq), item))
+        return dropped
+
+    def pop(self):
+        "Get next item or None"
+
+        items = self.items
+        while items:
+            item = items.popleft()
+            if item.state == QUEUED:
+                item.state = TAKEN
+                self.live -= 1
+                self.nbytes -= item.size
+                return item
+        return None
+
+    def remove(self, match):
+        "Take queued items for which match(item) is true, keep order"
+
+        removed = []
+        kept = collections.deque()
+        for item in self.items:
+            if item.state != QUEUED:
+                continue
+            if match(item):
+                item.state = TAKEN
+                self.live -= 1
+                self.nbytes -= item.size
+                removed.append(item)
+            else:
+                kept.append(item)
+        self.items = kept
+        return removed
+
+    def expire(self, now):
+        "Remove items with deadline before now, return them"
+
+        expired = []
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            item = heapq.heappop(deadlines)[2]
+            if item.state == QUEUED:
+                item.state = EXPIRED
+                self.live -= 1
+                self.nbytes -= item.size
+                expired.append(item)
+        self.expired += len(expired)
+        # drop marked items if they take most of queue or heap
+        if len(self.items) > 64 and len(self.items) > 2 * self.live:
+            self.items = collections.deque(
+                x for x in self.items if x.state == QUEUED)
+        if len(deadlines) > 64 and len(deadlines) > 2 * self.live:
+            self.deadlines = [x for x in deadlines if x[2].state == QUEUED]
+            heapq.heapify(self.deadlines)
+        return expired
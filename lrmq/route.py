@@ -0,0 +1,231 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Subscription routing table
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import re
+import functools
+
+# Message names look like "namespace/name/...". Masks are either regular
+# expressions (matched with re.match, as before) or glob patterns:
+#   *  - exactly one name segment
+#   ** - any number of trailing segments (only at the end)
+#
+# Regular expressions with a literal "namespace/" prefix are indexed by
+# namespace, glob patterns are compiled into a segment trie, everything
+# else goes to residual list and is checked one by one.
+
+# characters which can be safely treated as literal in regexp prefix
+_literal_chars = re.compile(r"[A-Za-z0-9_\-<>@:,;=!%&~' ]*")
+
+def regex_namespace(pattern):
+    "Return literal namespace of regular expression or None"
+
+    if "|" in pattern:
+        # alternation may escape prefix
+        return None
+    m = _literal_chars.match(pattern)
+    ns = m.group(0)
+    if pattern[len(ns):len(ns) + 1] != "/":
+        return None
+    if pattern[len(ns) + 1:len(ns) + 2] in ("?", "*", "+", "{"):
+        # quantified separator
+        return None
+    return ns
+
+class GlobMask:
+    "Glob style mask"
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.parts = pattern.split("/")
+        for idx, part in enumerate(self.parts):
+            if part == "**" and idx != len(self.parts) - 1:
+                raise Exception("'**' allowed only at the end of mask")
+            if part not in ("*", "**") and "*" in part:
+                raise Exception("Partial segment wildcards are not supported")
+
+    def match(self, name):
+        "Check name, compatible with regexp objects"
+
+        parts = name.split("/")
+        for idx, part in enumerate(self.parts):
+            if part == "**":
+                return True
+            if idx >= len(parts):
+                return False
+            if part != "*" and part != parts[idx]:
+                return False
+        return len(parts) == len(self.parts)
+
+    def __repr__(self):
+        return "GlobMask(%r)" % self.pattern
+
+def compile_mask(mask, syntax = "re"):
+    "Compile mask string to matcher object, equal masks share one object"
+
+    if not isinstance(mask, str):
+        raise Exception("Mask must be string")
+    if not isinstance(syntax, str):
+        raise Exception("Unknown mask syntax '%s'" % syntax)
+    return _compile_mask(mask, syntax)
+
+@functools.lru_cache(maxsize = 4096)
+def _compile_mask(mask, syntax):
+    "Cached compile_mask, arguments are checked by caller"
+
+    if syntax == "re":
+        return re.compile(mask)
+    elif syntax == "glob":
+        return GlobMask(mask)
+    raise Exception("Unknown mask syntax '%s'" % syntax)
+
+class TrieNode:
+    "Glob trie node"
+
+    __slots__ = ("children", "star", "subids", "tail")
+
+    def __init__(self):
+        self.children = {}
+        self.star = None # "*" child
+        self.subids = set() # complete match
+        self.tail = set() # "**" match
+
+    def isempty(self):
+        return not (self.children or self.star or self.subids or self.tail)
+
+class RouteTable:
+    "Subscription index: name -> subids"
+
+    def __init__(self):
+        self.namespaces = {} # ns -> {subid: regexp}
+        self.trie = TrieNode()
+        self.residual = {} # subid -> regexp
+        self.where = {} # subid -> (kind, key)
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, mask, subid):
+        "Add compiled mask"
+
+        if isinstance(mask, GlobMask):
+            node = self.trie
+            for part in mask.parts:
+                if part == "**":
+                    node.tail.add(subid)
+                    break
+                if part == "*":
+                    if node.star is None:
+                        node.star = TrieNode()
+                    node = node.star
+                else:
+                    node = node.children.setdefault(part, TrieNode())
+            else:
+                node.subids.add(subid)
+            self.where[subid] = ("glob", mask.parts)
+            return
+        ns = None
+        if not (mask.flags & re.IGNORECASE):
+            ns = regex_namespace(mask.pattern)
+        if ns is None:
+            self.residual[subid] = mask
+            self.where[subid] = ("re", None)
+        else:
+            self.namespaces.setdefault(ns, {})[subid] = mask
+            self.where[subid] = ("ns", ns)
+
+    def mask(self, subid):
+        "Compiled mask by subid"
+
+        kind, key = self.where[subid]
+        if kind == "re":
+            return self.residual[subid]
+        elif kind == "ns":
+            return self.namespaces[key][subid]
+        return GlobMask("/".join(key))
+
+    def remove(self, subid):
+        "Remove mask by subid"
+
+        kind, key = self.where.pop(subid)
+        if kind == "re":
+            del self.residual[subid]
+        elif kind == "ns":
+            masks = self.namespaces[key]
+            del masks[subid]
+            if not masks:
+                del self.namespaces[key]
+        else:
+            self._trie_remove(self.trie, key, subid)
+
+    def _trie_remove(self, node, parts, subid):
+        "Remove subid from trie, drop empty nodes"
+
+        part = parts[0]
+        if part == "**":
+            node.tail.discard(subid)
+            return
+        if part == "*":
+            child = node.star
+        else:
+            child = node.children.get(part)
+        if child is None:
+            return
+        if len(parts) == 1:
+            child.subids.discard(subid)
+        else:
+            self._trie_remove(child, parts[1:], subid)
+        if child.isempty():
+            if part == "*":
+                node.star = None
+            else:
+                del node.children[part]
+
+    def match(self, name):
+        "Return sorted list of subids matched to name"
+
+        found = []
+        ns = name.split("/", 1)[0]
+        masks = self.namespaces.get(ns)
+        if masks:
+            found += [subid for subid, mask in masks.items()
+                if mask.match(name)]
+        if self.trie.children or self.trie.star or self.trie.tail:
+            self._trie_match(self.trie, name.split("/"), 0, found)
+        if self.residual:
+            found += [subid for subid, mask in self.residual.items()
+                if mask.match(name)]
+        # keep subscription order
+        found.sort()
+        return found
+
+    def _trie_match(self, node, parts, idx, found):
+        found += node.tail
+        if idx == len(parts):
+            found += node.subids
+            return
+        child = node.children.get(parts[idx])
+        if child is not None:
+            self._trie_match(child, parts, idx + 1, found)
+        if node.star is not None:
+            self._trie_match(node.star, parts, idx + 1, found)
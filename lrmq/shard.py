@@ -0,0 +1,600 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Sharded hub
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+import array
+import pickle
+import shutil
+import signal
+import socket
+import struct
+import asyncio
+import tempfile
+import itertools
+import collections
+import multiprocessing
+
+from .hub import Hub
+from .agent import Agent, AgentListener, AgentSocket
+from .route import GlobMask
+from .logs import LogTypes
+from .metrics import Metrics
+
+# Hub shards are processes with own event loop and hub. Every shard
+# listens "peer-<index>.sock" in shard directory, shard connects to all
+# shards with lower index, so each pair has one link. Link frames are
+# 4 byte length and pickled tuple:
+#   ("hello", index) - first frame of connecting shard
+#   ("sub", syntax, pattern, flags, group, rpc) - shard has subscribers
+#   ("unsub", syntax, pattern, flags, group, rpc) - last subscriber gone
+#   ("msg", name, msg, opts, groups, server) - message for remote
+#       subscribers, server is set if other shard executes call
+#   ("query", qid, func) - shard 0 asks for "stats" or "call_stats"
+#   ("reply", qid, result) - answer of query
+# Remote subscriptions are hub subscriptions of ShardPeer agent, or of
+# its ShardObserver for subscribers which are not RPC servers, so
+# routing, groups and RPC balancing see other shard as one subscriber.
+# Keyed group messages are refused, partition owners would differ
+# between shards.
+# Listeners run in shard 0, accepted sockets are passed round robin to
+# workers over "handoff-<index>.sock" datagram sockets.
+# System RPC is served by shard 0, counters of workers are queried over
+# links and summed.
+
+FRAME = struct.Struct("!I")
+
+def encode_frame(rec):
+    data = pickle.dumps(rec, protocol = pickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(data)) + data
+
+async def read_frame(reader):
+    "Read link frame, None on end of stream"
+
+    try:
+        head = await reader.readexactly(FRAME.size)
+        data = await reader.readexactly(FRAME.unpack(head)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return pickle.loads(data)
+
+def mask_key(mask, group, rpc):
+    "Replicated subscription key"
+
+    if isinstance(mask, GlobMask):
+        return ("glob", mask.pattern, 0, group, rpc)
+    return ("re", mask.pattern, mask.flags, group, rpc)
+
+class ShardPeer(Agent):
+    "Link to other shard, subscriber for its agents"
+
+    def __init__(self, node, index, reader, writer):
+        self.index = index
+        super().__init__(node.hub, "shard-%d" % index)
+        self.node = node
+        self.reader = reader
+        self.writer = writer
+        self.isshard = True
+        self.isrpc = True
+        self.remote_subs = {} # key -> local subid
+        self.pending = [] # frames and [env, groups, server] to write
+        self.forward_groups = None # groups of message in process
+        self.forward_server = False # call of message in process is ours
+        self.observer = ShardObserver(self)
+        self.sent = 0
+        self.received = 0
+
+    def getid(self):
+        return "shard-%d" % self.index
+
+    async def run(self):
+        "Process frames until link is closed"
+
+        try:
+            while self.isloop:
+                rec = await read_frame(self.reader)
+                if rec is None:
+                    break
+                self.node.process(self, rec)
+        finally:
+            self.isloop = False
+            self.observer.isloop = False
+            self.node.link_lost(self)
+
+    def push_msg(self, name, msg = None, opts = None):
+        "Pulses are local to shard"
+
+    def push_pulse(self, env):
+        "Pulses are local to shard"
+
+    def push_envelope(self, env, subid = None, until = None, server = True):
+        "Forward message once per link with groups selected here"
+
+        group = self.hub.sub_groups.get(subid)
+        pending = self.pending
+        if pending and pending[-1][0] is env:
+            if group is not None:
+                pending[-1][1].append(group)
+            pending[-1][2] = pending[-1][2] or server
+            return
+        if not pending:
+            self.hub.loop.call_soon(self.flush_out)
+        pending.append([env, [] if group is None else [group], server])
+
+    def send(self, rec):
+        "Queue control frame after already forwarded messages"
+
+        if not self.pending:
+            self.hub.loop.call_soon(self.flush_out)
+        self.pending.append(encode_frame(rec))
+
+    def flush_out(self):
+        "Write all pending frames at once"
+
+        pending, self.pending = self.pending, []
+        if not self.isloop:
+            return
+        out = bytearray()
+        for item in pending:
+            if isinstance(item, bytes):
+                out += item
+            else:
+                env = item[0]
+                out += encode_frame(("msg", env.name, env.msg, env.opts,
+                    item[1], item[2]))
+                self.sent += 1
+        self.writer.write(out)
+
+class ShardObserver(Agent):
+    "Subscriber for remote agents which are not RPC servers"
+
+    def __init__(self, peer):
+        super().__init__(peer.hub, "shard-%d-observer" % peer.index, 
+            peer.logger)
+        self.peer = peer
+        self.isshard = True
+
+    def getid(self):
+        return "shard-%d-observer" % self.peer.index
+
+    def push_msg(self, name, msg = None, opts = None):
+        "Pulses are local to shard"
+
+    def push_pulse(self, env):
+        "Pulses are local to shard"
+
+    def push_envelope(self, env, subid = None, until = None):
+        "Copy of call is not executed by other shard"
+
+        self.peer.push_envelope(env, subid, until, server = False)
+
+class ShardNode:
+    "Shard of hub, keeps links to other shards"
+
+    def __init__(self, hub, index, count, path):
+        self.hub = hub
+        self.index = index
+        self.count = count
+        self.path = path # directory of shard sockets
+        self.peers = {} # index -> ShardPeer
+        self.keys = {} # local subid -> key
+        self.refs = collections.Counter() # key -> local subscriptions
+        self.server = None
+        self.handoff_sock = None
+        self.handoffs = 0 # connections passed to workers
+        self.conn_rr = 0
+        self.listeners = {} # name -> AgentListener, workers only
+        self.tasks = set() # link tasks
+        self.queries = {} # qid -> future of reply
+        self.qids = itertools.count()
+        hub.shard = self
+
+    def peer_path(self, index):
+        return os.path.join(self.path, "peer-%d.sock" % index)
+
+    def handoff_path(self, index):
+        return os.path.join(self.path, "handoff-%d.sock" % index)
+
+    def shard_config(self, cfg):
+        "Hub config of this shard"
+
+        cfg = dict(cfg)
+        agents = []
+        for acfg in cfg.get("agents", []) \
+                if cfg.get("load_mode", "config") == "config" else []:
+            if acfg.get("type") in ("unix", "tcp"):
+                if self.index == 0:
+                    agents.append(acfg)
+                else:
+                    # accepts nothing, used by passed connections
+                    self.listeners[acfg.get("name")] = \
+                        AgentListener(self.hub, acfg)
+            elif acfg.get("shard", 0) == self.index:
+                agents.append(acfg)
+        if self.index == 0:
+            return cfg
+        cfg["load_mode"] = "config"
+        cfg["agents"] = agents
+        # shard 0 keeps retention logs, workers forward to it
+        cfg.pop("retention", None)
+        if cfg.get("store"):
+            cfg["store"] = dict(cfg["store"], path = os.path.join(
+                cfg["store"]["path"], "shard-%d" % self.index))
+        if cfg.get("debuglogger"):
+            cfg["debuglogger"] = "%s.shard-%d" % (cfg["debuglogger"],
+                self.index)
+        return cfg
+
+    async def start(self):
+        "Listen and link with shards of lower index"
+
+        hub = self.hub
+        if self.index:
+            # system RPC is served by shard 0
+            for subid in hub.sysagent.subs:
+                hub.unsubscribe(subid)
+            hub.sysagent.subs = []
+            self.handoff_sock = socket.socket(socket.AF_UNIX, 
+                socket.SOCK_DGRAM)
+            self.handoff_sock.bind(self.handoff_path(self.index))
+            self.handoff_sock.setblocking(False)
+            hub.loop.add_reader(self.handoff_sock, self.recv_handoff)
+        else:
+            for ns in hub.topic_logs:
+                # messages of retained namespaces are logged here
+                self.sub_added(("retention", ns), 
+                    re.compile(re.escape(ns) + "/.*"), None, False)
+        for subid, a in list(hub.subs.items()):
+            if not a.isshard and subid not in self.keys:
+                self.sub_added(subid, hub.routes.mask(subid), 
+                    hub.sub_groups.get(subid), a.isrpc)
+        self.server = await asyncio.start_unix_server(self.accept_peer,
+            path = self.peer_path(self.index))
+        for index in range(self.index):
+            reader, writer = await self.connect(self.peer_path(index))
+            writer.write(encode_frame(("hello", self.index)))
+            peer = self.link(index, reader, writer)
+            if index == 0:
+                # worker lives while shard 0 is linked
+                hub.pending_agents.append(peer)
+            else:
+                task = asyncio.ensure_future(peer.run())
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def connect(self, path, timeout = 30):
+        "Connect to shard socket, wait while shard starts"
+
+        until = self.hub.loop.time() + timeout
+        while True:
+            try:
+                return await asyncio.open_unix_connection(path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self.hub.loop.time() > until:
+                    raise
+                await asyncio.sleep(0.05)
+
+    async def accept_peer(self, reader, writer):
+        "Link from shard of higher index"
+
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            rec = await read_frame(reader)
+            if not rec or rec[0] != "hello":
+                writer.close()
+                return
+            await self.link(rec[1], reader, writer).run()
+        except asyncio.CancelledError:
+            # shard is closing
+            pass
+        finally:
+            self.tasks.discard(task)
+
+    def link(self, index, reader, writer):
+        "Register link, send subscriptions of this shard"
+
+        peer = ShardPeer(self, index, reader, writer)
+        self.peers[index] = peer
+        for key in self.refs:
+            peer.send(("sub",) + key)
+        self.hub.logger.info(LogTypes.HUB_SHARD_LINK, self.index, index)
+        return peer
+
+    def link_lost(self, peer):
+        "Drop subscriptions of lost shard"
+
+        if self.peers.get(peer.index) is peer:
+            del self.peers[peer.index]
+        self.hub.logger.info(LogTypes.HUB_SHARD_LOST, self.index, 
+            peer.index)
+        for subid in peer.remote_subs.values():
+            self.hub.unsubscribe(subid)
+        peer.remote_subs = {}
+        peer.writer.close()
+        if peer.index == 0 and self.index:
+            # hub is stopping, close passed connections
+            for a in self.hub.working_agents + self.hub.pending_agents:
+                if isinstance(a, AgentSocket):
+                    a.writer.close()
+
+    def process(self, peer, rec):
+        "Apply frame from other shard"
+
+        hub = self.hub
+        kind = rec[0]
+        if kind == "msg":
+            peer.received += 1
+            peer.forward_groups = rec[4]
+            peer.forward_server = rec[5]
+            try:
+                hub.push_msg(peer, rec[1], rec[2], rec[3])
+            except Exception as e:
+                # late answer or no subscribers left
+                self.hub.logger.debug(LogTypes.HUB_SHARD_ERROR, self.index, 
+                    rec[1], str(e))
+            finally:
+                peer.forward_groups = None
+                peer.forward_server = False
+        elif kind == "sub":
+            key = rec[1:]
+            syntax, pattern, flags, group, rpc = key
+            if syntax == "glob":
+                mask = GlobMask(pattern)
+            else:
+                mask = re.compile(pattern, flags)
+            peer.remote_subs[key] = hub.subscribe(mask, 
+                peer if rpc else peer.observer, group)
+        elif kind == "unsub":
+            subid = peer.remote_subs.pop(rec[1:], None)
+            if subid is not None:
+                hub.unsubscribe(subid)
+        elif kind == "query":
+            if rec[2] == "stats":
+                ret = (hub.stats(), hub.metrics)
+            elif rec[2] == "call_stats":
+                ret = hub.call_stats()
+            else:
+                ret = None
+            peer.send(("reply", rec[1], ret))
+        elif kind == "reply":
+            fut = self.queries.get(rec[1])
+            if fut is not None and not fut.done():
+                fut.set_result(rec[2])
+
+    def sub_added(self, subid, mask, group, rpc):
+        "Local subscription, announce first one of key"
+
+        key = mask_key(mask, group, rpc)
+        self.keys[subid] = key
+        self.refs[key] += 1
+        if self.refs[key] == 1:
+            for peer in self.peers.values():
+                peer.send(("sub",) + key)
+
+    def sub_removed(self, subid):
+        "Local unsubscription, announce if key is not used"
+
+        key = self.keys.pop(subid, None)
+        if key is None:
+            return
+        self.refs[key] -= 1
+        if self.refs[key] <= 0:
+            del self.refs[key]
+            for peer in self.peers.values():
+                peer.send(("unsub",) + key)
+
+    def handoff(self, listener, writer, cid):
+        "Pass accepted connection to worker, False to keep it here"
+
+        index = self.conn_rr % self.count
+        self.conn_rr += 1
+        if index == 0 or index not in self.peers:
+            return False
+        sock = writer.get_extra_info('socket')
+        if self.handoff_sock is None:
+            self.handoff_sock = socket.socket(socket.AF_UNIX, 
+                socket.SOCK_DGRAM)
+            self.handoff_sock.setblocking(False)
+        try:
+            self.handoff_sock.sendmsg([pickle.dumps((listener.name, cid))],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS, 
+                array.array("i", [sock.fileno()]))], 0, 
+                self.handoff_path(index))
+        except OSError:
+            # worker is busy or gone
+            return False
+        # worker has own descriptor of connection
+        writer.transport.abort()
+        self.handoffs += 1
+        return True
+
+    def recv_handoff(self):
+        "Start agents of connections passed by shard 0"
+
+        fdsize = array.array("i").itemsize
+        while True:
+            try:
+                data, anc, flags, addr = self.handoff_sock.recvmsg(1024,
+                    socket.CMSG_SPACE(fdsize))
+            except (BlockingIOError, InterruptedError):
+                return
+            fds = array.array("i")
+            for level, kind, cdata in anc:
+                if level == socket.SOL_SOCKET and \
+                        kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cdata[:len(cdata) - len(cdata) % fdsize])
+            name, cid = pickle.loads(data)
+            for fd in fds:
+                asyncio.ensure_future(self.adopt(name, cid, 
+                    socket.socket(fileno = fd)))
+
+    async def adopt(self, name, cid, sock):
+        "Agent of passed connection"
+
+        sock.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock = sock)
+        a = AgentSocket(self.hub, self.listeners[name], reader, writer, cid)
+        self.hub.pending_agents.append(a)
+        self.hub.signal()
+
+    def stats(self):
+        "Shard counters"
+
+        return {"index": self.index, "count": self.count,
+            "handoffs": self.handoffs,
+            "peers": {str(index): {"subs": len(peer.remote_subs),
+                "sent": peer.sent, "received": peer.received}
+                for index, peer in self.peers.items()}}
+
+    async def query(self, func, timeout = 5):
+        "Ask linked shards, return index -> result of answered ones"
+
+        futs = {}
+        for index, peer in self.peers.items():
+            qid = next(self.qids)
+            fut = self.hub.loop.create_future()
+            self.queries[qid] = fut
+            futs[index] = (qid, fut)
+            peer.send(("query", qid, func))
+        if futs:
+            await asyncio.wait([x[1] for x in futs.values()], 
+                timeout = timeout)
+        ret = {}
+        for index, (qid, fut) in futs.items():
+            del self.queries[qid]
+            if fut.done():
+                ret[index] = fut.result()
+        return ret
+
+    async def total_call_stats(self):
+        "RPC call counters summed over shards"
+
+        total = self.hub.call_stats()
+        for ret in (await self.query("call_stats")).values():
+            for key, value in ret.items():
+                total[key] += value
+        return total
+
+    async def total_stats(self):
+        "Hub stats with counters of all shards, agents of all shards"
+
+        hub = self.hub
+        stats = hub.stats()
+        metrics = Metrics(hub.metrics.max_namespaces)
+        metrics.merge(hub.metrics)
+        shards = {}
+        for index, (wstats, wmetrics) in sorted(
+                (await self.query("stats")).items()):
+            metrics.merge(wmetrics)
+            stats["agents"].update(wstats["agents"])
+            for key, value in wstats["calls"].items():
+                stats["calls"][key] += value
+            # not summable, kept per shard
+            shards[str(index)] = {key: wstats[key] for key in 
+                ("route_cache", "store", "shard") if key in wstats}
+        stats.update(metrics.snapshot())
+        stats["shards"] = shards
+        return stats
+
+    async def close(self):
+        "Close links, workers stop on loss of shard 0"
+
+        for peer in list(self.peers.values()):
+            peer.flush_out()
+            peer.writer.close()
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions = True)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            os.unlink(self.peer_path(self.index))
+            self.server = None
+        if self.handoff_sock is not None:
+            if self.index:
+                self.hub.loop.remove_reader(self.handoff_sock)
+                os.unlink(self.handoff_path(self.index))
+            self.handoff_sock.close()
+            self.handoff_sock = None
+
+def run_shard(cfg, index, count, path):
+    "Run hub shard in current process, return exit code"
+
+    if index:
+        # stopped by shard 0, terminal interrupt is for it
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    hub = Hub()
+    node = ShardNode(hub, index, count, path)
+    hub.load_config(node.shard_config(cfg))
+    try:
+        loop.run_until_complete(node.start())
+        loop.run_until_complete(hub.main_loop())
+        loop.run_until_complete(node.close())
+    finally:
+        loop.close()
+    hub.cleanup()
+    return hub.exit_code
+
+def start_workers(cfg, count, path):
+    "Start worker shards 1..count-1 as processes"
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target = run_shard, args = (cfg, index, count,
+        path), name = "lrmq-shard-%d" % index) for index in range(1, count)]
+    for w in workers:
+        w.start()
+    return workers
+
+def stop_workers(workers, timeout = 10):
+    "Wait for workers, they exit after shard 0 is closed"
+
+    for w in workers:
+        w.join(timeout)
+        if w.is_alive():
+            w.terminate()
+            w.join()
+
+def run_sharded(cfg):
+    "Run hub of cfg['shards'] processes, return exit code of shard 0"
+
+    if not hasattr(socket, "AF_UNIX"):
+        raise Exception("Sharded hub requires unix domain sockets")
+    count = cfg["shards"]
+    path = tempfile.mkdtemp(prefix = "lrmq-shard-")
+    workers = start_workers(cfg, count, path)
+    try:
+        return run_shard(cfg, 0, count, path)
+    except BaseException:
+        # links are not closed, workers will not stop by themselves
+        for w in workers:
+            w.terminate()
+        raise
+    finally:
+        stop_workers(workers)
+        shutil.rmtree(path, ignore_errors = True)
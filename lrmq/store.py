@@ -0,0 +1,282 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Durable message log
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import pickle
+import struct
+import asyncio
+
+# Log is a directory of segment files "<first seq>.log". Records are
+# length prefixed pickled tuples:
+#   ("put", seq, name, msg, opts, [target, ...]) - message for agents
+#   ("add", seq, target) - message moved to other agent
+#   ("ack", seq, target) - message left agent queue
+# Targets are durable agent names. Segment is deleted when all its
+# messages and messages of older segments are acknowledged by all
+# targets (acks may refer to older segments).
+
+class Store:
+    "Durable segmented message log with group commit"
+
+    def __init__(self, loop, path, segment_bytes = 16 * 1024 * 1024,
+            commit_interval = 0.005, commit_bytes = 1024 * 1024):
+        self.loop = loop
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval # max delay before fsync
+        self.commit_bytes = commit_bytes # fsync earlier if more pending
+        self.seq = 0
+        self.live = {} # seq -> [name, msg, opts, targets]
+        self.where = {} # seq -> segment
+        self.pending = set() # seqs of buffered puts, segment not known
+        self.seg_live = {} # segment -> live message count
+        self.segments = [] # in order, last is active
+        self.f = None # active segment file
+        self.fsize = 0
+        self.buf = bytearray() # records not written yet
+        self.commit_fut = None # done when buf is on disk
+        self.commit_timer = None
+        self.committing = None # write task in executor
+        # counters
+        self.commits = 0
+        self.written = 0
+
+    def open(self):
+        "Read existing segments, start new active one"
+
+        os.makedirs(self.path, exist_ok = True)
+        names = sorted(x for x in os.listdir(self.path)
+            if x.endswith(".log"))
+        for seg in names:
+            self.seg_live[seg] = 0
+            self.segments.append(seg)
+            with open(os.path.join(self.path, seg), "r+b") as f:
+                good = 0
+                for rec in read_records(f):
+                    self.replay(seg, rec)
+                    good = f.tell()
+                if f.seek(0, os.SEEK_END) > good:
+                    # drop torn tail, new records may be appended here
+                    f.truncate(good)
+        self.new_segment()
+        self.compact()
+        return len(names)
+
+    def replay(self, seg, rec):
+        "Apply record during recovery"
+
+        kind, seq = rec[0], rec[1]
+        if kind == "put":
+            self.seq = max(self.seq, seq + 1)
+            self.live[seq] = [rec[2], rec[3], rec[4], set(rec[5])]
+            self.where[seq] = seg
+            self.seg_live[seg] += 1
+        elif seq in self.live:
+            targets = self.live[seq][3]
+            if kind == "add":
+                targets.add(rec[2])
+            elif kind == "ack":
+                targets.discard(rec[2])
+                if not targets:
+                    self.forget(seq)
+
+    def recovered(self):
+        "Return {target: [(seq, name, msg, opts)]} of undelivered messages"
+
+        queues = {}
+        for seq in sorted(self.live):
+            name, msg, opts, targets = self.live[seq]
+            for target in targets:
+                queues.setdefault(target, []).append((seq, name, msg, opts))
+        return queues
+
+    def new_segment(self):
+        "Start new active segment"
+
+        if self.f is not None:
+            self.f.close()
+        seg = "%016d.log" % self.seq
+        self.f = open(os.path.join(self.path, seg), "ab")
+        self.fsize = self.f.tell()
+        if seg not in self.seg_live:
+            self.seg_live[seg] = 0
+            self.segments.append(seg)
+
+    def compact(self):
+        "Delete leading fully acknowledged segments, except active one"
+
+        while len(self.segments) > 1 and not self.seg_live[self.segments[0]]:
+            seg = self.segments.pop(0)
+            del self.seg_live[seg]
+            try:
+                os.remove(os.path.join(self.path, seg))
+            except OSError:
+                pass
+
+    def forget(self, seq):
+        "Message delivered to all targets"
+
+        del self.live[seq]
+        seg = self.where.pop(seq, None)
+        if seg is None:
+            self.pending.discard(seq)
+            return
+        self.seg_live[seg] -= 1
+        if not self.seg_live[seg] and seg == self.segments[0]:
+            self.compact()
+
+    def put(self, name, msg, opts, targets):
+        "Append message, return (seq, future of commit)"
+
+        seq = self.seq
+        self.seq += 1
+        self.live[seq] = [name, msg, opts, set(targets)]
+        self.pending.add(seq)
+        return seq, self.append(("put", seq, name, msg, opts, list(targets)))
+
+    def add(self, seq, target):
+        "Message passed to other target"
+
+        entry = self.live.get(seq)
+        if entry is not None and target not in entry[3]:
+            entry[3].add(target)
+            self.append(("add", seq, target))
+
+    def ack(self, seq, target):
+        "Message left target queue"
+
+        entry = self.live.get(seq)
+        if entry is not None and target in entry[3]:
+            entry[3].discard(target)
+            self.append(("ack", seq, target))
+            if not entry[3]:
+                self.forget(seq)
+
+    def append(self, rec):
+        "Buffer record, return future of its commit"
+
+        data = pickle.dumps(rec, protocol = 4)
+        self.buf += struct.pack(">L", len(data)) + data
+        if self.commit_fut is None:
+            self.commit_fut = self.loop.create_future()
+        fut = self.commit_fut
+        if not self.committing:
+            if len(self.buf) >= self.commit_bytes:
+                self.start_commit()
+            elif self.commit_timer is None:
+                self.commit_timer = self.loop.call_later(
+                    self.commit_interval, self.start_commit)
+        return fut
+
+    def start_commit(self):
+        "Write and fsync pending records in executor"
+
+        if self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
+        if self.committing or not self.buf:
+            return
+        data, self.buf = bytes(self.buf), bytearray()
+        fut, self.commit_fut = self.commit_fut, None
+        # buffered puts go to active segment
+        seg = self.segments[-1]
+        for seq in self.pending:
+            self.where[seq] = seg
+        self.seg_live[seg] += len(self.pending)
+        self.pending = set()
+        task = self.loop.run_in_executor(None, self.write_sync, self.f, data)
+        self.committing = task
+        task.add_done_callback(lambda task: self.commit_done(task, fut,
+            len(data)))
+
+    def write_sync(self, f, data):
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def commit_done(self, task, fut, size):
+        "Records are on disk, wake publishers"
+
+        self.committing = None
+        self.commits += 1
+        self.written += size
+        self.fsize += size
+        exc = task.exception()
+        if not fut.done():
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(True)
+        if self.fsize >= self.segment_bytes:
+            self.new_segment()
+            self.compact()
+        if self.buf:
+            if len(self.buf) >= self.commit_bytes:
+                self.start_commit()
+            else:
+                self.commit_timer = self.loop.call_later(
+                    self.commit_interval, self.start_commit)
+
+    async def close(self):
+        "Commit pending records and close"
+
+        if self.f is None:
+            return
+        while self.committing or self.buf:
+            if not self.committing:
+                self.start_commit()
+            try:
+                await self.committing
+            except Exception:
+                pass
+            # let commit_done run
+            await asyncio.sleep(0)
+        if self.commit_timer is not None:
+            self.commit_timer.cancel()
+            self.commit_timer = None
+        self.f.close()
+        self.f = None
+
+    def stats(self):
+        "Store counters"
+
+        return {"live": len(self.live), "segments": len(self.segments),
+            "commits": self.commits, "written": self.written}
+
+def read_records(f):
+    "Read records of segment, stop at truncated tail"
+
+    while True:
+        head = f.read(4)
+        if len(head) < 4:
+            return
+        size = struct.unpack(">L", head)[0]
+        data = f.read(size)
+        if len(data) < size:
+            return
+        try:
+            yield pickle.loads(data)
+        except Exception:
+            # partially written record
+            return
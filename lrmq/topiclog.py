@@ -0,0 +1,326 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# Namespace retention log
+# Copyright (c) 2016 Roman Kharin <romiq.kh@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import json
+import mmap
+import time
+import bisect
+import struct
+
+from .msgqueue import QueueItem
+
+# Each namespace has directory with segments "<first offset>.log".
+# Record: header (offset, time, name length, payload length), name,
+# payload. Payload is JSON of [name, msg, opts] as sent to agents.
+# Segments are read through mmap, sparse index keeps (offset, time,
+# position) every index_bytes of segment.
+
+HEADER = struct.Struct("!QdHI")
+
+class Segment:
+    "One log file"
+
+    def __init__(self, path, base):
+        self.path = path
+        self.base = base # first offset
+        self.f = open(path, "a+b")
+        self.size = self.f.seek(0, os.SEEK_END)
+        self.dirty = False
+        self.mm = None
+        self.index = [] # sparse (offset, time, pos)
+        self.index_pos = None # last indexed position
+        self.last = None # last offset
+        self.pins = 0 # cursors which will read segment
+        self.retired = False # out of retention, deleted when unpinned
+
+    def view(self, pos):
+        "Memory view of file from pos, None if nothing to read"
+
+        if pos >= self.size:
+            return None
+        if self.dirty:
+            self.f.flush()
+            self.dirty = False
+        if self.mm is None or len(self.mm) < self.size:
+            # file grew, old map is released with its slices
+            self.mm = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+        return memoryview(self.mm)[pos:self.size]
+
+    def scan(self, index_bytes):
+        "Build sparse index of existing file"
+
+        pos = 0
+        while True:
+            mv = self.view(pos)
+            if mv is None or len(mv) < HEADER.size:
+                break
+            offset, rtime, nlen, plen = HEADER.unpack_from(mv)
+            rlen = HEADER.size + nlen + plen
+            if len(mv) < rlen:
+                break
+            self.add_index(offset, rtime, pos, index_bytes)
+            self.last = offset
+            pos += rlen
+        if pos < self.size:
+            # partially written record
+            self.mm = None
+            self.f.truncate(pos)
+            self.size = pos
+
+    def add_index(self, offset, rtime, pos, index_bytes):
+        if self.index_pos is None or pos - self.index_pos >= index_bytes:
+            self.index.append((offset, rtime, pos))
+            self.index_pos = pos
+
+    def append(self, offset, rtime, name, payload, index_bytes):
+        "Write record"
+
+        self.add_index(offset, rtime, self.size, index_bytes)
+        data = HEADER.pack(offset, rtime, len(name), len(payload)) + \
+            name + payload
+        self.f.write(data)
+        self.size += len(data)
+        self.dirty = True
+        self.last = offset
+
+    def unpin(self):
+        "Cursor left segment"
+
+        self.pins -= 1
+        if self.retired and not self.pins:
+            self.drop()
+
+    def drop(self):
+        "Close and delete file"
+
+        self.close()
+        os.remove(self.path)
+
+    def close(self):
+        self.mm = None
+        self.f.close()
+
+class TopicLog:
+    "Retention log of one namespace"
+
+    def __init__(self, path, segment_bytes = 64 * 1024 * 1024,
+            retention_bytes = None, index_bytes = 4096):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes # None - keep all
+        self.index_bytes = index_bytes
+        self.segments = []
+        self.next_offset = 0
+
+    def open(self):
+        "Open existing segments"
+
+        os.makedirs(self.path, exist_ok = True)
+        for fn in sorted(os.listdir(self.path)):
+            if fn.endswith(".log"):
+                seg = Segment(os.path.join(self.path, fn), int(fn[:-4]))
+                seg.scan(self.index_bytes)
+                self.segments.append(seg)
+        if self.segments:
+            seg = self.segments[-1]
+            self.next_offset = seg.base if seg.last is None else seg.last + 1
+        else:
+            self.new_segment()
+
+    def new_segment(self):
+        seg = Segment(os.path.join(self.path, "%020d.log" % self.next_offset),
+            self.next_offset)
+        self.segments.append(seg)
+
+    @property
+    def first_offset(self):
+        return self.segments[0].base
+
+    def append(self, name, payload, rtime = None):
+        "Add record, return its offset"
+
+        if self.segments[-1].size >= self.segment_bytes:
+            self.new_segment()
+            self.apply_retention()
+        offset = self.next_offset
+        self.next_offset += 1
+        self.segments[-1].append(offset, time.time() if rtime is None else
+            rtime, name.encode("utf-8"), payload, self.index_bytes)
+        return offset
+
+    def apply_retention(self):
+        "Delete oldest segments over retention size"
+
+        if self.retention_bytes is None:
+            return
+        total = sum(seg.size for seg in self.segments)
+        while len(self.segments) > 1 and total > self.retention_bytes:
+            seg = self.segments.pop(0)
+            total -= seg.size
+            if seg.pins:
+                # replay in progress
+                seg.retired = True
+            else:
+                seg.drop()
+
+    def seek(self, offset):
+        "Return (segment, position) of first record with offset or after"
+
+        offset = max(offset, self.first_offset)
+        idx = bisect.bisect_right([x.base for x in self.segments], offset) - 1
+        seg = self.segments[max(idx, 0)]
+        pos = 0
+        i = bisect.bisect_right(seg.index, (offset, float("inf"), 0)) - 1
+        if i >= 0:
+            pos = seg.index[i][2]
+        for roffset, rtime, name, payload, npos in self.records(seg, pos):
+            if roffset >= offset:
+                return seg, pos
+            pos = npos
+        return seg, pos
+
+    def offset_at(self, rtime):
+        "First offset with record time at rtime or later"
+
+        times = [seg.index[0][1] if seg.index else float("inf")
+            for seg in self.segments]
+        idx = max(bisect.bisect_right(times, rtime) - 1, 0)
+        for seg in self.segments[idx:]:
+            i = max(bisect.bisect_right([x[1] for x in seg.index], rtime) - 1,
+                0)
+            pos = seg.index[i][2] if seg.index else 0
+            for roffset, t, name, payload, npos in self.records(seg, pos):
+                if t >= rtime:
+                    return roffset
+        return self.next_offset
+
+    def records(self, seg, pos):
+        "Iterate (offset, time, name, payload, next pos) from position"
+
+        mv = seg.view(pos)
+        if mv is None:
+            return
+        start = 0
+        while len(mv) - start >= HEADER.size:
+            offset, rtime, nlen, plen = HEADER.unpack_from(mv, start)
+            npos = start + HEADER.size
+            name = mv[npos:npos + nlen]
+            payload = mv[npos + nlen:npos + nlen + plen]
+            start = npos + nlen + plen
+            yield offset, rtime, name, payload, pos + start
+
+    def close(self):
+        for seg in self.segments:
+            seg.close()
+
+class LogItem(QueueItem):
+    "Message from retention log, payload is slice of mapped segment"
+
+    __slots__ = ("rname", "payload", "decoded")
+
+    def __init__(self, name, payload, subid = None):
+        super().__init__(None, subid)
+        self.rname = name
+        self.payload = payload
+        self.decoded = None
+
+    def decode(self):
+        if self.decoded is None:
+            self.decoded = json.loads(bytes(self.payload).decode("utf-8"))
+        return self.decoded
+
+    @property
+    def name(self):
+        return self.rname
+
+    @property
+    def msg(self):
+        return self.decode()[1]
+
+    @property
+    def opts(self):
+        opts = self.decode()[2]
+        if self.subid is None:
+            return opts
+        opts = dict(opts) if opts else {}
+        opts["subid"] = self.subid
+        return opts
+
+    def astuple(self):
+        return (self.rname, self.msg, self.opts)
+
+    def encode_json(self):
+        "Stored JSON, subid is spliced into options"
+
+        if self.subid is None:
+            return self.payload
+        # stored options always have offset, payload ends with "}]"
+        return b"".join([self.payload[:-2], b', "subid": %d}]' % self.subid])
+
+class LogCursor:
+    """Replay of log records [start, end) matched by mask
+
+    Segments of range are pinned, retention deletes them after cursor
+    has left them or is closed.
+    """
+
+    def __init__(self, log, start, end, mask, subid):
+        self.log = log
+        self.end = end
+        self.mask = mask
+        self.subid = subid
+        seg, self.pos = log.seek(start)
+        self.segs = [x for x in log.segments 
+            if x.base >= seg.base and x.base < end]
+        for x in self.segs:
+            x.pins += 1
+        self.records = None
+
+    def next(self):
+        "Next LogItem or None at end"
+
+        while self.segs:
+            if self.records is None:
+                self.records = self.log.records(self.segs[0], self.pos)
+            for offset, rtime, name, payload, npos in self.records:
+                self.pos = npos
+                if offset >= self.end:
+                    self.close()
+                    return None
+                name = bytes(name).decode("utf-8")
+                if self.mask.match(name):
+                    return LogItem(name, payload, self.subid)
+            self.records = None
+            self.segs.pop(0).unpin()
+            self.pos = 0
+        return None
+
+    def close(self):
+        "Release segments"
+
+        self.records = None
+        for x in self.segs:
+            x.unpin()
+        self.segs = []
@@ -0,0 +1,149 @@
+# -*- coding: utf8 -*-
+
+# Low-resource message queue framework
+# In-memory agent and socket hub fixture for tests
+
+import os
+import struct
+import asyncio
+import tempfile
+import unittest
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.client.aio import AsyncAgentIO
+from lrmq.client.sync import codecs, compressors, FRAME_COMPRESSED
+
+class MemAgent(Agent):
+    "Agent connected to in-memory streams"
+
+    def __init__(self, hub, name):
+        super().__init__(hub, name)
+        self.reader = asyncio.StreamReader()
+        self.out = bytearray()
+        self.out_ev = asyncio.Event()
+        self.dumps, self.loads = codecs[b"4bj"]
+        self.decompress = None
+        self.compressed = 0 # compressed frames received
+
+    async def recv(self, blen):
+        return await self.reader.readexactly(blen)
+
+    async def readline(self):
+        return await self.reader.readline()
+
+    def send(self, data):
+        self.out += data
+        self.out_ev.set()
+
+    async def flush(self):
+        pass
+
+    async def finish(self):
+        pass
+
+    def getid(self):
+        return "mem-" + self.name
+
+    # client side helpers
+
+    def feed_line(self, data):
+        self.reader.feed_data(data + b"\n")
+
+    def feed_req(self, req):
+        "Send request with selected 4 byte protocol"
+
+        data = self.dumps(req)
+        self.reader.feed_data(struct.pack("!I", len(data)) + data)
+
+    async def read_line(self):
+        while b"\n" not in self.out:
+            self.out_ev.clear()
+            await self.out_ev.wait()
+        pos = self.out.index(b"\n")
+        line = bytes(self.out[:pos])
+        del self.out[:pos + 1]
+        return line
+
+    async def read_ans(self):
+        "Receive answer with selected 4 byte protocol"
+
+        while True:
+            if len(self.out) >= 4:
+                plen = struct.unpack("!I", self.out[:4])[0]
+                flag = plen & FRAME_COMPRESSED
+                plen &= ~FRAME_COMPRESSED
+                if len(self.out) >= plen + 4:
+                    data = bytes(self.out[4:plen + 4])
+                    del self.out[:plen + 4]
+                    if flag:
+                        self.compressed += 1
+                        data = self.decompress(data)
+                    return self.loads(data)
+            self.out_ev.clear()
+            await self.out_ev.wait()
+
+    async def start(self, proto = b"4bj", comp = None):
+        "Run agent and select protocol"
+
+        self.task = asyncio.ensure_future(self.run())
+        offer = (await self.read_line()).split(b" ")
+        self.offered = offer[0].split(b"|")
+        self.offered_comp = offer[1].split(b",") if len(offer) > 1 else []
+        self.dumps, self.loads = codecs[proto]
+        if comp:
+            self.decompress = compressors[comp][1]
+            self.feed_line(proto + b" " + comp)
+        else:
+            self.feed_line(proto)
+
+class SocketHubCase(unittest.TestCase):
+    "Fresh event loop and hub with unix socket listener in temp directory"
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "hub.sock")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def listener_config(self):
+        return {"type": "unix", "name": "local", "path": self.path,
+            "rpc": True, "log": os.devnull}
+
+    async def start_hub(self, cfg = None, acfg = None):
+        "Start hub, return (hub, listener, main loop task) when listening"
+
+        hub = Hub()
+        cfg = dict({"loglevel": "WARNING"}, **(cfg or {}))
+        cfg["agents"] = [acfg or self.listener_config()]
+        hub.load_config(cfg)
+        listener = hub.pending_agents[-1]
+        task = asyncio.ensure_future(hub.main_loop())
+        while listener.address is None:
+            await asyncio.sleep(0.01)
+        return hub, listener, task
+
+    def run_hub(self, test, cfg = None, timeout = 10):
+        "Run test(hub) coroutine against started hub"
+
+        async def run():
+            hub, listener, task = await self.start_hub(cfg)
+            try:
+                await test(hub)
+            finally:
+                listener.stop()
+                await task
+        self.loop.run_until_complete(asyncio.wait_for(run(), timeout))
+
+    async def connect(self, **kw):
+        "Async client connected to listener"
+
+        client = AsyncAgentIO(**kw)
+        await client.connect_unix(self.path)
+        await client.start()
+        return client
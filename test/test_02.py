@@ -4,12 +4,10 @@ import os
 import sys
 import lrmq
 from lrmq.logs import LogTypes
+from lrmq.logreader import read_log
 import timeout_decorator
 import tempfile
 
-import pickle
-import struct
-
 import asyncio
 
 TEST_TIMEOUT = 5 # it can fail in slow environment
@@ -18,15 +16,7 @@ TEST_TIMEOUT = 5 # it can fail in slow environment
 class TestRPC(unittest.TestCase):
 
     def read_log(self, fn):
-        logs = []
-        with open(fn, "rb") as f:
-            while True:
-                slen = f.read(4)
-                if not slen:
-                    break
-                slen = struct.unpack(">L", slen)[0]
-                data = pickle.loads(f.read(slen))
-                logs.append(data)
+        logs = read_log(fn)
         self.assertGreater(len(logs), 0)
         return logs
         
@@ -35,7 +25,7 @@ class TestRPC(unittest.TestCase):
         skip = 0
         for log in self.read_log(fn):
             log_id = None
-            if "log_id" in log:
+            if log["log_id"] is not None:
                 if log["log_id"] == LogTypes.MARK: continue
                 print(log)
                 if skip > 0:
@@ -131,7 +121,7 @@ class TestRPC(unittest.TestCase):
         assert code == 0
         for log in self.read_log(logname + ".pkl"):
             log_id = None
-            if "log_id" in log:
+            if log["log_id"] is not None:
                 print(log)
 
 if __name__ == '__main__':
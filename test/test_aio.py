@@ -0,0 +1,125 @@
+import unittest
+
+import asyncio
+
+from .memagent import SocketHubCase
+
+class TestAsyncClient(SocketHubCase):
+
+    def test_push(self):
+        async def test(hub):
+            for stream in (100, 0):
+                recv = await self.connect(stream = stream)
+                send = await self.connect()
+                await recv.subscribe(recv.myid + "/.*")
+                await asyncio.gather(*[send.push(recv.myid + "/msg", i)
+                    for i in range(50)])
+                got = []
+                async for name, msg, opts in recv:
+                    got.append(msg)
+                    if len(got) == 50:
+                        break
+                self.assertEqual(got, list(range(50)))
+                await send.exit()
+                await recv.exit()
+        self.run_hub(test)
+
+    def test_concurrent_calls(self):
+        async def test(hub):
+            server = await self.connect()
+            async def mul(fn, args, reqid, sender):
+                await asyncio.sleep(0.01)
+                return args[0] * args[1]
+            server.reg_rpc("mul", mul)
+            server.reg_rpc(None, lambda fn, args, reqid, sender: fn)
+            await server.subscribe(server.myid + "/call")
+            client = await self.connect()
+            rets = await asyncio.gather(*[client.call_check(server.myid,
+                "mul", [i, 2]) for i in range(200)])
+            self.assertEqual(rets, [i * 2 for i in range(200)])
+            self.assertEqual(await client.call_check(server.myid, "echo"),
+                "echo")
+            self.assertFalse(client.calls)
+            self.assertFalse(hub.call_wait)
+            await client.exit()
+            await server.exit()
+        self.run_hub(test)
+
+    def test_first_calls(self):
+        async def test(hub):
+            server = await self.connect()
+            server.reg_rpc(None, lambda fn, args, reqid, sender: args)
+            await server.subscribe(server.myid + "/call")
+            client = await self.connect()
+            subscribe = client.subscribe
+            async def slow_subscribe(*args, **kwargs):
+                await asyncio.sleep(0.1)
+                return await subscribe(*args, **kwargs)
+            client.subscribe = slow_subscribe
+            # answers come after subscription to them
+            rets = await asyncio.gather(*[client.call_check(server.myid,
+                "echo", i, timeout = 1) for i in range(3)])
+            self.assertEqual(rets, [0, 1, 2])
+            await client.exit()
+            await server.exit()
+        self.run_hub(test)
+
+    def test_call_timeout(self):
+        async def test(hub):
+            server = await self.connect()
+            release = asyncio.Event()
+            called = []
+            async def slow(fn, args, reqid, sender):
+                called.append(args)
+                await release.wait()
+                return args
+            server.reg_rpc("slow", slow)
+            await server.subscribe(server.myid + "/call")
+            client = await self.connect()
+            ans = await client.call(server.myid, "slow", 1, timeout = 0.1)
+            self.assertEqual(ans["answer"], "error")
+            self.assertEqual(hub.call_stats(), {"inflight": 0,
+                "completed": 0, "timed_out": 1, "late": 0})
+            # late answer is dropped
+            release.set()
+            await asyncio.sleep(0.1)
+            self.assertEqual(hub.call_stats()["late"], 1)
+            self.assertEqual(await client.call_check(server.myid, "slow", 2),
+                2)
+            # default deadline
+            hub.rpc_timeout = 0.1
+            release.clear()
+            with self.assertRaises(Exception):
+                await client.call_check(server.myid, "slow", 3)
+            self.assertEqual(hub.call_stats(), {"inflight": 0,
+                "completed": 1, "timed_out": 2, "late": 1})
+            self.assertFalse(hub.call_wait)
+            release.set()
+            # bad deadline is refused before call is delivered
+            for timeout in ("soon", -1):
+                with self.assertRaises(Exception):
+                    await client.call(server.myid, "slow", 4, 
+                        timeout = timeout)
+            await asyncio.sleep(0.05)
+            self.assertEqual(called, [1, 2, 3])
+            self.assertFalse(hub.call_wait)
+            await client.exit()
+            await server.exit()
+        self.run_hub(test)
+
+    def test_connection_lost(self):
+        async def test(hub):
+            client = await self.connect()
+            await client.subscribe(client.myid + "/nothing")
+            fut = asyncio.ensure_future(client.request({"cmd": "wait_msg",
+                "block": True}))
+            await asyncio.sleep(0.05)
+            client.writer.close()
+            with self.assertRaises(Exception):
+                await fut
+            async for m in client:
+                self.fail("Unexpected message")
+        self.run_hub(test)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+import asyncio
+import collections
+
+from .memagent import SocketHubCase
+
+class TestBalance(SocketHubCase):
+
+    def run_servers(self, test, count = 3, balance = None, cfg = None):
+        "Start hub with count servers of 'svc' address"
+
+        async def run(hub):
+            self.release = asyncio.Event()
+            self.release.set()
+            servers = []
+            for i in range(count):
+                server = await self.connect()
+                async def whoami(fn, args, reqid, sender, server = server):
+                    await self.release.wait()
+                    return server.myid
+                server.reg_rpc("whoami", whoami)
+                await server.subscribe("svc/call")
+                servers.append(server)
+            client = await self.connect()
+            try:
+                await test(hub, client, servers)
+            finally:
+                self.release.set()
+                for c in servers + [client]:
+                    if c.isloop:
+                        await c.exit()
+        cfg = dict(cfg or {})
+        if balance:
+            cfg["rpc_balance"] = balance
+        self.run_hub(run, cfg or None)
+
+    def test_round_robin(self):
+        async def test(hub, client, servers):
+            rets = await asyncio.gather(*[client.call_check("svc", "whoami")
+                for i in range(30)])
+            self.assertEqual(collections.Counter(rets),
+                {s.myid: 10 for s in servers})
+        self.run_servers(test)
+
+    def test_least_outstanding(self):
+        async def test(hub, client, servers):
+            self.release.clear()
+            calls = [asyncio.ensure_future(client.call_check("svc", "whoami"))
+                for i in range(3)]
+            await asyncio.sleep(0.1)
+            self.assertEqual(sorted(hub.rpc_outstanding.values()), [1, 1, 1])
+            self.release.set()
+            rets = await asyncio.gather(*calls)
+            self.assertEqual(len(set(rets)), 3)
+            self.assertFalse(hub.rpc_outstanding)
+        self.run_servers(test, balance = "least_outstanding")
+
+    def test_server_gone(self):
+        async def test(hub, client, servers):
+            self.release.clear()
+            calls = [asyncio.ensure_future(client.call_check("svc", "whoami"))
+                for i in range(3)]
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(hub.rpc_outstanding), 3)
+            await servers[0].close()
+            for i in range(50):
+                if len(hub.rpc_outstanding) == 2:
+                    break
+                await asyncio.sleep(0.05)
+            self.assertEqual(sorted(hub.rpc_outstanding.values()), [1, 1])
+            self.release.set()
+            done, pending = await asyncio.wait(calls, timeout = 1)
+            self.assertEqual(len(done), 2)
+            for call in pending:
+                call.cancel()
+            self.assertFalse(hub.rpc_outstanding)
+        self.run_servers(test, balance = "least_outstanding",
+            cfg = {"rpc_timeout": 0})
+
+    def test_hash(self):
+        async def test(hub, client, servers):
+            async def call(key):
+                return await client.call_check("svc", "whoami",
+                    opts = {"key": key, "balance": "hash"})
+            first = [await call(i) for i in range(30)]
+            self.assertEqual(len(set(first)), 3)
+            self.assertEqual([await call(i) for i in range(30)], first)
+        self.run_servers(test)
+
+    def test_observer(self):
+        async def test(hub, client, servers):
+            observer = await self.connect()
+            await observer.subscribe("svc/.*")
+            for a in hub.working_agents:
+                if a.getid() == observer.myid:
+                    a.isrpc = False
+            rets = await asyncio.gather(*[client.call_check("svc", "whoami")
+                for i in range(6)])
+            self.assertEqual(len(rets), 6)
+            got = []
+            async for name, msg, opts in observer:
+                got.append(name)
+                if len(got) == 6:
+                    break
+            self.assertEqual(got, ["svc/call"] * 6)
+            await observer.exit()
+        self.run_servers(test)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+import asyncio
+
+from lrmq import bench
+
+class TestBench(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_run(self):
+        args = bench.parse_args(["-s", "fanout", "-s", "rpc", "-p", "4bj",
+            "-n", "50", "--subscribers", "2", "--servers", "1", 
+            "--clients", "2", "--timeout", "30", "--size", "1000",
+            "--compress-threshold", "0", "--compress-threshold", "500"])
+        results = self.loop.run_until_complete(bench.Bench(args).run())
+        self.assertEqual([(x["scenario"], x["compress_threshold"], 
+            x["messages"]) for x in results], [("fanout", 0, 100), 
+            ("fanout", 500, 100), ("rpc", 0, 100), ("rpc", 500, 100)])
+        for res in results:
+            self.assertGreater(res["msgs_per_sec"], 0)
+            self.assertLessEqual(res["latency"]["p50"], 
+                res["latency"]["p999"])
+            self.assertGreater(res["bytes_per_msg"], 0)
+        # payload is compressible
+        self.assertLess(results[1]["bytes_per_msg"], 
+            results[0]["bytes_per_msg"])
+        bench.compare(results, {"results": results})
+        self.assertEqual(results[0]["change"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import unittest
+
+import asyncio
+import collections
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.route import compile_mask
+from lrmq.msgqueue import Envelope
+
+class TestGroup(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.hub = Hub()
+        self.workers = [Agent(self.hub, "w%d" % i) for i in range(3)]
+        self.subids = [self.hub.subscribe(compile_mask("job/.*"), a,
+            group = "workers") for a in self.workers]
+
+    def queued(self, a):
+        return [x.msg for x in a.q.items]
+
+    def test_one_member(self):
+        observer = Agent(self.hub, "observer")
+        self.hub.subscribe(compile_mask("job/.*"), observer)
+        for i in range(9):
+            self.hub.push_msg(None, "job/run", i)
+        got = [self.queued(a) for a in self.workers]
+        self.assertEqual([len(x) for x in got], [3, 3, 3])
+        self.assertEqual(sorted(sum(got, [])), list(range(9)))
+        self.assertEqual(self.queued(observer), list(range(9)))
+
+    def test_credit(self):
+        # free stream credit wins, then shortest queue
+        self.workers[1].stream_credit = 4
+        for i in range(6):
+            self.hub.push_msg(None, "job/run", i)
+        self.assertEqual(self.queued(self.workers[1]), [0, 1, 2, 3])
+        self.assertEqual(len(self.queued(self.workers[0])), 1)
+        self.assertEqual(len(self.queued(self.workers[2])), 1)
+
+    def test_redistribute(self):
+        leaving = self.workers[0]
+        for i in range(3):
+            leaving.push_envelope(Envelope("job/run", i), self.subids[0])
+        leaving.push_msg("w0/private", "own")
+        leaving.isloop = False
+        self.hub.unsubscribe(self.subids[0])
+        self.hub.redistribute(leaving, {self.subids[0]: "workers"})
+        self.assertEqual(len(leaving.q), 0)
+        got = self.queued(self.workers[1]) + self.queued(self.workers[2])
+        self.assertEqual(sorted(got), [0, 1, 2])
+        self.assertEqual(self.hub.groups["workers"], self.subids[1:])
+        for subid in self.subids[1:]:
+            self.hub.unsubscribe(subid)
+        self.assertFalse(self.hub.groups)
+        self.assertFalse(self.hub.sub_groups)
+
+    def test_redistribute_expired(self):
+        acked = []
+        class Store:
+            def ack(self, seq, key):
+                acked.append((seq, key))
+        removed = []
+        self.hub.store = Store()
+        self.hub.removed_msg = lambda a, reason, name, msg, opts: \
+            removed.append((a.name, reason, msg))
+        leaving = self.workers[0]
+        leaving.store_key = "w0"
+        env = Envelope("job/run", "old")
+        env.store_seq = 7
+        leaving.push_envelope(env, self.subids[0],
+            self.hub.loop.time() - 1)
+        leaving.isloop = False
+        self.hub.unsubscribe(self.subids[0])
+        self.hub.redistribute(leaving, {self.subids[0]: "workers"})
+        self.assertEqual(removed, [("w0", "timeout", "old")])
+        self.assertEqual(acked, [(7, "w0")])
+        self.assertEqual(leaving.q.expired, 1)
+        self.assertFalse(self.queued(self.workers[1]) + 
+            self.queued(self.workers[2]))
+
+    def owner_of(self, key, agents):
+        for a in agents:
+            if any(x.env.opts["key"] == key for x in a.q.items 
+                    if x.state == 0):
+                return a
+
+    def test_keyed(self):
+        self.assertEqual(sorted(collections.Counter(
+            self.hub.group_owners["workers"]).values()), [21, 21, 22])
+        for i in range(60):
+            self.hub.push_msg(None, "job/run", i, {"key": "k%d" % (i % 6)})
+        for a in self.workers:
+            keys = set(x.env.opts["key"] for x in a.q.items)
+            # one key is handled by one member in order
+            for key in keys:
+                self.assertEqual([x.msg for x in a.q.items 
+                    if x.env.opts["key"] == key], 
+                    list(range(int(key[1:]), 60, 6)))
+        self.assertEqual(sum(len(a.q) for a in self.workers), 60)
+
+    def test_rebalance(self):
+        events = []
+        self.hub.push_msg = self.record(self.hub.push_msg, events)
+        keys = ["k%d" % i for i in range(40)]
+        for i, key in enumerate(keys):
+            self.hub.push_msg(None, "job/run", i, {"key": key})
+        # new member takes partitions with queued messages
+        new = Agent(self.hub, "new")
+        subid = self.hub.subscribe(compile_mask("job/.*"), new, 
+            group = "workers")
+        self.assertEqual(self.hub.group_owners["workers"].count(subid), 16)
+        self.assertTrue(len(new.q))
+        for x in new.q.items:
+            part = self.hub.partition(x.env.opts["key"])
+            self.assertEqual(self.hub.group_owners["workers"][part], subid)
+            self.assertEqual(x.subid, subid)
+        self.assertIn("system/rebalance_agent/new", events)
+        # member exit, its messages go to new owners
+        leaving = self.workers[0]
+        leaving.isloop = False
+        self.hub.unsubscribe(self.subids[0])
+        self.hub.redistribute(leaving, {self.subids[0]: "workers"})
+        self.assertNotIn(self.subids[0], self.hub.group_owners["workers"])
+        for key in keys:
+            self.assertIsNotNone(self.owner_of(key, self.workers[1:] + [new]))
+        self.assertEqual(sum(len(a.q) for a in self.workers[1:] + [new]), 40)
+
+    def record(self, push_msg, events):
+        def push(sender, name, msg = None, opts = None):
+            events.append(name)
+            return push_msg(sender, name, msg, opts)
+        return push
+
+    def test_cmd_sub(self):
+        a = Agent(self.hub, "a")
+        ans = self.hub.loop.run_until_complete(a.cmd_sub({"mask": "x/.*",
+            "group": "g"}))
+        self.assertEqual(self.hub.sub_groups[ans["subid"]], "g")
+        ans = self.hub.loop.run_until_complete(a.cmd_sub({"mask": "x/.*",
+            "group": 1}))
+        self.assertEqual(ans["answer"], "error")
+
+if __name__ == '__main__':
+    unittest.main()
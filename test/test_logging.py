@@ -0,0 +1,114 @@
+import unittest
+
+import os
+import asyncio
+import logging
+import tempfile
+import threading
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.logs import LogTypes, LogTypesFilter
+from lrmq.logreader import LogReader
+from lrmq.route import compile_mask
+
+class Counted:
+    "Message which counts string conversions"
+
+    def __init__(self):
+        self.strs = 0
+
+    def __str__(self):
+        self.strs += 1
+        return "counted"
+
+class Gate:
+    "Log target which holds writer thread until lock is released"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lock.acquire()
+
+    def handle(self, record):
+        with self.lock:
+            pass
+
+class TestLogging(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def test_filter(self):
+        flt = LogTypesFilter()
+        def record(msg):
+            rec = logging.LogRecord("x", logging.INFO, __file__, 0, msg,
+                (), None)
+            self.assertTrue(flt.filter(rec))
+            return rec
+        rec = record(LogTypes.HUB_START)
+        self.assertEqual(rec.msg, LogTypes.text[LogTypes.HUB_START])
+        self.assertEqual(rec.log_id, LogTypes.HUB_START)
+        self.assertFalse(hasattr(record("text"), "log_id"))
+        self.assertEqual(record({"a": 1}).msg, {"a": 1})
+        self.assertEqual(record(999999).msg, 999999)
+
+    def test_disabled(self):
+        hub = Hub()
+        hub.logger.setLevel(logging.INFO)
+        a = Agent(hub, "a")
+        hub.subscribe(compile_mask("a/.*"), a)
+        msg = Counted()
+        hub.push_msg(None, "a/x", msg)
+        self.assertEqual(msg.strs, 0)
+        hub.logger.setLevel(logging.DEBUG)
+        a.logger.setLevel(logging.DEBUG)
+        hub.push_msg(None, "a/x", msg)
+        self.assertEqual(msg.strs, 2)
+        hub.logger.setLevel(logging.NOTSET)
+        a.logger.setLevel(logging.NOTSET)
+
+    def test_log_thread(self):
+        fn = os.path.join(self.tmpdir.name, "hub.log")
+        hub = Hub()
+        hub.load_config({"loglevel": "INFO", "log": fn, "log_thread": True,
+            "debuglogger": None})
+        self.assertIsNotNone(hub.log_writer.thread)
+        for i in range(100):
+            hub.logger.info(LogTypes.HUB_LOAD_AGENT, "agent%d" % i)
+        hub.cleanup()
+        self.assertIsNone(hub.log_writer.thread)
+        with open(fn, "r") as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 100)
+        self.assertIn("agent99", lines[-1])
+
+    def test_log_thread_args(self):
+        fn = os.path.join(self.tmpdir.name, "hub.log")
+        debugfn = os.path.join(self.tmpdir.name, "debug.log")
+        hub = Hub()
+        hub.load_config({"loglevel": "DEBUG", "log": fn, "log_thread": True,
+            "debuglogger": debugfn})
+        # writer thread waits until args are changed
+        gate = Gate()
+        hub.log_writer.queue.put((gate, None))
+        args = ["old"]
+        hub.logger.info(LogTypes.HUB_LOAD_AGENT, args)
+        args[0] = "new"
+        gate.lock.release()
+        hub.cleanup()
+        hub.logger.setLevel(logging.NOTSET)
+        with open(fn, "r") as f:
+            self.assertIn("['old']", f.readlines()[-1])
+        recs = [x for x in LogReader(debugfn).records()
+            if x["log_id"] == LogTypes.HUB_LOAD_AGENT]
+        self.assertEqual(recs[-1]["args"], (["old"],))
+
+if __name__ == '__main__':
+    unittest.main()
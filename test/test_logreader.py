@@ -0,0 +1,84 @@
+import unittest
+
+import os
+import logging
+import tempfile
+
+from lrmq.logs import LogTypes, LogTypesFilter, BinaryLogHandler
+from lrmq.logreader import LogReader, log_files, read_log
+
+class TestLogReader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmpdir.name, "debug.log")
+        self.loggers = []
+
+    def tearDown(self):
+        for logger, hdlr in self.loggers:
+            logger.removeHandler(hdlr)
+            hdlr.close()
+        self.tmpdir.cleanup()
+
+    def logger(self, name, hdlr):
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.addFilter(LogTypesFilter())
+        logger.addHandler(hdlr)
+        self.loggers.append((logger, hdlr))
+        return logger
+
+    def test_filter(self):
+        hdlr = BinaryLogHandler(self.fn)
+        hub = self.logger("test_hub", hdlr)
+        agent = self.logger("test_agent", hdlr)
+        for i in range(10):
+            hub.debug(LogTypes.HUB_MESSAGE, "a/x", str(i), "None")
+            agent.info(LogTypes.AGENT_START, "a")
+        hub.warning("plain %s", "text")
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            agent.exception(LogTypes.AGENT_EXC_SEND)
+        hdlr.flush()
+        log = LogReader(self.fn)
+        self.assertEqual(len(log), 22)
+        self.assertEqual(log.names, ["test_hub", "test_agent"])
+        recs = list(log.records(log_ids = (LogTypes.HUB_MESSAGE,
+            LogTypes.HUB_MESSAGE)))
+        self.assertEqual([x["args"][1] for x in recs],
+            [str(i) for i in range(10)])
+        self.assertEqual(recs[0]["levelname"], "DEBUG")
+        self.assertEqual(recs[0]["msg"], LogTypes.text[LogTypes.HUB_MESSAGE])
+        self.assertEqual(len(list(log.select(agents = ["test_agent"]))), 11)
+        plain = list(log.records(level = logging.WARNING))
+        self.assertEqual(plain[0]["msg"], "plain %s")
+        self.assertIsNone(plain[0]["log_id"])
+        self.assertIn("boom", plain[1]["exc_info"])
+        first = log.index[0][0]
+        self.assertEqual(len(list(log.select(since = first,
+            until = first))), 0)
+
+    def test_rotation(self):
+        hdlr = BinaryLogHandler(self.fn, max_bytes = 2000, backup_count = 2)
+        hub = self.logger("test_hub", hdlr)
+        for i in range(200):
+            hub.debug(LogTypes.HUB_MESSAGE, "a/x", str(i), "None")
+        hdlr.flush()
+        files = log_files(self.fn)
+        self.assertEqual(files, [self.fn + ".2", self.fn + ".1", self.fn])
+        for fn in files:
+            self.assertLessEqual(os.path.getsize(fn), 2000)
+            # every file has agent names
+            self.assertEqual(LogReader(fn).names, ["test_hub"])
+        nums = [int(x["args"][1]) for x in read_log(self.fn, rotated = True)]
+        self.assertEqual(nums, list(range(200 - len(nums), 200)))
+        # partially written tail is skipped
+        with open(self.fn, "r+b") as f:
+            f.truncate(os.path.getsize(self.fn) - 3)
+        self.assertEqual(len(LogReader(self.fn)), len(read_log(self.fn)))
+        self.assertEqual(read_log(self.fn)[-1]["args"][1], str(nums[-2]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+import os
+import json
+import asyncio
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.route import compile_mask
+from lrmq.metrics import Histogram, TIME_BOUNDS, OTHER_NAMESPACES
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_histogram(self):
+        h = Histogram([1, 2, 4, 8])
+        for v in [0.5] * 50 + [3] * 49 + [100]:
+            h.record(v)
+        self.assertEqual(h.counts, [50, 0, 49, 0, 1])
+        self.assertEqual(h.percentile(0.5), 1)
+        self.assertEqual(h.percentile(0.99), 4)
+        self.assertEqual(h.percentile(0.999), 100)
+        snap = h.snapshot()
+        self.assertEqual(snap["buckets"], [[1, 50], [4, 49], [None, 1]])
+        self.assertEqual(Histogram(TIME_BOUNDS).percentile(0.5), 0)
+
+    def test_hub(self):
+        hub = Hub()
+        agents = [Agent(hub, "a%d" % i) for i in range(3)]
+        for a in agents:
+            hub.subscribe(compile_mask("news/.*"), a)
+            hub.working_agents.append(a)
+        hub.subscribe(compile_mask("job/.*"), agents[0])
+        for i in range(4):
+            hub.push_msg(None, "news/item", i)
+        hub.push_msg(None, "job/run")
+        hub.push_msg(None, "none/msg")
+        stats = self.loop.run_until_complete(
+            hub.sysagent.sysrpc_stats("stats", None, None))
+        self.assertEqual(stats["published"], {"news": 4, "job": 1, "none": 1})
+        self.assertEqual(stats["delivered"], {"news": 12, "job": 1, "none": 0})
+        self.assertEqual(stats["fanout"]["buckets"], [[0, 1], [1, 1],
+            [4, 4]])
+        self.assertEqual(stats["match_time"]["count"], 6)
+        self.assertEqual(stats["agents"]["a0"]["msgs"], 5)
+        self.assertGreater(stats["agents"]["a0"]["bytes"], 0)
+        # sent as system/stats message
+        json.dumps(stats)
+
+    def test_namespaces(self):
+        hub = Hub()
+        hub.load_config({"loglevel": "WARNING", "debuglogger": None,
+            "log": os.devnull, "metrics_namespaces": 3})
+        for i in range(10):
+            hub.push_msg(None, "ns%d/ret" % i)
+        hub.push_msg(None, "ns0/ret")
+        self.assertEqual(hub.metrics.snapshot()["published"], 
+            {"ns0": 2, "ns1": 1, "ns2": 1, OTHER_NAMESPACES: 7})
+        hub.cleanup()
+
+    def test_wait_time(self):
+        hub = Hub()
+        a = Agent(hub, "a")
+        hub.subscribe(compile_mask("a/.*"), a)
+        async def wait():
+            task = asyncio.ensure_future(a.cmd_wait_msg({"block": True}))
+            await asyncio.sleep(0.05)
+            hub.push_msg(None, "a/msg", 1)
+            return await task
+        ans = self.loop.run_until_complete(wait())
+        self.assertEqual(ans["msgs"][0].msg, 1)
+        self.assertEqual(hub.metrics.wait_time.count, 1)
+        self.assertGreater(hub.metrics.wait_time.max, 0.04)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+import unittest
+
+import os
+import json
+import time
+import struct
+import asyncio
+import logging
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.logs import LogTypes, LogTypesFilter
+from lrmq.route import compile_mask
+from lrmq.msgqueue import Envelope, QueueItem
+from lrmq.client.sync import codecs
+
+from .memagent import MemAgent
+
+# Timings are divided by time of fixed pure python workload, so baseline
+# is comparable between machines. Set LRMQ_BENCH_UPDATE=1 to rewrite
+# baseline, LRMQ_BENCH_THRESHOLD to change allowed slowdown.
+BASELINE = os.path.join(os.path.dirname(__file__), "microbench.json")
+THRESHOLD = float(os.environ.get("LRMQ_BENCH_THRESHOLD", "2.0"))
+UPDATE = bool(os.environ.get("LRMQ_BENCH_UPDATE"))
+REPEAT = 5
+
+def best(fn):
+    "Best of REPEAT runs, seconds"
+
+    times = []
+    for i in range(REPEAT):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+def reference():
+    "Workload of dict, string and call operations like hub code"
+
+    d = {}
+    for i in range(20000):
+        key = "ns%d/name" % (i % 100)
+        d[key] = d.get(key, 0) + len(key.split("/", 1)[0])
+    return d
+
+class TestMicrobench(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.unit = best(reference)
+        cls.results = {}
+        try:
+            with open(BASELINE, "r") as f:
+                cls.baseline = json.load(f)
+        except FileNotFoundError:
+            cls.baseline = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        if UPDATE:
+            baseline = dict(cls.baseline)
+            baseline.update(cls.results)
+            with open(BASELINE, "w") as f:
+                json.dump(baseline, f, indent = 2, sort_keys = True)
+                f.write("\n")
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def check(self, name, fn):
+        "Measure fn, fail if it is slower than baseline * THRESHOLD"
+
+        value = round(best(fn) / self.unit, 4)
+        self.results[name] = value
+        base = self.baseline.get(name)
+        if UPDATE:
+            return
+        if base is None:
+            self.skipTest("no baseline for %s, run with LRMQ_BENCH_UPDATE=1" 
+                % name)
+        self.assertLess(value, base * THRESHOLD,
+            "%s: %.4f, baseline %.4f" % (name, value, base))
+
+    def make_hub(self, subs):
+        "Hub with subs subscriptions over 10 agents"
+
+        hub = Hub()
+        agents = [Agent(hub, "bench%d" % i) for i in range(10)]
+        for i in range(subs):
+            # namespace indexed, glob and residual masks
+            if i % 10 == 8:
+                mask = compile_mask("g%d/*" % i, "glob")
+            elif i % 10 == 9:
+                mask = compile_mask("(r%d|x)/.*" % i)
+            else:
+                mask = compile_mask("ns%d/.*" % i)
+            hub.subscribe(mask, agents[i % 10])
+        return hub, agents
+
+    def hub_push(self, subs):
+        hub, agents = self.make_hub(subs)
+        names = ["ns%d/item" % i for i in range(subs) if i % 10 < 8]
+        def run():
+            for i in range(2000):
+                hub.push_msg(None, names[i % len(names)], i)
+            for a in agents:
+                while a.q.pop() is not None:
+                    pass
+        self.check("hub_push_msg_%d" % subs, run)
+
+    def test_hub_push_10(self):
+        self.hub_push(10)
+
+    def test_hub_push_1k(self):
+        self.hub_push(1000)
+
+    def test_hub_push_10k(self):
+        self.hub_push(10000)
+
+    def test_agent_push_drain(self):
+        hub = Hub()
+        a = Agent(hub, "a")
+        async def drain():
+            while True:
+                ans = await a.cmd_wait_msg({})
+                if ans["empty"]:
+                    break
+        def run():
+            for i in range(5000):
+                a.push_msg("a/msg", i)
+            self.loop.run_until_complete(drain())
+        self.check("agent_push_drain", run)
+
+    def test_expiration(self):
+        hub = Hub()
+        def run():
+            # fresh queue, deadline heap does not grow between runs
+            a = Agent(hub, "a")
+            now = hub.loop.time()
+            for i in range(10000):
+                a.push_envelope(Envelope("a/msg", i),
+                    until = now + (-1 if i % 2 else 1000))
+            # half expired, then nothing to do
+            a.check_msg_expiration()
+            for i in range(100):
+                a.check_msg_expiration()
+            while a.q.pop() is not None:
+                pass
+        self.check("check_msg_expiration", run)
+
+    def protocol(self, label):
+        hub = Hub()
+        req = {"cmd": "push", "name": "a/msg", "msg": {"data": "x" * 100,
+            "n": [1, 2, 3]}, "id": 1}
+        items = [QueueItem(Envelope("a/msg", {"n": i, "data": "x" * 100},
+            {"ttl": 10}), 1) for i in range(10)]
+        a = MemAgent(hub, "a")
+        a.select_protocol(Agent.protocols[label])
+        if label == b"jnl":
+            data = json.dumps(req).encode("utf-8") + b"\n"
+        else:
+            data = codecs[label][0](req)
+            data = struct.pack("!I", len(data)) + data
+        async def pair():
+            for i in range(1000):
+                await a.recv_request()
+                await a.send_answer({"answer": "ok", "msgs": items,
+                    "id": i})
+        def run():
+            a.reader.feed_data(data * 1000)
+            self.loop.run_until_complete(pair())
+            a.out.clear()
+        self.check("proto_%s" % label.decode("ascii"), run)
+
+    def test_proto_4bj(self):
+        self.protocol(b"4bj")
+
+    def test_proto_4bp(self):
+        self.protocol(b"4bp")
+
+    @unittest.skipIf(b"4bm" not in Agent.protocols, 
+        "msgpack is not installed")
+    def test_proto_4bm(self):
+        self.protocol(b"4bm")
+
+    def test_proto_jnl(self):
+        self.protocol(b"jnl")
+
+    def test_log_filter(self):
+        flt = LogTypesFilter()
+        def run():
+            for i in range(20000):
+                record = logging.LogRecord("bench", logging.DEBUG, __file__,
+                    0, LogTypes.HUB_MESSAGE, ("a/msg", "1", "None"), None)
+                flt.filter(record)
+        self.check("log_types_filter", run)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import unittest
+
+import asyncio
+
+from lrmq.hub import Hub
+
+from .memagent import MemAgent
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def run_test(self, coro):
+        self.loop.run_until_complete(asyncio.wait_for(coro, 5))
+
+    def test_sequential(self):
+        async def test():
+            hub = Hub()
+            a = MemAgent(hub, "a")
+            await a.start()
+            a.feed_req({"cmd": "sub", "mask": "mem-a/.*", "id": 1})
+            self.assertEqual((await a.read_ans())["id"], 1)
+            # blocking wait stalls next request
+            a.feed_req({"cmd": "wait_msg", "block": True, "id": 2})
+            a.feed_req({"cmd": "ping", "id": 3})
+            await asyncio.sleep(0.01)
+            self.assertEqual(a.out, b"")
+            hub.push_msg(None, "mem-a/test", 1)
+            self.assertEqual((await a.read_ans())["id"], 2)
+            self.assertEqual((await a.read_ans())["id"], 3)
+            a.feed_req({"cmd": "exit", "id": 4})
+            await a.read_ans()
+            await a.task
+        self.run_test(test())
+
+    def test_pipelined(self):
+        async def test():
+            hub = Hub()
+            a = MemAgent(hub, "a")
+            await a.start()
+            a.feed_req({"cmd": "pipeline", "limit": 100000, "id": 0})
+            ans = await a.read_ans()
+            self.assertEqual(ans["limit"], hub.pipeline_limit)
+            a.feed_req({"cmd": "sub", "mask": "mem-a/.*", "id": 1})
+            await a.read_ans()
+            # two waiters share one signal
+            a.feed_req({"cmd": "wait_msg", "block": True, "id": 2})
+            a.feed_req({"cmd": "wait_msg", "block": True, "id": 3})
+            for i in range(4, 104):
+                a.feed_req({"cmd": "push", "name": "mem-a/test", "msg": i, 
+                    "id": i})
+            ids = []
+            msgs = []
+            while len(ids) < 102:
+                ans = await a.read_ans()
+                self.assertEqual(ans["answer"], "ok")
+                ids.append(ans["id"])
+                msgs += [m[1] for m in ans.get("msgs", [])]
+            self.assertEqual(sorted(ids), list(range(2, 104)))
+            # answers are out of order
+            self.assertNotEqual(ids[0], 2)
+            a.feed_req({"cmd": "wait_msg", "id": 200})
+            while True:
+                ans = await a.read_ans()
+                msgs += [m[1] for m in ans["msgs"]]
+                if ans["empty"]: break
+                a.feed_req({"cmd": "wait_msg", "id": 200})
+            self.assertEqual(sorted(msgs), list(range(4, 104)))
+            a.feed_req({"cmd": "exit", "id": 300})
+            self.assertEqual((await a.read_ans())["id"], 300)
+            await a.task
+        self.run_test(test())
+
+    def test_inflight(self):
+        async def test():
+            hub = Hub()
+            a = MemAgent(hub, "a")
+            await a.start()
+            a.feed_req({"cmd": "pipeline", "limit": 4, "id": 0})
+            await a.read_ans()
+            a.feed_req({"cmd": "sub", "mask": "mem-a/.*", "id": 1})
+            await a.read_ans()
+            a.feed_req({"cmd": "wait_msg", "block": True, "id": 2})
+            # waiter holds old limit
+            a.feed_req({"cmd": "pipeline", "limit": 2, "id": 3})
+            self.assertEqual((await a.read_ans())["answer"], "error")
+            a.feed_req({"cmd": "pipeline", "limit": 4, "id": 4})
+            self.assertEqual((await a.read_ans())["answer"], "ok")
+            # lost channel stops agent without next request
+            def send(data):
+                raise ConnectionResetError()
+            a.send = send
+            hub.push_msg(None, "mem-a/test", 1)
+            await a.task
+            self.assertFalse(a.isloop)
+            self.assertFalse(a.inflight)
+        self.run_test(test())
+
+    def test_batch(self):
+        async def test():
+            hub = Hub()
+            a = MemAgent(hub, "a")
+            await a.start()
+            reqs = [{"cmd": "sub", "mask": "mem-a/.*", "id": "s"}]
+            reqs += [{"cmd": "push", "name": "mem-a/test", "msg": i} 
+                for i in range(5)]
+            reqs += [{"cmd": "batch", "reqs": []}, 
+                {"cmd": "wait_msg", "id": "w"}]
+            a.feed_req({"cmd": "batch", "reqs": reqs, "id": 1})
+            ans = await a.read_ans()
+            self.assertEqual(ans["id"], 1)
+            answers = ans["answers"]
+            self.assertEqual(len(answers), len(reqs))
+            self.assertEqual(answers[0]["id"], "s")
+            self.assertEqual([x["answer"] for x in answers[1:6]], 
+                ["ok"] * 5)
+            self.assertEqual(answers[6]["answer"], "error")
+            self.assertEqual([m[1] for m in answers[7]["msgs"]], 
+                list(range(5)))
+            a.feed_req({"cmd": "exit", "id": 2})
+            await a.read_ans()
+            await a.task
+        self.run_test(test())
+
+    def test_stream(self):
+        async def test():
+            hub = Hub()
+            a = MemAgent(hub, "a")
+            await a.start()
+            a.feed_req({"cmd": "sub", "mask": "mem-a/.*", "id": 1})
+            await a.read_ans()
+            a.feed_req({"cmd": "stream", "credit": 3, "id": 2})
+            self.assertEqual((await a.read_ans())["credit"], 3)
+            for i in range(5):
+                hub.push_msg(None, "mem-a/test", i)
+            msgs = []
+            while len(msgs) < 3:
+                ans = await a.read_ans()
+                self.assertEqual(ans["answer"], "stream")
+                self.assertNotIn("id", ans)
+                msgs += [m[1] for m in ans["msgs"]]
+            self.assertEqual(msgs, [0, 1, 2])
+            self.assertEqual(ans["credit"], 0)
+            await asyncio.sleep(0.01)
+            self.assertEqual(a.out, b"")
+            # credit has no answer
+            a.feed_req({"cmd": "credit", "credit": 10})
+            ans = await a.read_ans()
+            self.assertEqual([m[1] for m in ans["msgs"]], [3, 4])
+            a.feed_req({"cmd": "exit", "id": 3})
+            self.assertEqual((await a.read_ans())["id"], 3)
+            await a.task
+        self.run_test(test())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import asyncio
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.client.sync import codecs, default_protocols
+
+from .memagent import MemAgent
+
+class TestProto(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def run_test(self, coro):
+        self.loop.run_until_complete(asyncio.wait_for(coro, 5))
+
+    def roundtrip(self, proto, msg):
+        async def test():
+            hub = Hub()
+            a = MemAgent(hub, "a")
+            await a.start(proto)
+            self.assertIn(proto, a.offered)
+            a.feed_req({"cmd": "sub", "mask": "mem-a/.*", "id": 1})
+            await a.read_ans()
+            a.feed_req({"cmd": "push", "name": "mem-a/x", "msg": msg, 
+                "id": 2})
+            self.assertEqual((await a.read_ans())["answer"], "ok")
+            a.feed_req({"cmd": "wait_msg", "id": 3})
+            ans = await a.read_ans()
+            a.feed_req({"cmd": "exit", "id": 4})
+            await a.read_ans()
+            await a.task
+            return ans
+        result = []
+        async def run():
+            result.append(await test())
+        self.run_test(run())
+        return result[0]
+
+    def test_binary(self):
+        msg = {"data": b"\x00\x01\xff" * 10, "text": "ok"}
+        for proto in codecs:
+            if proto == b"4bj" or proto not in Agent.protocols:
+                continue
+            ans = self.roundtrip(proto, msg)
+            self.assertEqual(ans["msgs"][0][1], msg)
+
+    def test_defaults(self):
+        # pickle answers of hub are not loaded unless requested
+        self.assertNotIn(b"4bp", default_protocols)
+        self.assertEqual(default_protocols[-1], b"4bj")
+
+    def test_json(self):
+        msg = {"text": "привет\n", "n": 1}
+        ans = self.roundtrip(b"4bj", msg)
+        self.assertEqual(ans["msgs"][0][1], msg)
+
+    def test_json_mixed(self):
+        # binary payload can't be delivered to JSON agent, it is reported
+        # lost, rest of messages are delivered
+        async def test():
+            hub = Hub()
+            a = MemAgent(hub, "a")
+            await a.start(b"4bj")
+            a.feed_req({"cmd": "sub", "mask": "mem-a/.*", "id": 1})
+            await a.read_ans()
+            a.feed_req({"cmd": "sub", "mask": "system/msg_lost_agent/.*", 
+                "id": 2})
+            await a.read_ans()
+            hub.push_msg(None, "mem-a/x", "ok1")
+            hub.push_msg(None, "mem-a/x", b"\xff")
+            hub.push_msg(None, "mem-a/x", "ok2")
+            a.feed_req({"cmd": "wait_msg", "id": 3})
+            ans = await a.read_ans()
+            self.assertEqual(ans["answer"], "ok")
+            self.assertEqual(ans["id"], 3)
+            self.assertEqual([x[1] for x in ans["msgs"]], ["ok1", "ok2"])
+            a.feed_req({"cmd": "wait_msg", "id": 4})
+            ans = await a.read_ans()
+            lost = ans["msgs"][0][1]
+            self.assertEqual(lost["event"], "msg_lost")
+            self.assertEqual(lost["msg"]["reason"], "encode_error")
+            self.assertEqual(lost["msg"]["msg"], repr(b"\xff"))
+            # answer of batch without head keys is valid JSON too
+            a.feed_req({"cmd": "batch", "id": 5, "reqs": [{"cmd": "ping"}]})
+            self.assertEqual((await a.read_ans())["answer"], "ok")
+            a.feed_req({"cmd": "exit", "id": 6})
+            self.assertEqual((await a.read_ans())["answer"], "ok")
+            await a.task
+        self.run_test(test())
+
+    def test_compress(self):
+        async def test():
+            hub = Hub()
+            hub.compress_threshold = 1000
+            a = MemAgent(hub, "a")
+            await a.start(b"4bj", b"zlib")
+            self.assertIn(b"zlib", a.offered_comp)
+            a.feed_req({"cmd": "sub", "mask": "mem-a/.*", "id": 1})
+            await a.read_ans()
+            small = "x" * 10
+            big = "abc" * 10000
+            hub.push_msg(None, "mem-a/x", small)
+            a.feed_req({"cmd": "wait_msg", "id": 2})
+            self.assertEqual((await a.read_ans())["msgs"][0][1], small)
+            self.assertEqual(a.compressed, 0)
+            hub.push_msg(None, "mem-a/x", big)
+            a.feed_req({"cmd": "wait_msg", "id": 3})
+            self.assertEqual((await a.read_ans())["msgs"][0][1], big)
+            self.assertEqual(a.compressed, 1)
+            a.feed_req({"cmd": "exit", "id": 4})
+            await a.read_ans()
+            await a.task
+        self.run_test(test())
+
+if __name__ == '__main__':
+    unittest.main()
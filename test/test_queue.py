@@ -0,0 +1,190 @@
+import unittest
+
+import json
+import asyncio
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent, encode_json, encode_msgpack
+from lrmq.route import compile_mask
+from lrmq.msgqueue import MsgQueue, QueueItem, QueueOverflow, Envelope
+
+class TestQueue(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    def fill(self, q, cnt):
+        dropped = []
+        for i in range(cnt):
+            dropped += q.push(QueueItem(Envelope("a/msg", i)))
+        return dropped
+
+    def test_drop_oldest(self):
+        q = MsgQueue(max_msgs = 3)
+        dropped = self.fill(q, 5)
+        self.assertEqual([x.msg for x in dropped], [0, 1])
+        self.assertEqual([x.msg for x in q.items], [2, 3, 4])
+        self.assertEqual(q.dropped, 2)
+
+    def test_drop_newest(self):
+        q = MsgQueue(max_msgs = 3, overflow = "drop_newest")
+        dropped = self.fill(q, 5)
+        self.assertEqual([x.msg for x in dropped], [3, 4])
+        self.assertEqual([x.msg for x in q.items], [0, 1, 2])
+
+    def test_reject(self):
+        q = MsgQueue(max_msgs = 3, overflow = "reject")
+        self.fill(q, 3)
+        self.assertRaises(QueueOverflow, self.fill, q, 1)
+        self.assertEqual(q.rejected, 1)
+
+    def test_bytes(self):
+        q = MsgQueue(max_bytes = 100)
+        q.push(QueueItem(Envelope("a/msg", "x" * 60)))
+        q.push(QueueItem(Envelope("a/msg", "y" * 60)))
+        self.assertEqual(len(q), 1)
+        self.assertEqual(q.pop().msg, "y" * 60)
+        self.assertEqual(q.nbytes, 0)
+        self.assertIsNone(q.pop())
+        # single oversized message is still accepted
+        q.push(QueueItem(Envelope("a/msg", "z" * 200)))
+        self.assertEqual(len(q), 1)
+
+    def test_expire(self):
+        q = MsgQueue()
+        for i in range(10):
+            q.push(QueueItem(Envelope("a/msg", i), 
+                until = i if i % 2 else None))
+        expired = q.expire(5)
+        self.assertEqual([x.msg for x in expired], [1, 3, 5])
+        self.assertEqual(len(q), 7)
+        self.assertEqual(q.pop().msg, 0)
+        self.assertEqual(q.pop().msg, 2)
+        self.assertEqual(q.expire(5), [])
+        self.assertEqual(q.expired, 3)
+
+    def test_agent_ttl(self):
+        hub = Hub()
+        sub = Agent(hub, "sub")
+        lost = []
+        hub.removed_msg = lambda a, reason, name, msg, opts: \
+            lost.append((reason, msg))
+        sub.push_msg("sub/x", 1, {"ttl": 0.01})
+        sub.push_msg("sub/x", 2, {"ttl": 100})
+        sub.push_msg("sub/x", 3, {"ttl": 0.01})
+        sub.push_msg("sub/x", 4)
+        hub.loop.run_until_complete(asyncio.sleep(0.02))
+        # expired message is never delivered, even before cleanup
+        self.assertEqual(sub.take_msg().msg, 2)
+        self.assertEqual(lost, [("timeout", 1)])
+        sub.check_msg_expiration()
+        self.assertEqual(lost, [("timeout", 1), ("timeout", 3)])
+        self.assertEqual(sub.take_msg().msg, 4)
+        self.assertIsNone(sub.take_msg())
+
+    def test_hub_policies(self):
+        hub = Hub()
+        pub = Agent(hub, "pub")
+        sub = Agent(hub, "sub")
+        mon = Agent(hub, "mon")
+        other = Agent(hub, "other")
+        sub.setup_queue({"max_msgs": 2, "overflow": "reject"})
+        hub.subscribe(compile_mask("sub/.*"), sub)
+        hub.subscribe(compile_mask("sub/.*"), other)
+        hub.subscribe(compile_mask("system/msg_lost_agent/.*"), mon)
+        hub.push_msg(pub, "sub/x", 1)
+        hub.push_msg(pub, "sub/x", 2)
+        self.assertRaises(QueueOverflow, hub.push_msg, pub, "sub/x", 3)
+        self.assertEqual(len(sub.q), 2)
+        self.assertEqual(sub.q.rejected, 1)
+        # rejected message is not delivered to anyone, retry is safe
+        self.assertEqual([x.msg for x in other.q.items], [1, 2])
+        self.assertEqual(len(mon.q), 1)
+        lost = mon.q.pop().msg["msg"]
+        self.assertEqual(lost["msg"], 3)
+        self.assertEqual(lost["reason"], "overflow_reject")
+        # drop oldest reports every dropped message
+        sub.setup_queue({"max_msgs": 2})
+        hub.push_msg(pub, "sub/x", 4)
+        self.assertEqual([x.msg for x in sub.q.items], [2, 4])
+        self.assertEqual(mon.q.pop().msg["msg"]["msg"], 1)
+
+    def test_pulse(self):
+        hub = Hub()
+        a = Agent(hub, "a")
+        hub.working_agents.append(a)
+        hub.subscribe(compile_mask("a/.*"), a)
+        for policy in MsgQueue.policies:
+            a.setup_queue({"max_msgs": 2, "overflow": policy})
+            hub.push_msg(None, "a/x", 1)
+            hub.push_msg(None, "a/x", 2)
+            # pulse takes no place of messages
+            hub.push_pulse()
+            hub.push_pulse()
+            self.assertEqual([x.msg for x in a.q.items], [1, 2])
+            self.assertEqual(a.q.dropped + a.q.rejected, 0)
+            self.assertEqual([x.name for x in a.take_part(10)], 
+                ["*/pulse", "a/x", "a/x"])
+            self.assertFalse(a.has_msgs())
+
+    def test_envelope(self):
+        env = Envelope("a/msg", {"data": [1, "два"]}, {"ttl": 5})
+        items = [QueueItem(env, subid) for subid in (None, 1, 2)]
+        for item in items:
+            self.assertEqual(json.loads(item.encode_json().decode("utf-8")),
+                list(item.astuple()))
+        self.assertEqual(items[2].opts, {"ttl": 5, "subid": 2})
+        self.assertEqual(env.opts, {"ttl": 5})
+        # body is shared
+        self.assertIs(env.encode_json()[0], env.json_body)
+        env = Envelope("a/msg")
+        self.assertEqual(json.loads(QueueItem(env, 3).encode_json()),
+            ["a/msg", None, {"subid": 3}])
+        self.assertEqual(json.loads(QueueItem(env).encode_json()),
+            ["a/msg", None, None])
+
+    def test_fanout_encode_once(self):
+        hub = Hub()
+        subs = [Agent(hub, "s%d" % i) for i in range(5)]
+        for a in subs:
+            hub.subscribe(compile_mask("x/.*"), a)
+        hub.push_msg(None, "x/y", {"big": "data"}, {"ttl": 10})
+        items = [a.q.pop() for a in subs]
+        self.assertEqual(len(set(id(x.env) for x in items)), 1)
+        encoded = encode_json({"answer": "ok", "msgs": items[:1], "id": 1})
+        self.assertEqual(json.loads(encoded.decode("utf-8")), 
+            {"answer": "ok", "id": 1, "msgs": [["x/y", {"big": "data"}, 
+            {"ttl": 10, "subid": 1}]]})
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_fanout_pack_once(self):
+        hub = Hub()
+        subs = [Agent(hub, "s%d" % i) for i in range(3)]
+        for a in subs:
+            hub.subscribe(compile_mask("x/.*"), a)
+        hub.push_msg(None, "x/y", {"big": b"\x00data"}, {"ttl": 10})
+        hub.push_msg(None, "x/y", list(range(20)))
+        items = [a.take_part(10) for a in subs]
+        encoded = [encode_msgpack({"answer": "ok", "msgs": x, "id": 1}) 
+            for x in items]
+        self.assertEqual(msgpack.unpackb(encoded[0], raw = False), 
+            {"answer": "ok", "id": 1, "msgs": [
+            ["x/y", {"big": b"\x00data"}, {"ttl": 10, "subid": 1}],
+            ["x/y", list(range(20)), {"subid": 1}]]})
+        # body is shared
+        env = items[0][0].env
+        self.assertIs(env.bodies[b"4bm"], items[2][0].env.bodies[b"4bm"])
+        batch = {"answer": "ok", "answers": [{"answer": "ok", 
+            "msgs": items[1]}] * 20}
+        self.assertEqual(msgpack.unpackb(encode_msgpack(batch), 
+            raw = False)["answers"][19]["msgs"][1][1], list(range(20)))
+
+if __name__ == '__main__':
+    unittest.main()
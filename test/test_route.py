@@ -0,0 +1,110 @@
+import unittest
+
+import re
+import asyncio
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.route import RouteTable, GlobMask, compile_mask, regex_namespace
+
+class TestRoute(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    def test_regex_namespace(self):
+        self.assertEqual(regex_namespace("agent1/.*"), "agent1")
+        self.assertEqual(regex_namespace("system/call"), "system")
+        self.assertEqual(regex_namespace(".*"), None)
+        self.assertEqual(regex_namespace("a.c/.*"), None)
+        self.assertEqual(regex_namespace("ab/?x"), None)
+        self.assertEqual(regex_namespace("ab/x|foo"), None)
+        self.assertEqual(regex_namespace("abc"), None)
+
+    def test_glob(self):
+        self.assertTrue(GlobMask("a/*/c").match("a/b/c"))
+        self.assertFalse(GlobMask("a/*/c").match("a/b/c/d"))
+        self.assertTrue(GlobMask("a/**").match("a/b/c/d"))
+        self.assertFalse(GlobMask("a/**").match("b/c"))
+        self.assertRaises(Exception, GlobMask, "a/**/c")
+        self.assertRaises(Exception, GlobMask, "a/b*")
+
+    def test_compile_mask(self):
+        self.assertIs(compile_mask("a/.*"), compile_mask("a/.*"))
+        for mask in (["a/.*"], {"mask": "a"}, None):
+            with self.assertRaisesRegex(Exception, "Mask must be string"):
+                compile_mask(mask)
+        with self.assertRaisesRegex(Exception, "Unknown mask syntax"):
+            compile_mask("a/*", "sql")
+
+    def test_table(self):
+        masks = [
+            compile_mask("agent1/.*"),
+            compile_mask("agent2/call"),
+            compile_mask(".*/pulse"),
+            compile_mask("agent1/*", "glob"),
+            compile_mask("*/pulse", "glob"),
+            compile_mask("**", "glob"),
+            compile_mask("AGENT1/.*", "re"),
+        ]
+        masks[-1] = re.compile("AGENT1/.*", re.IGNORECASE)
+        table = RouteTable()
+        for subid, mask in enumerate(masks):
+            table.add(mask, subid)
+        names = ["agent1/ret", "agent2/call", "agent2/callx", "x/pulse",
+            "agent1/a/b", "other", ""]
+        for name in names:
+            expected = [subid for subid, mask in enumerate(masks)
+                if mask.match(name)]
+            self.assertEqual(table.match(name), expected, name)
+        # remove all and check that index is empty
+        for subid in range(len(masks)):
+            table.remove(subid)
+            for name in names:
+                expected = [sid for sid, mask in enumerate(masks)
+                    if sid > subid and mask.match(name)]
+                self.assertEqual(table.match(name), expected, name)
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.namespaces, {})
+        self.assertTrue(table.trie.isempty())
+
+    def test_hub_push(self):
+        hub = Hub()
+        a1 = Agent(hub, "a1")
+        a2 = Agent(hub, "a2")
+        s1 = hub.subscribe(compile_mask("a1/.*"), a1)
+        hub.subscribe(compile_mask("a2/*", "glob"), a2)
+        hub.push_msg(None, "a1/test", {"x": 1})
+        hub.push_msg(None, "a2/test", {"x": 2})
+        hub.push_msg(None, "a3/test", {"x": 3})
+        self.assertEqual(len(a1.q), 1)
+        self.assertEqual(len(a2.q), 1)
+        self.assertRaises(Exception, hub.push_msg, a1, "a3/test")
+        hub.unsubscribe(s1)
+        hub.push_msg(None, "a1/test", {"x": 1})
+        self.assertEqual(len(a1.q), 1)
+
+    def test_hub_cache(self):
+        hub = Hub()
+        hub.route_cache_size = 2
+        a1 = Agent(hub, "a1")
+        self.assertIs(compile_mask("a1/.*"), compile_mask("a1/.*"))
+        hub.subscribe(compile_mask("a1/.*"), a1)
+        for name in ("a1/x", "a1/x", "a1/y", "a1/x", "a1/z", "a1/y"):
+            hub.push_msg(None, name)
+        stats = hub.route_cache_stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["size"], 2)
+        # new subscription invalidates cache
+        a2 = Agent(hub, "a2")
+        hub.subscribe(compile_mask("a1/*", "glob"), a2)
+        hub.push_msg(None, "a1/x")
+        self.assertEqual(hub.route_cache_stats()["misses"], 5)
+        self.assertEqual(len(a1.q), 7)
+        self.assertEqual(len(a2.q), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+
+import os
+import asyncio
+
+from lrmq.hub import Hub
+from lrmq.agent import AgentSocket
+from lrmq.shard import ShardNode
+
+from .memagent import SocketHubCase
+
+class TestShard(SocketHubCase):
+
+    def run_shards(self, test, count = 2):
+        "Run shards in one loop, connections are spread over them"
+
+        async def run():
+            cfg = {"loglevel": "WARNING", "log": os.devnull,
+                "debuglogger": None, "agents": [self.listener_config()]}
+            hubs = []
+            nodes = []
+            for index in range(count):
+                hub = Hub()
+                node = ShardNode(hub, index, count, self.tmpdir.name)
+                hub.load_config(node.shard_config(cfg))
+                await node.start()
+                hubs.append(hub)
+                nodes.append(node)
+            listener = hubs[0].pending_agents[-1]
+            tasks = [asyncio.ensure_future(hub.main_loop()) for hub in hubs]
+            while listener.address is None or \
+                    len(nodes[0].peers) < count - 1:
+                await asyncio.sleep(0.01)
+            clients = []
+            for i in range(count * 2):
+                clients.append(await self.connect())
+            try:
+                await test(hubs, clients)
+            finally:
+                for client in clients:
+                    await client.exit()
+                listener.stop()
+                await tasks[0]
+                await nodes[0].close()
+                await asyncio.gather(*tasks[1:])
+                for node in nodes[1:]:
+                    await node.close()
+                for hub in hubs:
+                    hub.cleanup()
+            # link tasks are finished, not left pending on closed loop
+            for node in nodes:
+                self.assertFalse(node.tasks)
+        self.loop.run_until_complete(asyncio.wait_for(run(), 20))
+
+    async def replicated(self, hubs, counts):
+        "Wait until shards have counts of remote subscriptions"
+
+        def remote(hub):
+            return sum(1 for a in hub.subs.values() if a.isshard)
+        while [remote(hub) for hub in hubs] != counts:
+            await asyncio.sleep(0.01)
+
+    def shard_of(self, hubs, client):
+        for index, hub in enumerate(hubs):
+            for a in hub.working_agents + hub.pending_agents:
+                if isinstance(a, AgentSocket) and a.getid() == client.myid:
+                    return index
+
+    def test_pubsub(self):
+        async def test(hubs, clients):
+            self.assertEqual([self.shard_of(hubs, c) for c in clients],
+                [0, 1, 0, 1])
+            self.assertEqual(hubs[0].shard.handoffs, 2)
+            await clients[1].subscribe("news/.*")
+            await clients[2].subscribe("news/.*")
+            # news of each other, system calls of shard 0
+            await self.replicated(hubs, [1, 2])
+            for i in range(10):
+                await clients[0].push("news/item", i)
+            for c in clients[1:3]:
+                got = []
+                async for name, msg, opts in c:
+                    got.append(msg)
+                    if len(got) == 10:
+                        break
+                self.assertEqual(got, list(range(10)))
+            # unsubscribed on exit
+            await clients[1].exit()
+            await self.replicated(hubs, [0, 2])
+            self.assertEqual(len(hubs[0].shard.refs), 2)
+            self.assertEqual(len(hubs[1].shard.refs), 0)
+            clients[1] = await self.connect()
+        self.run_shards(test)
+
+    def test_group(self):
+        async def test(hubs, clients):
+            for c in clients[:2]:
+                await c.subscribe("jobs/.*", group = "workers")
+            await self.replicated(hubs, [1, 2])
+            for i in range(20):
+                await clients[3].push("jobs/run", i)
+            got = []
+            async def take(c):
+                async for name, msg, opts in c:
+                    got.append(msg)
+                    if len(got) == 20:
+                        for c in clients[:2]:
+                            c.msgs.put_nowait(None)
+            await asyncio.gather(*[take(c) for c in clients[:2]])
+            # every job once
+            self.assertEqual(sorted(got), list(range(20)))
+            # owners of key partitions would differ between shards
+            with self.assertRaises(Exception):
+                await clients[3].push("jobs/run", 20, {"key": "k"})
+        self.run_shards(test)
+
+    def test_rpc(self):
+        async def test(hubs, clients):
+            server = clients[1]
+            async def whoami(fn, args, reqid, sender):
+                return [server.myid, args]
+            server.reg_rpc("whoami", whoami)
+            await server.subscribe("svc/call")
+            await self.replicated(hubs, [1, 1])
+            rets = await asyncio.gather(*[clients[0].call_check("svc",
+                "whoami", i) for i in range(5)])
+            self.assertEqual(rets, [[server.myid, i] for i in range(5)])
+            # traced by shard of caller
+            self.assertEqual(hubs[0].calls_completed, 5)
+            self.assertFalse(hubs[0].call_wait)
+            self.assertFalse(hubs[1].call_wait)
+            # system calls are served by shard 0
+            stats = await clients[3].call_check("system", "stats")
+            self.assertEqual(stats["shard"]["index"], 0)
+            self.assertEqual(stats["shard"]["peers"]["1"]["received"], 6)
+            # counters of all shards, stats call is traced by shard 1
+            for c in clients:
+                self.assertIn(c.myid, stats["agents"])
+            self.assertEqual(stats["calls"]["completed"], 5)
+            self.assertEqual(stats["calls"]["inflight"], 1)
+            self.assertEqual(list(stats["shards"]), ["1"])
+            self.assertEqual(stats["rpc_time"]["count"], 5)
+            calls = await clients[2].call_check("system", "call_stats")
+            self.assertEqual(calls["completed"], 6)
+        self.run_shards(test)
+
+    def test_rpc_observer(self):
+        async def test(hubs, clients):
+            caller, observer, server = clients[:3]
+            async def whoami(fn, args, reqid, sender):
+                return server.myid
+            server.reg_rpc("whoami", whoami)
+            await server.subscribe("svc/call")
+            for a in hubs[1].working_agents:
+                if a.getid() == observer.myid:
+                    a.isrpc = False
+            await observer.subscribe("svc/.*")
+            await self.replicated(hubs, [1, 2])
+            # other shard has no server, it is never selected
+            rets = await asyncio.gather(*[caller.call_check("svc", "whoami",
+                timeout = 2) for i in range(4)])
+            self.assertEqual(rets, [server.myid] * 4)
+            got = []
+            async for name, msg, opts in observer:
+                got.append(name)
+                if len(got) == 4:
+                    break
+            self.assertEqual(got, ["svc/call"] * 4)
+        self.run_shards(test)
+
+if __name__ == '__main__':
+    unittest.main()
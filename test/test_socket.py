@@ -0,0 +1,101 @@
+import unittest
+
+import io
+import os
+import sys
+import json
+import struct
+import asyncio
+import logging
+import contextlib
+
+from .memagent import SocketHubCase
+
+class SocketClient:
+    "Minimal 4bj client"
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.cmdid = 0
+
+    async def negotiate(self, proto = b"4bj"):
+        self.offer = (await self.reader.readline()).strip()
+        self.writer.write(proto + b"\n")
+
+    async def req(self, **req):
+        self.cmdid += 1
+        req["id"] = self.cmdid
+        data = json.dumps(req).encode("utf-8")
+        self.writer.write(struct.pack("!I", len(data)) + data)
+        plen = struct.unpack("!I", await self.reader.readexactly(4))[0]
+        return json.loads((await self.reader.readexactly(plen)).decode())
+
+class TestSocket(SocketHubCase):
+
+    async def exchange(self, clients):
+        for c in clients:
+            await c.negotiate()
+            self.assertNotIn(b"4bp", c.offer)
+        ids = []
+        for c in clients:
+            ans = await c.req(cmd = "getid")
+            ids.append(ans["agentid"])
+            await c.req(cmd = "sub", mask = ans["agentid"] + "/.*")
+        self.assertEqual(len(set(ids)), len(clients))
+        # each client sends message to next one
+        for idx, c in enumerate(clients):
+            dest = ids[(idx + 1) % len(ids)]
+            ans = await c.req(cmd = "push", name = dest + "/hello", msg = idx)
+            self.assertEqual(ans["answer"], "ok")
+        for idx, c in enumerate(clients):
+            ans = await c.req(cmd = "wait_msg", block = True)
+            self.assertEqual(ans["msgs"][0][1], (idx - 1) % len(clients))
+        for c in clients:
+            await c.req(cmd = "exit")
+            c.writer.close()
+
+    def test_unix(self):
+        path = self.path
+        async def test():
+            hub, listener, task = await self.start_hub(acfg = {"type": 
+                "unix", "name": "local", "path": path, "log": os.devnull})
+            clients = []
+            for i in range(3):
+                clients.append(SocketClient(
+                    *(await asyncio.open_unix_connection(path))))
+            await self.exchange(clients)
+            # connections use listener logger
+            self.assertNotIn("log_local-1", logging.Logger.manager.loggerDict)
+            # no protocol selected, data of peer is not hub output
+            reader, writer = await asyncio.open_unix_connection(path)
+            await reader.readline()
+            writer.write(b"\nnot for stdout\n")
+            writer.close()
+            while len(hub.working_agents) > 2:
+                await asyncio.sleep(0.01)
+            listener.stop()
+            await task
+            self.assertFalse(os.path.exists(path))
+        out = io.TextIOWrapper(io.BytesIO())
+        with contextlib.redirect_stdout(out):
+            self.loop.run_until_complete(asyncio.wait_for(test(), 5))
+        out.flush()
+        self.assertNotIn(b"not for stdout", out.buffer.getvalue())
+
+    def test_tcp(self):
+        async def test():
+            hub, listener, task = await self.start_hub(acfg = {"type": 
+                "tcp", "name": "net", "port": 0, "log": os.devnull})
+            host, port = listener.address
+            clients = []
+            for i in range(3):
+                clients.append(SocketClient(
+                    *(await asyncio.open_connection(host, port))))
+            await self.exchange(clients)
+            listener.stop()
+            await task
+        self.loop.run_until_complete(asyncio.wait_for(test(), 5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ import inspect
 import re
 
 import lrmq
+import lrmq.shard
 
 class TestSource(unittest.TestCase):
 
@@ -114,7 +115,8 @@ class TestSource(unittest.TestCase):
                             sobj.__code__.co_firstlineno)
             return items
             
-        items = scan_all(lrmq.agent) + scan_all(lrmq.hub)
+        items = scan_all(lrmq.agent) + scan_all(lrmq.hub) + \
+            scan_all(lrmq.shard)
         
         # check unused
         unused = list(logtypes.keys())
@@ -0,0 +1,136 @@
+import unittest
+
+import os
+import asyncio
+import tempfile
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent
+from lrmq.route import compile_mask
+from lrmq.store import Store
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def reopen(self, store, **kw):
+        self.loop.run_until_complete(store.close())
+        store = Store(self.loop, self.path, **kw)
+        store.open()
+        return store
+
+    def test_recover(self):
+        store = Store(self.loop, self.path)
+        store.open()
+        futs = [store.put("a/x", i, None, ["w1", "w2"])[1] for i in range(5)]
+        # group commit
+        self.assertEqual(len(set(futs)), 1)
+        self.loop.run_until_complete(futs[0])
+        self.assertEqual(store.commits, 1)
+        store.ack(0, "w1")
+        store.ack(0, "w2")
+        store.ack(1, "w1")
+        store.add(2, "w3")
+        store.ack(2, "w1")
+        store = self.reopen(store)
+        queues = store.recovered()
+        self.assertEqual([x[2] for x in queues["w1"]], [3, 4])
+        self.assertEqual([x[2] for x in queues["w2"]], [1, 2, 3, 4])
+        self.assertEqual([x[2] for x in queues["w3"]], [2])
+        self.assertEqual(store.seq, 5)
+        self.loop.run_until_complete(store.close())
+
+    def test_segments(self):
+        store = Store(self.loop, self.path, segment_bytes = 200)
+        store.open()
+        for i in range(20):
+            seq, fut = store.put("a/x", "x" * 20, None, ["w"])
+            self.loop.run_until_complete(fut)
+        self.assertGreater(len(store.segments), 5)
+        self.assertEqual(len(os.listdir(self.path)), len(store.segments))
+        # acked prefix is deleted, acks of old messages are kept
+        for seq in range(10):
+            store.ack(seq, "w")
+        self.assertLess(len(store.segments), 6)
+        store.ack(15, "w")
+        store = self.reopen(store, segment_bytes = 200)
+        self.assertEqual([x[0] for x in store.recovered()["w"]],
+            [10, 11, 12, 13, 14, 16, 17, 18, 19])
+        for seq in list(store.live):
+            store.ack(seq, "w")
+        self.assertEqual(len(store.segments), 1)
+        self.loop.run_until_complete(store.close())
+
+    def test_truncated(self):
+        store = Store(self.loop, self.path)
+        store.open()
+        for i in range(3):
+            store.put("a/x", i, None, ["w"])
+        store = self.reopen(store)
+        self.loop.run_until_complete(store.close())
+        seg = os.path.join(self.path, sorted(os.listdir(self.path))[0])
+        with open(seg, "r+b") as f:
+            f.truncate(os.path.getsize(seg) - 3)
+        store = Store(self.loop, self.path)
+        store.open()
+        self.assertEqual([x[2] for x in store.recovered()["w"]], [0, 1])
+        self.loop.run_until_complete(store.close())
+
+    def test_truncated_append(self):
+        store = Store(self.loop, self.path)
+        store.open()
+        for i in range(3):
+            store.put("a/x", i, None, ["w"])
+        store = self.reopen(store)
+        store.ack(0, "w")
+        self.loop.run_until_complete(store.close())
+        # torn ack in active segment, which is reused after restart
+        seg = os.path.join(self.path, sorted(os.listdir(self.path))[-1])
+        with open(seg, "r+b") as f:
+            f.truncate(os.path.getsize(seg) - 3)
+        store = Store(self.loop, self.path)
+        store.open()
+        for i in range(3, 6):
+            store.put("a/x", i, None, ["w"])
+        store = self.reopen(store)
+        self.assertEqual([x[2] for x in store.recovered()["w"]],
+            list(range(6)))
+        self.loop.run_until_complete(store.close())
+
+    def test_hub(self):
+        def start():
+            hub = Hub()
+            hub.load_config({"loglevel": "WARNING", "log": os.devnull,
+                "store": {"path": self.path, "namespaces": ["orders"]}})
+            a = Agent(hub, "w")
+            a.store_key = "w"
+            hub.subscribe(compile_mask("(orders|news)/.*"), a)
+            hub.restore_queue(a)
+            return hub, a
+        hub, a = start()
+        fut = hub.push_msg(None, "orders/new", 1)
+        self.assertIsNone(hub.push_msg(None, "news/new", 2))
+        hub.push_msg(None, "news/new", 3, {"persist": True})
+        hub.push_msg(None, "orders/new", 4)
+        self.loop.run_until_complete(fut)
+        self.assertEqual(a.take_msg().msg, 1)
+        self.loop.run_until_complete(hub.store.close())
+        hub.cleanup()
+        # restart, only undelivered persisted messages come back
+        hub, a = start()
+        self.assertEqual([x.msg for x in a.take_part(10)], [3, 4])
+        self.assertFalse(hub.store.live)
+        self.loop.run_until_complete(hub.store.close())
+        hub.cleanup()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+
+import socket
+import threading
+import concurrent.futures
+
+from lrmq.client.sync import ThreadedAgentIO
+
+from .memagent import SocketHubCase
+
+class TestThreadedClient(SocketHubCase):
+
+    def setUp(self):
+        super().setUp()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        super().tearDown()
+
+    def connect(self, **kw):
+        "Client over unix socket instead of stdio"
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        self.socks.append(sock)
+        client = ThreadedAgentIO(**kw)
+        client.rfile = sock.makefile("rb")
+        client.wfile = sock.makefile("wb")
+        client.init_loop()
+        return client
+
+    def run_hub(self, test):
+        "Run blocking test(hub) in executor thread"
+
+        super().run_hub(lambda hub: self.loop.run_in_executor(None, test, 
+            hub))
+
+    def test_threads(self):
+        def test(hub):
+            for stream in (100, 0):
+                server = self.connect(stream = stream)
+                server.reg_rpc("add", lambda fn, args, reqid, sender:
+                    args[0] + args[1])
+                server.subscribe_check(server.myid + "/call")
+                server.isloop = True
+                def serve():
+                    while server.isloop:
+                        server.process_msgs()
+                thread = threading.Thread(target = serve, daemon = True)
+                thread.start()
+                client = self.connect(stream = stream)
+                client.subscribe_check(client.myid + "/ret")
+                with concurrent.futures.ThreadPoolExecutor(8) as pool:
+                    rets = list(pool.map(lambda i: client.call_check(
+                        server.myid, "add", [i, 1])["ret"], range(200)))
+                self.assertEqual(rets, [i + 1 for i in range(200)])
+                self.assertFalse(client.wait_req)
+                client.exit_check()
+                server.exit_check()
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+        self.run_hub(test)
+
+if __name__ == '__main__':
+    unittest.main()
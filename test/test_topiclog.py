@@ -0,0 +1,151 @@
+import unittest
+
+import os
+import json
+import asyncio
+import tempfile
+
+from lrmq.hub import Hub
+from lrmq.agent import Agent, encode_json
+from lrmq.topiclog import TopicLog, LogCursor
+from lrmq.route import compile_mask
+
+class TestTopicLog(unittest.TestCase):
+
+    def setUp(self):
+        # reinitialize loop
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        self.loop.close()
+
+    def fill(self, log, count, start = 0):
+        for i in range(start, start + count):
+            log.append("news/%d" % (i % 2), json.dumps(["news/%d" % (i % 2),
+                i, {"offset": i}]).encode("utf-8"), rtime = 1000 + i)
+
+    def replay(self, log, start, end = None, mask = "news/.*"):
+        cur = LogCursor(log, start, log.next_offset if end is None else end,
+            compile_mask(mask), None)
+        got = []
+        while True:
+            item = cur.next()
+            if item is None:
+                return got
+            got.append(item.msg)
+
+    def test_index(self):
+        log = TopicLog(self.path, index_bytes = 100)
+        log.open()
+        self.fill(log, 100)
+        self.assertGreater(len(log.segments[0].index), 10)
+        self.assertEqual(self.replay(log, 37), list(range(37, 100)))
+        self.assertEqual(self.replay(log, 10, 15), list(range(10, 15)))
+        self.assertEqual(self.replay(log, 0, mask = "news/1"),
+            list(range(1, 100, 2)))
+        self.assertEqual(log.offset_at(1050.5), 51)
+        self.assertEqual(log.offset_at(0), 0)
+        self.assertEqual(log.offset_at(5000), 100)
+        # payload is slice of mapped file
+        cur = LogCursor(log, 5, 6, compile_mask("news/.*"), 3)
+        item = cur.next()
+        self.assertIsInstance(item.payload, memoryview)
+        self.assertEqual(json.loads(item.encode_json().decode("utf-8")),
+            ["news/1", 5, {"offset": 5, "subid": 3}])
+        self.assertEqual(item.opts, {"offset": 5, "subid": 3})
+        del cur, item
+        log.close()
+
+    def test_segments(self):
+        log = TopicLog(self.path, segment_bytes = 500, retention_bytes = 2000)
+        log.open()
+        self.fill(log, 200)
+        self.assertGreater(len(log.segments), 2)
+        self.assertLessEqual(sum(seg.size for seg in log.segments), 2500)
+        first = log.first_offset
+        self.assertGreater(first, 0)
+        self.assertEqual(self.replay(log, 0), list(range(first, 200)))
+        log.close()
+        # reopen, partially written record is dropped
+        seg = os.path.join(self.path, sorted(os.listdir(self.path))[-1])
+        with open(seg, "r+b") as f:
+            f.truncate(os.path.getsize(seg) - 3)
+        log = TopicLog(self.path, segment_bytes = 500)
+        log.open()
+        self.assertEqual(log.next_offset, 199)
+        self.fill(log, 1, 199)
+        self.assertEqual(self.replay(log, 190), list(range(190, 200)))
+        log.close()
+
+    def test_pinned(self):
+        log = TopicLog(self.path, segment_bytes = 500, retention_bytes = 1000)
+        log.open()
+        self.fill(log, 20)
+        first = log.first_offset
+        cur = LogCursor(log, first, log.next_offset, 
+            compile_mask("news/.*"), None)
+        self.assertEqual(cur.next().msg, first)
+        # segments of replay are kept out of retention until read
+        self.fill(log, 100, 20)
+        self.assertGreater(log.first_offset, 20)
+        self.assertGreater(len(os.listdir(self.path)), len(log.segments))
+        got = []
+        while True:
+            item = cur.next()
+            if item is None:
+                break
+            got.append(item.msg)
+        self.assertEqual(got, list(range(first + 1, 20)))
+        del item
+        self.assertEqual(len(os.listdir(self.path)), len(log.segments))
+        # closed cursor releases rest of segments
+        cur = LogCursor(log, log.first_offset, log.next_offset, 
+            compile_mask("news/.*"), None)
+        cur.next()
+        self.fill(log, 100, 120)
+        cur.close()
+        self.assertEqual(len(os.listdir(self.path)), len(log.segments))
+        log.close()
+
+    def test_hub(self):
+        hub = Hub()
+        hub.load_config({"loglevel": "WARNING", "log": os.devnull,
+            "retention": {"path": self.path, "namespaces": ["news"]}})
+        pub = Agent(hub, "pub")
+        # no subscribers, message is kept in log only
+        for i in range(5):
+            self.assertIsNone(hub.push_msg(pub, "news/item", i))
+        self.assertEqual(hub.topic_logs["news"].next_offset, 5)
+        a = Agent(hub, "a")
+        def sub(**kw):
+            req = {"cmd": "sub", "mask": "news/.*"}
+            req.update(kw)
+            return self.loop.run_until_complete(a.cmd_sub(req))
+        ans = sub(from_offset = 2)
+        self.assertEqual((ans["offset"], ans["end"]), (2, 5))
+        hub.push_msg(None, "news/item", 5)
+        # history first, then live
+        part = a.take_part(10)
+        self.assertEqual([x.msg for x in part], [2, 3, 4, 5])
+        self.assertEqual([x.opts["offset"] for x in part], [2, 3, 4, 5])
+        data = json.loads(encode_json({"answer": "ok", "msgs": part}
+            ).decode("utf-8"))
+        self.assertEqual(data["msgs"][0], ["news/item", 2,
+            {"offset": 2, "subid": ans["subid"]}])
+        self.assertEqual(sub(latest = True)["offset"], 6)
+        self.assertEqual(a.take_part(10), [])
+        self.assertEqual(sub(from_time = 0)["offset"], 0)
+        self.assertEqual(len(a.take_part(10)), 6)
+        self.assertEqual(sub(from_offset = 0, mask = "other/.*")["answer"],
+            "error")
+        self.assertEqual(sub(from_offset = 0, mask = ".*")["answer"], "error")
+        for log in hub.topic_logs.values():
+            log.close()
+        hub.cleanup()
+
+if __name__ == '__main__':
+    unittest.main()